@@ -1,9 +1,19 @@
 from __future__ import print_function
+import errno
+import io
 import os
+import re
+import site
+import subprocess
 import sys
+import threading
+import weakref
+from copy import copy
 from itertools import chain
 from collections import defaultdict, deque
 import argparse
+from array import array
+from bisect import bisect_right
 from operator import attrgetter
 import json
 from importlib import import_module
@@ -19,14 +29,15 @@ except ImportError:
     from collections import Mapping
 
 try:
-    from pip._internal.utils.misc import get_installed_distributions
-    from pip._internal.operations.freeze import FrozenRequirement
+    from StringIO import StringIO
 except ImportError:
-    from pip import get_installed_distributions, FrozenRequirement
+    from io import StringIO
 
-from pip._vendor import pkg_resources
-# inline:
-# from graphviz import backend, Digraph
+# inline (pip and pkg_resources take a long time to import, hence
+# they are imported only in the code paths that need them):
+# from pip._internal.utils.misc import get_installed_distributions
+# from pip._internal.operations.freeze import FrozenRequirement
+# from pip._vendor import pkg_resources
 
 
 __version__ = '2.0.0b1'
@@ -53,7 +64,11 @@ def sorted_tree(tree):
 
 
 def guess_version(pkg_key, default='?'):
-    """Guess the version of a pkg when pip doesn't provide it
+    """Guess the version of a pkg by importing it and looking for a
+    `__version__` attribute
+
+    Note that importing arbitrary packages can have side effects, so
+    this is used only if explicitly asked for (--guess-by-import).
 
     :param str pkg_key: key of the package
     :param str default: default version to return if unable to find
@@ -69,13 +84,276 @@ def guess_version(pkg_key, default='?'):
         return getattr(m, '__version__', default)
 
 
+class VersionResolver(object):
+    """Resolves the installed versions of required packages for which
+    there's no distribution in the DAG (eg. because they were
+    filtered out by --local-only or are not installed at all)
+
+    Versions are read from the installed metadata, without importing
+    anything, and are looked up only once per package key.
+
+      :param bool guess_by_import: if no metadata is found, guess the
+                                   version by importing the package
+                                   (refer `guess_version`)
+      :param list paths: directories to look for the metadata in
+                         (default: sys.path). Versions are never
+                         guessed by import then, as that would find the
+                         packages of the current environment.
+    """
+
+    def __init__(self, guess_by_import=False, paths=None):
+        self.guess_by_import = guess_by_import
+        self.paths = None if paths is None else list(paths)
+        self._versions = {}
+
+    def resolve(self, pkg_key, default='?'):
+        """Return the installed version of a package
+
+        :param str pkg_key: key of the package
+        :param str default: default version to return if unable to find
+        :returns: version
+        :rtype: string
+
+        """
+        try:
+            version = self._versions[pkg_key]
+        except KeyError:
+            if self.paths is None:
+                version = self.lookup_metadata(pkg_key)
+                if version is None and self.guess_by_import:
+                    version = guess_version(pkg_key, None)
+            else:
+                version = self.lookup_metadata(pkg_key, self.paths)
+            self._versions[pkg_key] = version
+        return default if version is None else version
+
+    def override(self, versions):
+        """Return a copy of the resolver that resolves some packages
+        to the given versions instead of looking them up
+
+        :param dict versions: package key -> version (None for the
+                              packages that are not to be found)
+        :rtype: VersionResolver
+
+        """
+        resolver = copy(self)
+        resolver._versions = dict(self._versions)
+        resolver._versions.update(versions)
+        return resolver
+
+    @staticmethod
+    def lookup_metadata(pkg_key, paths=None):
+        """Return the version of a package as per it's installed metadata
+
+        :param str pkg_key: key of the package
+        :param list paths: directories to look in (default: sys.path)
+        :returns: version or None if the package is not installed
+        :rtype: string
+
+        """
+        try:
+            import importlib.metadata as importlib_metadata
+        except ImportError:
+            from pip._vendor import pkg_resources
+            if paths is not None:
+                dist = pkg_resources.WorkingSet(paths).by_key.get(pkg_key)
+                return None if dist is None else dist.version
+            try:
+                return pkg_resources.get_distribution(pkg_key).version
+            except pkg_resources.DistributionNotFound:
+                return None
+        if paths is not None:
+            for dist in importlib_metadata.distributions(name=pkg_key,
+                                                         path=paths):
+                return dist.version
+            return None
+        try:
+            return importlib_metadata.version(pkg_key)
+        except importlib_metadata.PackageNotFoundError:
+            return None
+
+
+# Parsed version specifiers and versions keyed by their string
+# representation. As the same requirement strings and versions occur
+# many times in a tree, each of them is parsed only once. The result
+# of checking a version against a specifier is cached as well.
+_specifiers = {}
+_versions = {}
+_satisfied = {}
+
+
+def parse_specifier(spec):
+    """Return the (cached) SpecifierSet for a version spec string
+
+    :param str spec: comma separated version specifiers eg. '>=1.0,<2'
+                     or None
+    :rtype: packaging.specifiers.SpecifierSet
+
+    """
+    try:
+        return _specifiers[spec]
+    except KeyError:
+        from pip._vendor.packaging.specifiers import SpecifierSet
+        specifier = _specifiers[spec] = SpecifierSet(spec or '')
+        return specifier
+
+
+def parse_version(version):
+    """Return the (cached) parsed version
+
+    :param str version: version string
+    :returns: the parsed version or None if it's invalid (as per the
+              version of `packaging` vendored by pip)
+    :rtype: packaging.version.Version
+
+    """
+    try:
+        return _versions[version]
+    except KeyError:
+        from pip._vendor.packaging.version import parse, InvalidVersion
+        try:
+            parsed = parse(version)
+        except InvalidVersion:
+            parsed = None
+        _versions[version] = parsed
+        return parsed
+
+
+def version_satisfies(version, spec):
+    """Check whether a version satisfies the version specifiers
+
+    Pre-releases are considered to satisfy the specifiers and invalid
+    versions satisfy only an empty specifier.
+
+    :param str version: version string
+    :param str spec: comma separated version specifiers or None
+    :rtype: bool
+
+    """
+    try:
+        return _satisfied[(version, spec)]
+    except KeyError:
+        specifier = parse_specifier(spec)
+        parsed = parse_version(version)
+        if parsed is None:
+            result = not specifier
+        else:
+            result = specifier.contains(parsed, prereleases=True)
+        _satisfied[(version, spec)] = result
+        return result
+
+
 def frozen_req_from_dist(dist):
+    try:
+        from pip._internal.operations.freeze import FrozenRequirement
+    except ImportError:
+        from pip import FrozenRequirement
+
+    # pip needs the real pkg_resources distribution and not the
+    # lightweight one returned by the faster discovery backends
+    if isinstance(dist, MetadataDistribution):
+        dist = dist.as_pkg_resources()
     try:
         return FrozenRequirement.from_dist(dist)
     except TypeError:
         return FrozenRequirement.from_dist(dist, [])
 
 
+# Keyed by the distribution objects, which are referred to weakly so
+# that the cache doesn't keep distributions alive once no DAG uses them
+_frozen_reprs = weakref.WeakKeyDictionary()
+
+
+def frozen_repr(dist):
+    """Return the (cached) frozen representation of a distribution
+    ie. it's line in the output of `pip freeze`
+
+    :param dist: the distribution
+    :rtype: str
+
+    """
+    try:
+        return _frozen_reprs[dist]
+    except KeyError:
+        fr = _frozen_reprs[dist] = _compute_frozen_repr(dist)
+        return fr
+
+
+def _compute_frozen_repr(dist):
+    if not isinstance(dist, MetadataDistribution):
+        return str(frozen_req_from_dist(dist)).strip()
+    if not dist.is_on_disk():
+        # eg. read from a wheel or a tarball, so there's nothing for
+        # pip to look at except the name and version
+        return '{0}=={1}'.format(dist.project_name, dist.version)
+    try:
+        return str(frozen_req_from_dist(dist)).strip()
+    except AttributeError:
+        # pip >= 21.3 no longer accepts pkg_resources distributions
+        return dist.direct_url_repr()
+
+
+def prefetch_frozen_reprs(dists, threads=None):
+    """Compute the frozen representations of distributions concurrently
+
+    For editable installs, pip finds the url and revision by running
+    the VCS commands (git, hg etc.) in the source checkout, which is
+    slow when done one package at a time while rendering. Calling this
+    beforehand runs them in a thread pool and caches the results for
+    `frozen_repr`.
+
+    :param dists: iterable of distributions
+    :param int threads: max. no. of threads (refer `_thread_map`)
+    :returns: None
+
+    """
+    todo = []
+    seen = set()
+    for dist in dists:
+        if dist not in _frozen_reprs and dist not in seen:
+            seen.add(dist)
+            todo.append(dist)
+    reprs = _thread_map(_compute_frozen_repr, todo, threads)
+    _frozen_reprs.update(zip(todo, reprs))
+
+
+def _thread_map(fn, items, threads=None):
+    """Same as `map` but calls `fn` concurrently in a thread pool
+
+    :param fn: function to call for every item
+    :param list items: the items
+    :param int threads: max. no. of threads (default: no. of CPUs + 4,
+                        but at most 32)
+    :returns: list of results, in the same order as the items
+    :rtype: list
+
+    """
+    if not items:
+        return []
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(threads or min(cpu_count() + 4, 32), len(items)))
+    try:
+        return pool.map(fn, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _version_spec(specs):
+    """Returns the version specifier string for a list of (operator,
+    version) tuples or None if there are no specs"""
+    if not specs:
+        return None
+    specs = sorted(specs, reverse=True)  # `reverse` makes '>' prior to '<'
+    return ','.join([''.join(sp) for sp in specs])
+
+
+def _unwrap(pkg):
+    """Returns the object wrapped by `pkg` if it's a Package"""
+    return pkg._obj if isinstance(pkg, Package) else pkg
+
+
 class Package(object):
     """Abstract class for wrappers around objects that pip returns.
 
@@ -84,6 +362,8 @@ class Package(object):
 
     """
 
+    __slots__ = ('_obj', 'project_name', 'key')
+
     def __init__(self, obj):
         self._obj = obj
         self.project_name = obj.project_name
@@ -103,10 +383,12 @@ class Package(object):
 
     @staticmethod
     def frozen_repr(obj):
-        fr = frozen_req_from_dist(obj)
-        return str(fr).strip()
+        return frozen_repr(obj)
 
     def __getattr__(self, key):
+        if key == '_obj':
+            # not initialized yet, don't recurse
+            raise AttributeError(key)
         return getattr(self._obj, key)
 
     def __repr__(self):
@@ -122,6 +404,8 @@ class DistPackage(Package):
                   tree in reverse
     """
 
+    __slots__ = ('version_spec', 'req')
+
     def __init__(self, obj, req=None):
         super(DistPackage, self).__init__(obj)
         self.version_spec = None
@@ -179,24 +463,38 @@ class ReqPackage(Package):
       :param obj: The `Requirements` instance to wrap over
       :param dist: optional `pkg_resources.Distribution` instance for
                    this requirement
+      :param resolver: optional VersionResolver to find the installed
+                       version if `dist` is not known
+      :param version_spec: optional version specifier string of the
+                           requirement, if already known (it's
+                           computed from `obj.specs` otherwise)
     """
 
+    __slots__ = ('dist', 'resolver', 'version_spec', '_installed_version')
+
     UNKNOWN_VERSION = '?'
 
-    def __init__(self, obj, dist=None):
+    def __init__(self, obj, dist=None, resolver=None, version_spec=None):
         super(ReqPackage, self).__init__(obj)
         self.dist = dist
+        self.resolver = resolver
+        self._installed_version = None
+        self.version_spec = version_spec or _version_spec(obj.specs)
 
     @property
-    def version_spec(self):
-        specs = sorted(self._obj.specs, reverse=True)  # `reverse` makes '>' prior to '<'
-        return ','.join([''.join(sp) for sp in specs]) if specs else None
+    def specifier(self):
+        return parse_specifier(self.version_spec)
 
     @property
     def installed_version(self):
-        if not self.dist:
-            return guess_version(self.key, self.UNKNOWN_VERSION)
-        return self.dist.version
+        if self._installed_version is None:
+            if self.dist:
+                self._installed_version = self.dist.version
+            else:
+                resolver = self.resolver or VersionResolver()
+                self._installed_version = resolver.resolve(
+                    self.key, self.UNKNOWN_VERSION)
+        return self._installed_version
 
     @property
     def is_missing(self):
@@ -207,16 +505,13 @@ class ReqPackage(Package):
         # unknown installed version is also considered conflicting
         if self.installed_version == self.UNKNOWN_VERSION:
             return True
-        ver_spec = (self.version_spec if self.version_spec else '')
-        req_version_str = '{0}{1}'.format(self.project_name, ver_spec)
-        req_obj = pkg_resources.Requirement.parse(req_version_str)
-        return self.installed_version not in req_obj
+        return not version_satisfies(self.installed_version, self.version_spec)
 
     def render_as_root(self, frozen):
         if not frozen:
             return '{0}=={1}'.format(self.project_name, self.installed_version)
         elif self.dist:
-            return self.__class__.frozen_repr(self.dist._obj)
+            return self.__class__.frozen_repr(_unwrap(self.dist))
         else:
             return self.project_name
 
@@ -236,12 +531,419 @@ class ReqPackage(Package):
                 'required_version': self.version_spec}
 
 
+class CompactGraph(object):
+    """Compact representation of the nodes and edges of a package graph
+
+    The nodes are interned as integer ids. The first `size` ids are the
+    nodes of the graph ie. the keys of the PackageDAG mapping (in
+    order), the remaining ones are only referred to as children
+    (missing dependencies). For every id, `keys` holds the package
+    key, `dists` the distribution (None if missing) and `objs` the
+    object wrapped by the node (refer `PackageDAG`).
+
+    The edges are stored in CSR form ie. the edges of the node `i` are
+    `offsets[i]` to `offsets[i + 1]` (exclusive) and for every edge,
+    `targets` holds the id of the child node, `reqs` the requirement
+    object and `specs` the index of the version specifier string in
+    `spec_table`.
+
+    Instances must not be modified once built, which allows sharing the
+    arrays between graphs.
+
+    """
+
+    __slots__ = ('keys', 'ids', 'dists', 'objs', 'size', 'offsets',
+                 'targets', 'reqs', 'specs', 'spec_table')
+
+    def __init__(self):
+        self.keys = []
+        self.ids = {}
+        self.dists = []
+        self.objs = []
+        self.size = 0
+        self.offsets = array('i', [0])
+        self.targets = array('i')
+        self.reqs = []
+        self.specs = array('i')
+        self.spec_table = [None]
+
+    def _add(self, key, dist, obj):
+        self.ids[key] = len(self.keys)
+        self.keys.append(key)
+        self.dists.append(dist)
+        self.objs.append(obj)
+        return self.ids[key]
+
+    @classmethod
+    def build(cls, nodes):
+        """Build the graph from an iterable of nodes
+
+        If there are multiple nodes with the same key, only the first
+        one is considered.
+
+        :param nodes: iterable of (key, dist, obj, edges) tuples where
+                      edges is an iterable of (key, dist, req,
+                      version_spec) tuples of the children
+        :returns: CompactGraph instance
+
+        """
+        g = cls()
+        unique = []
+        for node in nodes:
+            if node[0] not in g.ids:
+                g._add(*node[:3])
+                unique.append(node)
+        g.size = len(g.keys)
+        spec_ids = {None: 0}
+        for _, _, _, edges in unique:
+            for key, dist, req, spec in edges:
+                t = g.ids.get(key)
+                if t is None:
+                    t = g._add(key, dist, None)
+                s = spec_ids.get(spec)
+                if s is None:
+                    s = spec_ids[spec] = len(g.spec_table)
+                    g.spec_table.append(spec)
+                g.targets.append(t)
+                g.reqs.append(req)
+                g.specs.append(s)
+            g.offsets.append(len(g.targets))
+        return g
+
+    def update(self, nodes, removed=()):
+        """Build a graph with some of the nodes replaced, added or
+        removed
+
+        The edges of the other nodes are copied from this graph in
+        slices (translating the ids of the children if needed) instead
+        of one by one, so it's a lot cheaper than `build` when only a
+        few nodes change.
+
+        :param nodes: iterable of (key, dist, obj, edges) tuples as in
+                      `build`, replacing the nodes with the same keys
+                      or added after the other ones
+        :param set removed: keys of the nodes to remove (they are kept
+                            as children only, without a distribution,
+                            if still referred to)
+        :returns: CompactGraph instance
+
+        """
+        nodes = OrderedDict((node[0], node) for node in nodes)
+        n = len(self.keys)
+        removed_ids = set(i for i in (self.ids.get(k) for k in removed)
+                          if i is not None and i < self.size)
+        changed_ids = set(i for i in (self.ids.get(k) for k in nodes)
+                          if i is not None and i < self.size)
+        added = [k for k in nodes if self.ids.get(k, n) >= self.size]
+        order = [i for i in range(self.size) if i not in removed_ids]
+        others = [i for i in range(self.size, n)
+                  if self.keys[i] not in nodes]
+        others.extend(sorted(removed_ids))
+
+        new_ids = array('i', [-1]) * n
+        old_ids = order + [self.ids.get(k, -1) for k in added] + others
+        for new, i in enumerate(old_ids):
+            if i >= 0:
+                new_ids[i] = new
+        g = self.__class__()
+        g.keys = ([self.keys[i] for i in order] + added +
+                  [self.keys[i] for i in others])
+        g.ids = dict(zip(g.keys, range(len(g.keys))))
+        g.size = len(order) + len(added)
+        g.dists = ([self.dists[i] for i in order] +
+                   [nodes[k][1] for k in added] +
+                   [None if self.keys[i] in removed else self.dists[i]
+                    for i in others])
+        g.objs = ([self.objs[i] for i in order] +
+                  [nodes[k][2] for k in added] + [None] * len(others))
+        for i in changed_ids:
+            _, g.dists[new_ids[i]], g.objs[new_ids[i]], _ = \
+                nodes[self.keys[i]]
+        g.spec_table = list(self.spec_table)
+        spec_ids = dict((s, k) for k, s in enumerate(g.spec_table))
+        remap = new_ids != array('i', range(n))
+
+        def copy(a, b):
+            # the edges of the nodes `a` to `b` (exclusive) at once
+            lo, hi = self.offsets[a], self.offsets[b]
+            shift = len(g.targets) - lo
+            targets = self.targets[lo:hi]
+            g.targets.extend(array('i', [new_ids[t] for t in targets])
+                             if remap else targets)
+            g.reqs.extend(self.reqs[lo:hi])
+            g.specs.extend(self.specs[lo:hi])
+            offsets = self.offsets[a + 1:b + 1]
+            g.offsets.extend(array('i', [o + shift for o in offsets])
+                             if shift else offsets)
+
+        def add(edges):
+            for key, dist, req, spec in edges:
+                t = g.ids.get(key)
+                if t is None:
+                    t = g._add(key, dist, None)
+                s = spec_ids.get(spec)
+                if s is None:
+                    s = spec_ids[spec] = len(g.spec_table)
+                    g.spec_table.append(spec)
+                g.targets.append(t)
+                g.reqs.append(req)
+                g.specs.append(s)
+            g.offsets.append(len(g.targets))
+
+        start = 0
+        for i in sorted(changed_ids | removed_ids) + [self.size]:
+            if start < i:
+                copy(start, i)
+            if i in changed_ids:
+                add(nodes[self.keys[i]][3])
+            start = i + 1
+        for key in added:
+            add(nodes[key][3])
+
+        # drop the children only ids that are no longer referred to
+        referred = set(g.targets)
+        keep = [i for i in range(len(g.keys)) if i < g.size or i in referred]
+        if len(keep) < len(g.keys):
+            new_ids = array('i', [-1]) * len(g.keys)
+            for new, i in enumerate(keep):
+                new_ids[i] = new
+            g.keys = [g.keys[i] for i in keep]
+            g.ids = dict(zip(g.keys, range(len(g.keys))))
+            g.dists = [g.dists[i] for i in keep]
+            g.objs = [g.objs[i] for i in keep]
+            g.targets = array('i', [new_ids[t] for t in g.targets])
+        return g
+
+    def edges(self, i):
+        """Returns the range of (indices of) edges of the node `i`"""
+        return range(self.offsets[i], self.offsets[i + 1])
+
+    def components(self, roots=None, edges=None):
+        """Find the strongly connected components of the graph
+
+        Uses an iterative version of Tarjan's algorithm, so it runs in
+        O(N+E) and isn't limited by the recursion limit.
+
+        :param roots: ids of the nodes to start from, in which case
+                      only the components of the nodes reachable from
+                      them are found (default: all the nodes)
+        :param edges: function returning the edges of a node to follow
+                      (default: `edges` ie. all of them)
+        :returns: list of components, each being a list of node ids,
+                  in reverse topological order
+        :rtype: list
+
+        """
+        n = len(self.keys)
+        index = array('i', [-1]) * n
+        lowlink = array('i', [0]) * n
+        on_stack = bytearray(n)
+        stack = []
+        components = []
+        counter = 0
+        edges_of = edges or self.edges
+        for root in (range(n) if roots is None else roots):
+            if index[root] >= 0:
+                continue
+            index[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = 1
+            work = [(root, iter(edges_of(root) if root < self.size
+                                else ()))]
+            while work:
+                v, edges = work[-1]
+                for e in edges:
+                    w = self.targets[e]
+                    if index[w] < 0:
+                        index[w] = lowlink[w] = counter
+                        counter += 1
+                        stack.append(w)
+                        on_stack[w] = 1
+                        work.append((w, iter(edges_of(w) if w < self.size
+                                             else ())))
+                        break
+                    elif on_stack[w]:
+                        lowlink[v] = min(lowlink[v], index[w])
+                else:
+                    work.pop()
+                    if work:
+                        u = work[-1][0]
+                        lowlink[u] = min(lowlink[u], lowlink[v])
+                    if lowlink[v] == index[v]:
+                        component = []
+                        while True:
+                            w = stack.pop()
+                            on_stack[w] = 0
+                            component.append(w)
+                            if w == v:
+                                break
+                        components.append(component)
+        return components
+
+    def select(self, order, edges):
+        """Build a graph with a subset of the nodes and edges
+
+        :param list order: ids of the nodes of the new graph, in order
+        :param list edges: for every node in `order`, the list of
+                           edges (indices) to keep
+        :returns: CompactGraph instance
+
+        """
+        g = self.__class__()
+        for i in order:
+            g._add(self.keys[i], self.dists[i], self.objs[i])
+        g.size = len(g.keys)
+        g.spec_table = self.spec_table
+        for es in edges:
+            for e in es:
+                key = self.keys[self.targets[e]]
+                t = g.ids.get(key)
+                if t is None:
+                    t = g._add(key, self.dists[self.targets[e]], None)
+                g.targets.append(t)
+                g.reqs.append(self.reqs[e])
+                g.specs.append(self.specs[e])
+            g.offsets.append(len(g.targets))
+        return g
+
+    def transpose(self, order, objs):
+        """Build the graph with the direction of all the edges reversed
+
+        All the children must be nodes of the transposed graph ie. be
+        included in `order`. The nodes that are not, but have
+        children, are added as ids of children only.
+
+        :param list order: ids of the nodes of the new graph, in order
+        :param list objs: objects to be wrapped by the nodes of the
+                          new graph, by (old) id
+        :returns: CompactGraph instance
+
+        """
+        g = self.__class__()
+        new_ids = array('i', [-1]) * len(self.keys)
+        for i in order:
+            new_ids[i] = g._add(self.keys[i], self.dists[i], objs[i])
+        g.size = len(g.keys)
+        for i in range(self.size):
+            if new_ids[i] < 0 and self.offsets[i] != self.offsets[i + 1]:
+                new_ids[i] = g._add(self.keys[i], self.dists[i], None)
+
+        # counting sort of the edges by their (new) source node, which
+        # keeps the order in which the old source nodes appear
+        offsets = array('i', [0]) * (g.size + 1)
+        for t in self.targets:
+            offsets[new_ids[t] + 1] += 1
+        for i in range(g.size):
+            offsets[i + 1] += offsets[i]
+        n = len(self.targets)
+        positions = offsets[:-1]
+        g.targets = array('i', [0]) * n
+        g.reqs = [None] * n
+        g.specs = array('i', [0]) * n
+        for i in range(self.size):
+            for e in self.edges(i):
+                t = new_ids[self.targets[e]]
+                pos = positions[t]
+                positions[t] = pos + 1
+                g.targets[pos] = new_ids[i]
+                g.reqs[pos] = self.reqs[e]
+                g.specs[pos] = self.specs[e]
+        g.offsets = offsets
+        g.spec_table = self.spec_table
+        return g
+
+
+class ReachabilityIndex(object):
+    """Index to answer whether a package depends on another one,
+    directly or transitively, in constant time
+
+    The strongly connected components of the graph are numbered in
+    reverse topological order, and for every component, the set of
+    components reachable from it is stored as a bitset (python int).
+    As the components reachable from a component come before it in
+    that order, all the sets are computed in a single pass.
+
+    Note that the size of the index is quadratic in the number of
+    components in the worst case.
+
+      :param CompactGraph graph: the graph to index
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        components = graph.components()
+        self.members = components
+        self.component = array('i', [0]) * len(graph.keys)
+        for c, members in enumerate(components):
+            for i in members:
+                self.component[i] = c
+        self.reach = []
+        for c, members in enumerate(components):
+            reach = 0
+            # a package in a cycle depends on itself
+            cyclic = len(members) > 1
+            for i in members:
+                if i >= graph.size:
+                    continue
+                for e in graph.edges(i):
+                    d = self.component[graph.targets[e]]
+                    if d == c:
+                        cyclic = True
+                    else:
+                        reach |= self.reach[d] | (1 << d)
+            if cyclic:
+                reach |= 1 << c
+            self.reach.append(reach)
+
+    def depends_on(self, a, b):
+        """Whether the package `a` depends on `b` directly or
+        transitively
+
+        :param str a: key of the package
+        :param str b: key of the dependency
+        :rtype: bool
+
+        """
+        i, j = self.graph.ids.get(a), self.graph.ids.get(b)
+        if i is None or j is None:
+            return False
+        return bool(self.reach[self.component[i]] >> self.component[j] & 1)
+
+    def transitive_deps(self, a):
+        """Return the keys of all the packages that `a` depends on
+        directly or transitively (including `a` itself only if it's
+        part of a cycle)
+
+        :param str a: key of the package
+        :rtype: set
+
+        """
+        i = self.graph.ids.get(a)
+        if i is None:
+            return set()
+        keys = set()
+        reach = self.reach[self.component[i]]
+        while reach:
+            low = reach & -reach
+            keys.update(self.graph.keys[k]
+                        for k in self.members[low.bit_length() - 1])
+            reach ^= low
+        return keys
+
+
+# Guards building the lazily computed data of the DAGs (refer
+# `PackageDAG._cached`). It's global rather than per DAG so that the
+# DAGs can still be pickled.
+_cache_lock = threading.RLock()
+
+
 class PackageDAG(Mapping):
     """Representation of Package dependencies as directed acyclic graph
     using a dict (Mapping) as the underlying datastructure.
 
-    The nodes and their relationships (edges) are internally
-    stored using a map as follows,
+    The nodes and their relationships (edges) are represented as a map
+    as follows,
 
     {a: [b, c],
      b: [d],
@@ -260,27 +962,159 @@ class PackageDAG(Mapping):
     ReversedPackageDAG where the key and value types are
     interchanged).
 
+    Internally, the graph is stored as a `CompactGraph` and the
+    `Package` instances are created only when accessed, which keeps
+    the memory footprint low. Note that this means every access
+    returns new instances, hence the nodes are to be identified by
+    their keys.
+
+    A DAG is never modified once built (`filter`, `reverse` and
+    `apply` return new ones), and the data computed on first use
+    (eg. the reversed DAG) is built only once even if several threads
+    ask for it at the same time, so a DAG can be shared by threads.
+
     """
 
     @classmethod
-    def from_pkgs(cls, pkgs):
-        pkgs = [DistPackage(p) for p in pkgs]
-        idx = {p.key: p for p in pkgs}
-        m = {p: [ReqPackage(r, idx.get(r.key))
-                 for r in p.requires()]
-             for p in pkgs}
-        return cls(m)
-
-    def __init__(self, m):
+    def from_pkgs(cls, pkgs, guess_by_import=False, include=None,
+                  exclude=None, max_depth=None, resolver=None):
+        """Construct the DAG from a list of distributions
+
+        If `include` is specified, the DAG is built lazily ie. starting
+        from the included packages, only the distributions reachable
+        from them are added and the requirements (and hence the
+        metadata) of the others are never looked at. This gives the
+        same result as calling `filter` on the complete DAG, but is a
+        lot cheaper when only a few of many packages are of interest.
+
+        :param list pkgs: list of `pkg_resources.Distribution` (or
+                          compatible) instances
+        :param bool guess_by_import: whether to guess the versions of
+                                     missing dependencies by importing
+                                     them (refer `VersionResolver`)
+        :param set include: keys of the packages to start from (or
+                            None for all of them)
+        :param set exclude: keys of the packages whose requirements
+                            are not to be followed (only considered
+                            along with `include`)
+        :param int max_depth: depth up to which to follow the
+                              requirements of the included packages
+                              (only considered along with `include`)
+        :param VersionResolver resolver: resolver for the versions of
+                                         missing dependencies (default:
+                                         one looking at the current
+                                         environment, `guess_by_import`
+                                         is ignored if given)
+        :returns: PackageDAG instance
+
+        """
+        resolver = resolver or VersionResolver(guess_by_import)
+        pkgs = list(pkgs)
+        idx = {}
+        for p in pkgs:
+            idx.setdefault(p.key, p)
+        if include is None:
+            reqs = None
+        else:
+            reqs = cls._reachable_requires(idx, include, exclude, max_depth)
+            pkgs = [p for p in pkgs if p.key in reqs]
+
+        def requires(p):
+            return p.requires() if reqs is None else reqs[p.key]
+
+        nodes = ((p.key, p, p, [(r.key, idx.get(r.key), r,
+                                 _version_spec(r.specs))
+                                for r in requires(p)])
+                 for p in pkgs)
+        return cls(CompactGraph.build(nodes), resolver)
+
+    @staticmethod
+    def _reachable_requires(idx, include, exclude, max_depth=None):
+        """Find the distributions reachable from the included ones
+
+        :param dict idx: index of distributions by key
+        :param set include: keys of the packages to start from
+        :param set exclude: keys of the packages not to follow
+        :param int max_depth: depth up to which to follow the
+                              requirements (or None for no limit)
+        :returns: dict of key -> requirements of the distribution, for
+                  all the reachable distributions (the ones at
+                  `max_depth` have no requirements)
+        :rtype: dict
+
+        """
+        include = set(k.lower() for k in include)
+        exclude = set(k.lower() for k in exclude or [])
+        depth = dict((k, 0) for k in include
+                     if k in idx and k not in exclude)
+        queue = deque(sorted(depth))
+        reqs = {}
+        while queue:
+            key = queue.popleft()
+            if depth[key] == max_depth:
+                reqs[key] = []
+                continue
+            reqs[key] = idx[key].requires()
+            for r in reqs[key]:
+                if (r.key in idx and r.key not in exclude and
+                        r.key not in depth):
+                    depth[r.key] = depth[key] + 1
+                    queue.append(r.key)
+        return reqs
+
+    def __init__(self, m, resolver=None):
         """Initialize the PackageDAG object
 
-        :param dict m: dict of node objects (refer class docstring)
+        :param m: dict of node objects (refer class docstring) or a
+                  CompactGraph instance
+        :param VersionResolver resolver: resolver shared by the
+                                         ReqPackage nodes of the DAG
         :returns: None
         :rtype: NoneType
 
         """
-        self._obj = m
-        self._index = {p.key: p for p in list(self._obj)}
+        if not isinstance(m, CompactGraph):
+            m = CompactGraph.build(self._decompose(k, vs)
+                                   for k, vs in m.items())
+        self._graph = m
+        self.resolver = resolver or VersionResolver()
+        self._reversed = None
+        self._reachability = None
+        self._conflicts = None
+        self._cycles = None
+
+    def _cached(self, attr, build):
+        """Return the value of the attribute `attr`, setting it to the
+        result of `build()` first if it's None"""
+        value = getattr(self, attr)
+        if value is None:
+            with _cache_lock:
+                value = getattr(self, attr)
+                if value is None:
+                    value = build()
+                    setattr(self, attr, value)
+        return value
+
+    @staticmethod
+    def _decompose(node, children):
+        """Returns the tuple representing a node and it's children in
+        `CompactGraph.build`"""
+        return (node.key, node._obj, node._obj,
+                [(c.key, _unwrap(c.dist), c._obj, c.version_spec)
+                 for c in children])
+
+    def _node(self, i):
+        return DistPackage(self._graph.objs[i])
+
+    def _children(self, i):
+        g = self._graph
+        return [ReqPackage(g.reqs[e], g.dists[g.targets[e]],
+                           self.resolver, g.spec_table[g.specs[e]])
+                for e in g.edges(i)]
+
+    def _id(self, node_key):
+        i = self._graph.ids.get(node_key)
+        return i if i is not None and i < self._graph.size else None
 
     def get_node_as_parent(self, node_key):
         """Get the node from the keys of the dict representing the DAG.
@@ -295,10 +1129,8 @@ class PackageDAG(Mapping):
         :rtype: Object
 
         """
-        try:
-            return self._index[node_key]
-        except KeyError:
-            return None
+        i = self._id(node_key)
+        return None if i is None else self._node(i)
 
     def get_children(self, node_key):
         """Get child nodes for a node by it's key
@@ -308,23 +1140,32 @@ class PackageDAG(Mapping):
         :rtype: ReqPackage[]
 
         """
-        node = self.get_node_as_parent(node_key)
-        return self._obj[node] if node else []
+        i = self._id(node_key)
+        return [] if i is None else self._children(i)
 
-    def filter(self, include, exclude):
+    def filter(self, include, exclude, max_depth=None):
         """Filters nodes in a graph by given parameters
 
         If a node is included, then all it's children are also
         included.
 
+        With `max_depth`, only the nodes up to that depth from the
+        included ones (or the top level ones ie. that aren't children
+        of any other node, if `include` is None) are kept. Packages in
+        cycles that no top level package leads to are then kept too,
+        starting from one of the packages of the cycle. The nodes at
+        that depth are kept without their children.
+
         :param set include: set of node keys to include (or None)
         :param set exclude: set of node keys to exclude (or None)
+        :param int max_depth: depth up to which to include the
+                              children (or None for no limit)
         :returns: filtered version of the graph
         :rtype: PackageDAG
 
         """
         # If neither of the filters are specified, short circuit
-        if include is None and exclude is None:
+        if include is None and exclude is None and max_depth is None:
             return self
 
         # Note: In following comparisons, we use lower cased values so
@@ -344,37 +1185,79 @@ class PackageDAG(Mapping):
         if include and exclude:
             assert not (include & exclude)
 
+        g = self._graph
+
+        def edges(n):
+            return [e for e in g.edges(n)
+                    if g.keys[g.targets[e]] not in exclude]
+
+        if max_depth is not None:
+            return self._filter_depth(include, exclude, max_depth, edges)
+
         # Traverse the graph in a depth first manner and filter the
         # nodes according to `show_only` and `exclude` sets
         stack = deque()
-        m = {}
-        seen = set([])
-        for node in self._obj.keys():
-            if node.key in exclude:
+        m = OrderedDict()
+        for i in range(g.size):
+            if g.keys[i] in exclude:
                 continue
-            if include is None or node.key in include:
-                stack.append(node)
-            while True:
-                if len(stack) > 0:
-                    n = stack.pop()
-                    cldn = [c for c in self._obj[n]
-                            if c.key not in exclude]
-                    m[n] = cldn
-                    seen.add(n.key)
-                    for c in cldn:
-                        if c.key not in seen:
-                            cld_node = self.get_node_as_parent(c.key)
-                            if cld_node:
-                                stack.append(cld_node)
-                            else:
-                                # It means there's no root node
-                                # corresponding to the child node
-                                # ie. a dependency is missing
-                                continue
-                else:
-                    break
+            if include is None or g.keys[i] in include:
+                stack.append(i)
+            while stack:
+                n = stack.pop()
+                m[n] = edges(n)
+                for e in m[n]:
+                    c = g.targets[e]
+                    # children that aren't nodes of the graph ie. the
+                    # missing dependencies have no children to follow
+                    if c < g.size and c not in m:
+                        stack.append(c)
+
+        return self.__class__(g.select(list(m), list(m.values())),
+                              self.resolver)
+
+    def _filter_depth(self, include, exclude, max_depth, edges):
+        # Breadth first, so that every node is reached at it's minimum
+        # depth. The children of the nodes at `max_depth` are never
+        # looked at.
+        g = self._graph
+        if include is None:
+            # The top level packages, along with one package of every
+            # cycle that isn't required by any package outside of it
+            # (which would be lost otherwise)
+            ids = [i for i in range(g.size) if g.keys[i] not in exclude]
+            component_of = {}
+            components = g.components(ids, edges)
+            for n, component in enumerate(components):
+                for i in component:
+                    component_of[i] = n
+            has_parent = bytearray(len(components))
+            for i in ids:
+                for e in edges(i):
+                    n = component_of[g.targets[e]]
+                    if n != component_of[i]:
+                        has_parent[n] = 1
+            roots = sorted(min(c) for n, c in enumerate(components)
+                           if not has_parent[n] and min(c) < g.size)
+        else:
+            roots = [i for i in range(g.size) if g.keys[i] in include]
+        depth = dict((i, 0) for i in roots)
+        queue = deque(roots)
+        m = OrderedDict()
+        while queue:
+            n = queue.popleft()
+            if depth[n] == max_depth:
+                m[n] = []
+                continue
+            m[n] = edges(n)
+            for e in m[n]:
+                c = g.targets[e]
+                if c < g.size and c not in depth:
+                    depth[c] = depth[n] + 1
+                    queue.append(c)
 
-        return self.__class__(m)
+        return self.__class__(g.select(list(m), list(m.values())),
+                              self.resolver)
 
     def reverse(self):
         """Reverse the DAG, or turn it upside-down
@@ -391,60 +1274,350 @@ class PackageDAG(Mapping):
         hand, if filter is called on reversed DAG, then the definition
         of "child" nodes is as per the reversed DAG.
 
+        The reversed DAG is computed only once and cached on this
+        instance.
+
         :returns: DAG in the reversed form
         :rtype: ReversedPackageDAG
 
         """
-        m = defaultdict(list)
-        child_keys = set(r.key for r in flatten(self._obj.values()))
-        for k, vs in self._obj.items():
-            for v in vs:
-                # if v is already added to the dict, then ensure that
-                # we are using the same object. This check is required
-                # as we're using array mutation
-                try:
-                    node = [p for p in m.keys() if p.key == v.key][0]
-                except IndexError:
-                    node = v
-                m[node].append(k.as_parent_of(v))
-            if k.key not in child_keys:
-                m[k.as_requirement()] = []
-        return ReversedPackageDAG(dict(m))
+        return self._cached('_reversed', self._reverse)
+
+    def _reverse(self):
+        g = self._graph
+        # Every package becomes a node of the reversed DAG, in the
+        # order of their first occurrence. A node is represented by
+        # the first requirement referring to it, or the requirement
+        # created from the distribution if there's none.
+        order = []
+        objs = [None] * len(g.keys)
+        seen = bytearray(len(g.keys))
+        for t in g.targets:
+            seen[t] = 2
+        for i in range(g.size):
+            for e in g.edges(i):
+                t = g.targets[e]
+                if seen[t] != 1:
+                    seen[t] = 1
+                    order.append(t)
+                    objs[t] = g.reqs[e]
+            if not seen[i]:
+                order.append(i)
+        return ReversedPackageDAG(g.transpose(order, objs), self.resolver)
+
+    def get_parents(self, node_key):
+        """Get parent nodes for a node by it's key
+
+        Uses the (cached) reversed DAG, so only the first call costs
+        time proportional to the size of the graph.
+
+        :param str node_key: key of the node to get parents of
+        :returns: list of parent nodes
+        :rtype: list
+
+        """
+        return self.reverse().get_children(node_key)
+
+    def reachability(self):
+        """Return the index to answer reachability queries (refer
+        `ReachabilityIndex`)
+
+        The index is built on first use and cached on this instance.
+
+        :rtype: ReachabilityIndex
+
+        """
+        return self._cached('_reachability',
+                            lambda: ReachabilityIndex(self._graph))
+
+    def depends_on(self, node_key, dep_key):
+        """Whether a package depends on another one directly or
+        transitively (in a reversed DAG, whether the package is a
+        dependency of the other one)
+
+        :param str node_key: key of the package
+        :param str dep_key: key of the dependency
+        :rtype: bool
+
+        """
+        return self.reachability().depends_on(node_key, dep_key)
+
+    def transitive_deps(self, node_key):
+        """Return the keys of all the packages that a package depends
+        on directly or transitively (in a reversed DAG, the packages
+        that depend on it)
+
+        :param str node_key: key of the package
+        :rtype: set
+
+        """
+        return self.reachability().transitive_deps(node_key)
+
+    def conflicts(self):
+        """Return the dependencies that are missing or conflict with the
+        requirements, in the same form as `conflicting_deps`
+
+        The packages with conflicts are found on first use and cached
+        on this instance (and carried over by `apply`).
+
+        :returns: dict of DistPackage -> list of unsatisfied/unknown
+                  ReqPackage
+        :rtype: collections.OrderedDict
+
+        """
+        found = self._cached('_conflicts', lambda: self._find_conflicts(
+            range(self._graph.size)))
+        g = self._graph
+        conflicts = OrderedDict()
+        for key in sorted(found, key=g.ids.get):
+            i = g.ids[key]
+            children = self._children(i)
+            conflicts[self._node(i)] = [children[n] for n in found[key]]
+        return conflicts
+
+    def _find_conflicts(self, ids):
+        # positions of the conflicting requirements of the nodes, by key
+        conflicts = {}
+        for i in ids:
+            positions = [n for n, c in enumerate(self._children(i))
+                         if c.is_conflicting()]
+            if positions:
+                conflicts[self._graph.keys[i]] = positions
+        return conflicts
+
+    def cycles(self):
+        """Return the packages that are part of cycles
+
+        Every strongly connected component with more than one package
+        (or a package requiring itself) is a set of packages that
+        depend on each other. Refer `cyclic_deps` for the actual
+        chains of requirements.
+
+        The components are found on first use and cached on this
+        instance (and carried over by `apply`).
+
+        :returns: list of sets of keys
+        :rtype: list
+
+        """
+        return list(self._cached('_cycles', lambda: self._cyclic_components(
+            self._graph.components())))
+
+    def _cyclic_components(self, components):
+        g = self._graph
+        return [frozenset(g.keys[i] for i in c) for c in components
+                if len(c) > 1 or (c[0] < g.size and
+                                  any(g.targets[e] == c[0]
+                                      for e in g.edges(c[0])))]
+
+    def apply(self, added=None, removed=None, upgraded=None):
+        """Return a new DAG with the given changes to the installed
+        distributions, leaving this one as is
+
+        Only the requirements of the added and upgraded distributions
+        are read, the parsed requirements of the other packages are
+        reused as is. If `conflicts` or `cycles` were already computed
+        on this instance, they are carried over to the new DAG by only
+        checking the packages affected by the changes again: the
+        changed packages and the ones requiring them for conflicts,
+        and the packages reachable from the changed ones for cycles.
+        So the steps of an install plan can be checked one by one
+        without starting from scratch every time.
+
+        Note that building the new graph is still linear in the size of
+        the graph: the edges of the unchanged packages are copied over
+        in slices (refer `CompactGraph.update`) and, unless the reversed
+        DAG of this instance is already built, the packages requiring
+        the changed ones are found by going through all the edges. It's
+        the parsing of requirements and the checks for conflicts and
+        cycles that are limited to the packages affected by the
+        changes. The reversed DAG and the reachability index of the new
+        DAG are built again on first use.
+
+        :param list added: distributions to add (a distribution with
+                           the same key as an installed one replaces
+                           it)
+        :param list removed: keys of the packages to remove
+        :param list upgraded: distributions replacing the installed
+                              ones with the same keys
+        :returns: PackageDAG instance
+
+        """
+        g = self._graph
+        removed = set(k.lower() for k in removed or [])
+        changed = OrderedDict()
+        for dist in chain(upgraded or [], added or []):
+            changed[dist.key] = dist
+        touched = removed.union(changed)
+
+        def dist_of(key):
+            if key in touched:
+                return changed.get(key)
+            i = g.ids.get(key)
+            return None if i is None else g.dists[i]
+
+        nodes = [(dist.key, dist, dist,
+                  [(r.key, dist_of(r.key), r, _version_spec(r.specs))
+                   for r in dist.requires()])
+                 for dist in changed.values()]
+        # The removed packages are not to be looked up in the current
+        # environment, where they are still installed
+        versions = dict((key, None) for key in removed)
+        versions.update((key, dist.version) for key, dist in changed.items())
+        dag = self.__class__(g.update(nodes, removed.difference(changed)),
+                             self.resolver.override(versions))
+        ng = dag._graph
+
+        if self._conflicts is not None:
+            # the packages requiring the changed ones
+            parents = self._parents_of(touched)
+            conflicts = dict((k, v) for k, v in self._conflicts.items()
+                             if k not in touched and k not in parents)
+            conflicts.update(dag._find_conflicts(
+                i for i in map(dag._id, parents.union(changed))
+                if i is not None))
+            dag._conflicts = conflicts
+
+        if self._cycles is not None:
+            stale = set(chain.from_iterable(c for c in self._cycles
+                                            if not c.isdisjoint(touched)))
+            components = ng.components(dag._id(k)
+                                       for k in stale.union(changed)
+                                       if dag._id(k) is not None)
+            visited = set(ng.keys[i] for c in components for i in c)
+            dag._cycles = [c for c in self._cycles
+                           if c.isdisjoint(touched) and c.isdisjoint(visited)]
+            dag._cycles.extend(dag._cyclic_components(components))
+
+        return dag
+
+    def _parents_of(self, keys):
+        """Return the keys of the packages requiring any of the given
+        ones, using the reversed DAG if it's already built"""
+        if self._reversed is not None:
+            rg = self._reversed._graph
+            ids = (rg.ids.get(k) for k in keys)
+            return set(rg.keys[rg.targets[e]] for i in ids
+                       if i is not None and i < rg.size
+                       for e in rg.edges(i))
+        g = self._graph
+        ids = set(g.ids[k] for k in keys if k in g.ids)
+        return set(g.keys[bisect_right(g.offsets, e) - 1]
+                   for e, t in enumerate(g.targets) if t in ids)
+
+    def paths_to(self, node_key, max_paths=None):
+        """Find out why a package is installed ie. the chains of
+        dependencies leading to it from the top level packages
+
+        For every top level package (ie. one that no other package
+        depends on) that depends on the package directly or
+        transitively, the shortest path is returned. The paths are
+        found by a breadth first search over the reversed DAG, so
+        it's linear in the size of the graph irrespective of the
+        number of possible paths.
+
+        :param str node_key: key of the package
+        :param int max_paths: maximum no. of paths to find (the
+                              shortest ones are found first), or None
+                              for no limit
+        :returns: list of paths, each being a tuple with the
+                  DistPackage of the top level package followed by the
+                  ReqPackage instances along the path, the last of
+                  which refers to the package
+        :rtype: list
+
+        """
+        rtree = self.reverse()
+        rg = rtree._graph
+        start = rtree._id(node_key)
+        if start is None:
+            return []
+        # node id -> (id, edge) of the next node on the way to `start`
+        nexts = {start: None}
+        queue = deque([start])
+        paths = []
+        while queue:
+            i = queue.popleft()
+            edges = rg.edges(i)
+            if not edges and rg.dists[i] is not None:
+                if max_paths is not None and len(paths) >= max_paths:
+                    break
+                paths.append(self._path(rg, i, nexts))
+            for e in edges:
+                parent = rg.targets[e]
+                if parent not in nexts:
+                    nexts[parent] = (i, e)
+                    queue.append(parent)
+        return paths
+
+    def _path(self, rg, i, nexts):
+        path = [DistPackage(rg.dists[i])]
+        while nexts[i] is not None:
+            i, e = nexts[i]
+            path.append(ReqPackage(rg.reqs[e], rg.dists[i], self.resolver,
+                                   rg.spec_table[rg.specs[e]]))
+        return tuple(path)
 
     def sort(self):
-        """Return sorted tree in which the underlying _obj dict is an
-        OrderedDict, sorted alphabetically by the keys
+        """Return sorted tree in which the nodes as well as their
+        children are sorted alphabetically by the keys
 
-        :returns: Instance of same class with OrderedDict
+        :returns: Instance of same class
 
         """
-        return self.__class__(sorted_tree(self._obj))
+        g = self._graph
+        order = sorted(range(g.size), key=g.keys.__getitem__)
+        edges = [sorted(g.edges(i), key=lambda e: g.keys[g.targets[e]])
+                 for i in order]
+        return self.__class__(g.select(order, edges), self.resolver)
 
     # Methods required by the abstract base class Mapping
-    def __getitem__(self, *args):
-        return self._obj.get(*args)
+    def __getitem__(self, node):
+        i = self._id(node.key)
+        return None if i is None else self._children(i)
 
     def __iter__(self):
-        return self._obj.__iter__()
+        return (self._node(i) for i in range(self._graph.size))
 
     def __len__(self):
-        return len(self._obj)
+        return self._graph.size
 
 
 class ReversedPackageDAG(PackageDAG):
     """Representation of Package dependencies in the reverse
     order.
 
-    Similar to it's super class `PackageDAG`, the underlying
-    datastructure is a dict, but here the keys are expected to be of
-    type `ReqPackage` and each item in the values of type
-    `DistPackage`.
+    Similar to it's super class `PackageDAG`, the nodes and their
+    relationships are represented as a map, but here the keys are
+    expected to be of type `ReqPackage` and each item in the values
+    of type `DistPackage`.
 
     Typically, this object will be obtained by calling
     `PackageDAG.reverse`.
 
     """
 
+    @staticmethod
+    def _decompose(node, children):
+        return (node.key, _unwrap(node.dist), node._obj,
+                [(c.key, c._obj, c.req and c.req._obj,
+                  c.req and c.req.version_spec)
+                 for c in children])
+
+    def _node(self, i):
+        g = self._graph
+        if g.objs[i] is None:
+            return DistPackage(g.dists[i]).as_requirement()
+        return ReqPackage(g.objs[i], g.dists[i], self.resolver)
+
+    def _children(self, i):
+        g = self._graph
+        dist = g.dists[i]
+        return [DistPackage(g.dists[g.targets[e]],
+                            ReqPackage(g.reqs[e], dist, self.resolver,
+                                       g.spec_table[g.specs[e]]))
+                for e in g.edges(i)]
+
     def reverse(self):
         """Reverse the already reversed DAG to get the PackageDAG again
 
@@ -452,177 +1625,1460 @@ class ReversedPackageDAG(PackageDAG):
         :rtype: PackageDAG
 
         """
-        m = defaultdict(list)
-        child_keys = set(r.key for r in flatten(self._obj.values()))
-        for k, vs in self._obj.items():
-            for v in vs:
-                try:
-                    node = [p for p in m.keys() if p.key == v.key][0]
-                except IndexError:
-                    node = v.as_parent_of(None)
-                m[node].append(k)
-            if k.key not in child_keys:
-                m[k.dist] = []
-        return PackageDAG(dict(m))
+        return self._cached('_reversed', self._reverse)
+
+    def _reverse(self):
+        g = self._graph
+        # The parents become the nodes of the DAG in the order of their
+        # first occurrence, along with the installed packages without
+        # any dependencies
+        order = []
+        seen = bytearray(len(g.keys))
+        for t in g.targets:
+            seen[t] = 2
+        for i in range(g.size):
+            for t in g.targets[g.offsets[i]:g.offsets[i + 1]]:
+                if seen[t] != 1:
+                    seen[t] = 1
+                    order.append(t)
+            if not seen[i] and g.dists[i] is not None:
+                order.append(i)
+        return PackageDAG(g.transpose(order, g.dists), self.resolver)
+
+    def apply(self, added=None, removed=None, upgraded=None):
+        raise TypeError('Changes can only be applied to the PackageDAG '
+                        'ie. before reversing it')
+
+
+# Names of ancient stdlib packages that pip skips when listing the
+# installed distributions. The other discovery backends skip them too
+# so that all of them agree on the output.
+STDLIB_PKGS = ('python', 'wsgiref', 'argparse')
+
+
+def _safe_name(name):
+    """Convert an arbitrary string to a standard distribution name
+
+    Same as `pkg_resources.safe_name` which is not used here to avoid
+    importing `pkg_resources`.
+
+    :param str name: name of the distribution
+    :returns: normalized name
+    :rtype: str
 
+    """
+    return re.sub('[^A-Za-z0-9.]+', '-', name)
 
-def render_text(tree, list_all=True, frozen=False):
-    """Print tree as text on console
 
-    :param dict tree: the package tree
-    :param bool list_all: whether to list all the pgks at the root
-                          level or only those that are the
-                          sub-dependencies
-    :param bool frozen: whether or not show the names of the pkgs in
-                        the output that's favourable to pip --freeze
-    :returns: None
+def _search_paths(local_only=False, user_only=False):
+    """Return the sys.path entries to look for installed distributions
 
-    """
-    tree = tree.sort()
-    nodes = tree.keys()
-    branch_keys = set(r.key for r in flatten(tree.values()))
-    use_bullets = not frozen
+    :param bool local_only: if in a virtualenv, only return the paths
+                            local to it
+    :param bool user_only: only return the user site dir
+    :returns: list of directories
+    :rtype: list
 
-    if not list_all:
-        nodes = [p for p in nodes if p.key not in branch_keys]
+    """
+    if user_only:
+        paths = [site.USER_SITE] if site.ENABLE_USER_SITE else []
+    else:
+        paths = [os.path.abspath(p or os.curdir) for p in sys.path]
+        in_venv = (hasattr(sys, 'real_prefix') or
+                   sys.prefix != getattr(sys, 'base_prefix', sys.prefix))
+        if local_only and in_venv:
+            prefix = os.path.normcase(os.path.abspath(sys.prefix))
+            paths = [p for p in paths
+                     if os.path.normcase(p).startswith(prefix)]
+    return [p for p in paths if p and os.path.isdir(p)]
 
-    def aux(node, parent=None, indent=0, chain=None):
-        chain = chain or []
-        node_str = node.render(parent, frozen)
-        if parent:
-            prefix = ' '*indent + ('- ' if use_bullets else '')
-            node_str = prefix + node_str
-        result = [node_str]
-        children = [aux(c, node, indent=indent+2,
-                        chain=chain+[c.project_name])
-                    for c in tree.get_children(node.key)
-                    if c.project_name not in chain]
-        result += list(flatten(children))
-        return result
 
-    lines = flatten([aux(p) for p in nodes])
-    print('\n'.join(lines))
+def _fill_name_version(filename, name, version):
+    """Fallback to the name and version in a filename of the form
+    {name}-{version}[-...].{ext} (eg. a .dist-info directory or a
+    wheel) if they are missing in the metadata"""
+    if not name or not version:
+        parts = os.path.splitext(filename)[0].split('-')
+        name = name or parts[0]
+        version = version or (parts[1] if len(parts) > 1 else '?')
+    return name, version
 
 
-def render_json(tree, indent):
-    """Converts the tree into a flat json representation.
+def parse_metadata(lines):
+    """Parse the fields of interest from METADATA/PKG-INFO contents
 
-    The json repr will be a list of hashes, each hash having 2 fields:
-      - package
-      - dependencies: list of dependencies
+    Only the headers are looked at, ie. the long description in the
+    body is never read.
 
-    :param dict tree: dependency tree
-    :param int indent: no. of spaces to indent json
-    :returns: json representation of the tree
-    :rtype: str
+    :param lines: iterable of lines of the metadata file
+    :returns: tuple of name, version and list of `Requires-Dist` strings
+    :rtype: tuple
 
     """
-    return json.dumps([{'package': k.as_dict(),
-                        'dependencies': [v.as_dict() for v in vs]}
-                       for k, vs in tree.items()],
-                      indent=indent)
+    name, version, requires = None, None, []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line:
+            # End of the headers
+            break
+        if line[0] in ' \t':
+            # Continuation line of a multi-line header
+            continue
+        field, _, value = line.partition(':')
+        field = field.lower()
+        if field == 'name':
+            name = value.strip()
+        elif field == 'version':
+            version = value.strip()
+        elif field == 'requires-dist':
+            requires.append(value.strip())
+    return name, version, requires
+
+
+def parse_requires_txt(lines):
+    """Convert the contents of an egg-info `requires.txt` file to
+    `Requires-Dist` strings
+
+    Requirements listed under an `[extra]` section are ignored as
+    extras are not installed by default. Sections of the form
+    `[:marker]` are turned into environment markers.
+
+    :param lines: iterable of lines of the requires.txt file
+    :returns: list of requirement strings
+    :rtype: list
 
+    """
+    requires = []
+    section = None
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('['):
+            section = line.strip('[]')
+            continue
+        if section:
+            extra, _, marker = section.partition(':')
+            if extra:
+                continue
+            line = '{0}; {1}'.format(line, marker)
+        requires.append(line)
+    return requires
 
-def render_json_tree(tree, indent):
-    """Converts the tree into a nested json representation.
 
-    The json repr will be a list of hashes, each hash having the following fields:
-      - package_name
-      - key
-      - required_version
-      - installed_version
-      - dependencies: list of dependencies
+class MetadataRequirement(object):
+    """Lightweight stand-in for `pkg_resources.Requirement`
 
-    :param dict tree: dependency tree
-    :param int indent: no. of spaces to indent json
-    :returns: json representation of the tree
-    :rtype: str
+    Only the subset of the interface that pipdeptree relies on is
+    implemented.
 
+      :param str name: name of the required distribution
+      :param list specs: list of (operator, version) tuples
     """
-    tree = tree.sort()
-    branch_keys = set(r.key for r in flatten(tree.values()))
-    nodes = [p for p in tree.keys() if p.key not in branch_keys]
 
-    def aux(node, parent=None, chain=None):
-        if chain is None:
-            chain = [node.project_name]
+    def __init__(self, name, specs):
+        self.project_name = _safe_name(name)
+        self.key = self.project_name.lower()
+        self.specs = specs
 
-        d = node.as_dict()
-        if parent:
-            d['required_version'] = node.version_spec if node.version_spec else 'Any'
-        else:
-            d['required_version'] = d['installed_version']
+    # Matches the common forms of `Requires-Dist` values such as
+    # `foo[bar] (>=1.0,<2) ; python_version < "3"`. Anything else is
+    # handed over to the (much slower) `packaging` parser.
+    _REQ_RE = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[[^\]]*\])?'
+                         r'\s*\(?([^;()@]*?)\)?\s*(?:;\s*(.*?))?\s*$')
+    _SPEC_RE = re.compile(r'^\s*(~=|===|==|!=|<=|>=|<|>)\s*(\S+?)\s*$')
 
-        d['dependencies'] = [
-            aux(c, parent=node, chain=chain+[c.project_name])
-            for c in tree.get_children(node.key)
-            if c.project_name not in chain
-        ]
+    # Evaluated environment markers, keyed by the marker string
+    _markers = {}
 
-        return d
+    @classmethod
+    def parse(cls, s):
+        """Parse a `Requires-Dist` string
 
-    return json.dumps([aux(p) for p in nodes], indent=indent)
+        :param str s: requirement string, optionally with a marker
+        :returns: requirement or None if the marker doesn't match the
+                  current environment
+        :rtype: MetadataRequirement
 
+        """
+        m = cls._REQ_RE.match(s)
+        specs = []
+        if m:
+            name, spec_str, marker = m.groups()
+            for spec in filter(None, spec_str.split(',')):
+                sm = cls._SPEC_RE.match(spec)
+                if sm is None:
+                    m = None
+                    break
+                specs.append(sm.groups())
+        if m is None:
+            from pip._vendor.packaging.requirements import Requirement
+            req = Requirement(s)
+            name = req.name
+            specs = [(sp.operator, sp.version) for sp in req.specifier]
+            marker = str(req.marker) if req.marker is not None else None
+        if marker and not cls.evaluate_marker(marker):
+            return None
+        return cls(name, specs)
 
-def dump_graphviz(tree, output_format='dot', is_reverse=False):
-    """Output dependency graph as one of the supported GraphViz output formats.
+    @classmethod
+    def evaluate_marker(cls, marker):
+        """Evaluate an environment marker ignoring all extras
+
+        :param str marker: the marker
+        :returns: whether the marker matches the current environment
+        :rtype: bool
+
+        """
+        try:
+            return cls._markers[marker]
+        except KeyError:
+            from pip._vendor.packaging.markers import Marker
+            result = Marker(marker).evaluate({'extra': ''})
+            cls._markers[marker] = result
+            return result
+
+    def __str__(self):
+        return '{0}{1}'.format(self.project_name,
+                               ','.join(''.join(sp) for sp in self.specs))
 
-    :param dict tree: dependency graph
-    :param string output_format: output format
-    :returns: representation of tree in the specified output format
-    :rtype: str or binary representation depending on the output format
 
+class MetadataDistribution(object):
+    """Lightweight stand-in for `pkg_resources.Distribution`
+
+    Instances are built by the `scan` and `importlib` discovery
+    backends from the raw metadata fields. The requirement strings are
+    parsed only when `requires` is called.
+
+      :param str name: name of the distribution
+      :param str version: installed version
+      :param list requires_dist: list of `Requires-Dist` strings
+      :param str location: the sys.path entry the distribution was
+                           found in
+      :param str path: path to the .dist-info/.egg-info metadata
     """
-    try:
-        from graphviz import backend, Digraph
-    except ImportError:
-        print('graphviz is not available, but necessary for the output '
-              'option. Please install it.', file=sys.stderr)
-        sys.exit(1)
 
-    if output_format not in backend.FORMATS:
-        print('{0} is not a supported output format.'.format(output_format),
-              file=sys.stderr)
-        print('Supported formats are: {0}'.format(
-            ', '.join(sorted(backend.FORMATS))), file=sys.stderr)
-        sys.exit(1)
+    def __init__(self, name, version, requires_dist, location=None,
+                 path=None):
+        self.project_name = _safe_name(name)
+        self.key = self.project_name.lower()
+        self.version = version
+        self.requires_dist = list(requires_dist)
+        self.location = location
+        self.path = path
+        self._requires = None
+
+    def requires(self):
+        if self._requires is None:
+            reqs = (MetadataRequirement.parse(s) for s in self.requires_dist)
+            self._requires = [r for r in reqs if r is not None]
+        return list(self._requires)
 
-    graph = Digraph(format=output_format)
+    def as_requirement(self):
+        return MetadataRequirement(self.project_name,
+                                   [('==', self.version)])
 
-    if not is_reverse:
-        for pkg, deps in tree.items():
+    def is_on_disk(self):
+        """Whether the metadata was read from the filesystem (as
+        opposed to eg. from a wheel or a tarball)"""
+        return self.path is None or os.path.exists(self.path)
+
+    def direct_url_repr(self):
+        """Return the line for the distribution in the output of `pip
+        freeze` as per it's direct_url.json (refer PEP 610), which
+        tells whether it was installed from a url, a VCS or in editable
+        mode
+
+        :returns: the frozen representation or `name==version` if it
+                  was installed from an index
+        :rtype: str
+
+        """
+        data = None
+        if self.path is not None:
+            try:
+                with io.open(os.path.join(self.path, 'direct_url.json'),
+                             encoding='utf-8') as f:
+                    data = json.load(f)
+            except (IOError, OSError, ValueError):
+                pass
+        if not isinstance(data, dict) or not data.get('url'):
+            return '{0}=={1}'.format(self.project_name, self.version)
+        url = data['url']
+        if (data.get('dir_info') or {}).get('editable'):
+            return '-e {0}'.format(url)
+        vcs_info = data.get('vcs_info') or {}
+        if vcs_info.get('vcs') and vcs_info.get('commit_id'):
+            url = '{0}+{1}@{2}'.format(vcs_info['vcs'], url,
+                                       vcs_info['commit_id'])
+        return '{0} @ {1}'.format(self.project_name, url)
+
+    def as_pkg_resources(self):
+        """Return the equivalent `pkg_resources.Distribution`
+
+        Required for the parts of pip's API that expect a real
+        distribution object eg. `FrozenRequirement.from_dist`
+
+        """
+        from pip._vendor import pkg_resources
+        if not self.is_on_disk():
+            # The metadata was not read from the filesystem (eg. from a
+            # wheel or a tarball), so only the name and version are known
+            return pkg_resources.Distribution(
+                self.location, project_name=self.project_name,
+                version=self.version)
+        if self.path is None:
+            return pkg_resources.get_distribution(self.project_name)
+        metadata = pkg_resources.PathMetadata(self.location, self.path)
+        return pkg_resources.Distribution.from_location(
+            self.location, os.path.basename(self.path), metadata)
+
+    def __repr__(self):
+        return '<{0}("{1}")>'.format(self.__class__.__name__, self.key)
+
+
+class BackendUnavailable(Exception):
+    """Raised when a discovery backend cannot be used in the current
+    environment"""
+
+
+class DiscoveryBackend(object):
+    """Abstract class for strategies to find installed distributions
+
+    This class needs to be subclassed with an implementation for the
+    `distributions` method which must return objects that implement
+    the `pkg_resources.Distribution` interface used by `PackageDAG`
+    ie. `project_name`, `key`, `version`, `requires` and
+    `as_requirement`.
+
+      :param cache: optional MetadataCache instance (only used by the
+                    backends that read the metadata files themselves)
+    """
+
+    name = None
+
+    def __init__(self, cache=None):
+        self.cache = cache
+
+    def distributions(self, local_only=False, user_only=False):
+        raise NotImplementedError
+
+
+class PipBackend(DiscoveryBackend):
+    """Find distributions using pip's `get_installed_distributions`
+
+    This builds a complete `pkg_resources.WorkingSet` and is hence the
+    slowest backend, but also the one that supports every kind of
+    installation (eggs, editables etc.)
+
+    """
+
+    name = 'pip'
+
+    def distributions(self, local_only=False, user_only=False):
+        try:
+            from pip._internal.utils.misc import get_installed_distributions
+        except ImportError:
+            from pip import get_installed_distributions
+        return get_installed_distributions(local_only=local_only,
+                                           user_only=user_only)
+
+
+def _unshadowed(dists):
+    """Return the distributions, skipping the ones shadowed by an
+    earlier one with the same key (and the ones in `STDLIB_PKGS`)
+
+    :param dists: iterable of distributions, in order of precedence
+    :rtype: list
+
+    """
+    seen = set(STDLIB_PKGS)
+    unshadowed = []
+    for dist in dists:
+        if dist.key not in seen:
+            seen.add(dist.key)
+            unshadowed.append(dist)
+    return unshadowed
+
+
+class MetadataScanBackend(DiscoveryBackend):
+    """Find distributions by scanning the sys.path entries for
+    .dist-info and .egg-info metadata
+
+    Only the `Name`, `Version` and `Requires-Dist` fields are parsed
+    (along with `requires.txt` in case of .egg-info). Eggs and
+    editable installs that don't leave metadata on sys.path are not
+    found by this backend.
+
+    If a `MetadataCache` is given, the metadata files are only read if
+    they have changed since the last run.
+
+    """
+
+    name = 'scan'
+
+    def distributions(self, local_only=False, user_only=False):
+        return self.scan_dirs(_search_paths(local_only, user_only))
+
+    def scan_dirs(self, locations):
+        """Return distributions found in the directories, in order of
+        precedence ie. a distribution shadowed by one with the same
+        name in an earlier directory is skipped
+
+        :param list locations: directories to scan
+        :returns: list of MetadataDistribution instances
+        :rtype: list
+
+        """
+        return _unshadowed(dist for location in locations
+                           for dist in self.scan_dir(location))
+
+    def scan_dir(self, location):
+        """Return distributions found in a directory
+
+        :param str location: directory to scan
+        :returns: list of MetadataDistribution instances
+        :rtype: list
+
+        """
+        if self.cache is None:
+            try:
+                entries = self.list_entries(location)
+            except OSError:
+                return []
+            dists = (self.read_dist(location, e) for e in entries)
+            return [d for d in dists if d is not None]
+
+        cached = self.cache.load(location)
+        known = dict((entry, (item['stamp'], MetadataDistribution(
+                         item['name'], item['version'], item['requires'],
+                         location=location,
+                         path=os.path.join(location, entry))))
+                     for entry, item in cached.items())
+        found = self.rescan_dir(location, known)
+        fresh = dict((entry, {'stamp': stamp,
+                              'name': dist.project_name,
+                              'version': dist.version,
+                              'requires': dist.requires_dist})
+                     for entry, (stamp, dist) in found.items())
+        if fresh != cached:
+            self.cache.save(location, fresh)
+        return [dist for _, dist in found.values()]
+
+    @classmethod
+    def rescan_dir(cls, location, known):
+        """Scan a directory again, reading only the metadata that has
+        changed since a previous scan
+
+        A distribution is considered unchanged for as long as it's
+        `metadata_stamp` is the same.
+
+        :param str location: directory to scan
+        :param dict known: .dist-info/.egg-info name -> (stamp,
+                           distribution) as returned for the previous
+                           scan
+        :returns: .dist-info/.egg-info name -> (stamp, distribution)
+                  for the distributions found, in the order of the
+                  names. The distributions that are unchanged are the
+                  ones from `known`.
+        :rtype: collections.OrderedDict
+
+        """
+        try:
+            entries = cls.list_entries(location)
+        except OSError:
+            entries = []
+        found = OrderedDict()
+        for entry in entries:
+            stamp = cls.metadata_stamp(location, entry)
+            if stamp is None:
+                continue
+            item = known.get(entry)
+            if item is None or item[0] != stamp:
+                dist = cls.read_dist(location, entry)
+                if dist is None:
+                    continue
+                item = (stamp, dist)
+            found[entry] = item
+        return found
+
+    @staticmethod
+    def list_entries(location):
+        """Return the names of the .dist-info/.egg-info entries in a
+        directory, sorted
+
+        :param str location: directory to scan
+        :rtype: list
+        :raises OSError: if the directory is not readable
+
+        """
+        return sorted(e for e in os.listdir(location)
+                      if e.endswith(('.dist-info', '.egg-info')))
+
+    @classmethod
+    def metadata_stamp(cls, location, entry):
+        """Return the mtime, inode and size of the files the metadata
+        of a distribution is read from ie. the metadata headers and
+        `requires.txt` in case of an .egg-info directory
+
+        :param str location: directory in which the metadata is found
+        :param str entry: name of the .dist-info/.egg-info entry
+        :returns: the stamp or None if the metadata is not readable
+        :rtype: list
+
+        """
+        path = cls.metadata_path(location, entry)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stamp = [st.st_mtime, st.st_ino, st.st_size]
+        if entry.endswith('.egg-info') and path != os.path.join(location,
+                                                                 entry):
+            try:
+                st = os.stat(os.path.join(location, entry, 'requires.txt'))
+            except OSError:
+                stamp.append(None)
+            else:
+                stamp.extend([st.st_mtime, st.st_ino, st.st_size])
+        return stamp
+
+    @staticmethod
+    def metadata_path(location, entry):
+        """Return path to the file containing the metadata headers
+
+        :param str location: directory in which the metadata is found
+        :param str entry: name of the .dist-info/.egg-info entry
+        :rtype: str
+
+        """
+        path = os.path.join(location, entry)
+        if entry.endswith('.dist-info'):
+            return os.path.join(path, 'METADATA')
+        elif os.path.isdir(path):
+            return os.path.join(path, 'PKG-INFO')
+        else:
+            # Single file .egg-info as installed by distutils
+            return path
+
+    @classmethod
+    def read_dist(cls, location, entry):
+        """Read a distribution from its metadata directory (or file)
+
+        :param str location: directory in which the metadata is found
+        :param str entry: name of the .dist-info/.egg-info entry
+        :returns: the distribution or None if the metadata is not
+                  readable
+        :rtype: MetadataDistribution
+
+        """
+        path = os.path.join(location, entry)
+        metadata_path = cls.metadata_path(location, entry)
+        try:
+            with io.open(metadata_path, encoding='utf-8',
+                         errors='replace') as f:
+                name, version, requires = parse_metadata(f)
+        except (IOError, OSError):
+            return None
+        if metadata_path != path and entry.endswith('.egg-info'):
+            try:
+                with io.open(os.path.join(path, 'requires.txt'),
+                             encoding='utf-8', errors='replace') as f:
+                    requires = parse_requires_txt(f)
+            except (IOError, OSError):
+                pass
+        name, version = _fill_name_version(entry, name, version)
+        return MetadataDistribution(name, version, requires,
+                                    location=location, path=path)
+
+
+class MetadataCache(object):
+    """Persistent cache of the metadata read by the `scan` backend
+
+    There's one json file per scanned directory which holds the name,
+    version and requirements of every distribution found in it. An
+    entry is valid for as long as the mtime, inode and size of its
+    metadata files are unchanged (refer
+    `MetadataScanBackend.metadata_stamp`), so that on a warm run only the
+    distributions that have been installed or upgraded since the
+    previous run need to be parsed.
+
+      :param str cache_dir: directory to store the cache files in
+                            (default: $XDG_CACHE_HOME/pipdeptree)
+    """
+
+    # To be incremented whenever the format of the cache files changes
+    VERSION = 1
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+            cache_dir = os.path.join(cache_home, 'pipdeptree')
+        self.cache_dir = cache_dir
+
+    def cache_file(self, location):
+        import hashlib
+        digest = hashlib.sha1(location.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, '{0}.json'.format(digest))
+
+    def load(self, location):
+        """Load the cached entries for a directory
+
+        :param str location: the scanned directory
+        :returns: dict of .dist-info/.egg-info name -> entry
+        :rtype: dict
+
+        """
+        try:
+            with io.open(self.cache_file(location), encoding='utf-8') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if data.get('version') != self.VERSION or \
+           data.get('location') != location:
+            return {}
+        return data['entries']
+
+    def save(self, location, entries):
+        """Save the entries for a directory
+
+        The cache is only an optimization, so failing to write it
+        (eg. due to a read-only home dir) is not an error.
+
+        :param str location: the scanned directory
+        :param dict entries: dict of .dist-info/.egg-info name -> entry
+        :returns: None
+
+        """
+        data = {'version': self.VERSION,
+                'location': location,
+                'entries': entries}
+        import tempfile
+        path = self.cache_file(location)
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # Write to a temp file first so that concurrent runs never
+            # see a partially written cache file
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            getattr(os, 'replace', os.rename)(tmp_path, path)
+        except (IOError, OSError):
+            pass
+
+
+class ImportlibMetadataBackend(DiscoveryBackend):
+    """Find distributions using `importlib.metadata` (or the
+    `importlib_metadata` backport on older versions of python)
+
+    """
+
+    name = 'importlib'
+
+    def distributions(self, local_only=False, user_only=False):
+        try:
+            import importlib.metadata as importlib_metadata
+        except ImportError:
+            try:
+                import importlib_metadata
+            except ImportError:
+                raise BackendUnavailable('importlib.metadata is not available')
+
+        seen = set(STDLIB_PKGS)
+        dists = []
+        paths = _search_paths(local_only, user_only)
+        for d in importlib_metadata.distributions(path=paths):
+            name = d.metadata['Name']
+            if not name:
+                continue
+            # `_path` is only set for distributions found on the
+            # filesystem, which is all we look for
+            path = getattr(d, '_path', None)
+            dist = MetadataDistribution(
+                name, d.version, d.requires or [],
+                location=str(d.locate_file('')),
+                path=str(path) if path is not None else None)
+            if dist.key not in seen:
+                seen.add(dist.key)
+                dists.append(dist)
+        return dists
+
+
+BACKENDS = OrderedDict((b.name, b) for b in (PipBackend,
+                                             MetadataScanBackend,
+                                             ImportlibMetadataBackend))
+
+
+def discover_distributions(backend='pip', local_only=False, user_only=False,
+                           cache=None):
+    """Find the installed distributions using the specified backend
+
+    If the backend is not available in the current environment, pip
+    is used as the fallback.
+
+    :param str backend: name of the backend (one of `BACKENDS`)
+    :param bool local_only: if in a virtualenv, only return the
+                            distributions local to it
+    :param bool user_only: only return the distributions installed
+                           in the user site dir
+    :param MetadataCache cache: optional cache of parsed metadata
+    :returns: list of distributions
+    :rtype: list
+
+    """
+    try:
+        return BACKENDS[backend](cache).distributions(local_only=local_only,
+                                                 user_only=user_only)
+    except BackendUnavailable as e:
+        print('{0}, falling back to pip'.format(e), file=sys.stderr)
+        return PipBackend().distributions(local_only=local_only,
+                                          user_only=user_only)
+
+
+def read_wheel(path):
+    """Read a distribution from the METADATA file in a wheel
+
+    Only the zip's central directory and the METADATA member are read,
+    nothing is extracted.
+
+    :param str path: path to the .whl file
+    :returns: the distribution or None if the file is not a readable
+              wheel
+    :rtype: MetadataDistribution
+
+    """
+    import zipfile
+    try:
+        with zipfile.ZipFile(path) as whl:
+            members = [m for m in whl.namelist()
+                       if m.count('/') == 1 and
+                       m.endswith('.dist-info/METADATA')]
+            if not members:
+                return None
+            with whl.open(members[0]) as f:
+                lines = io.TextIOWrapper(f, encoding='utf-8',
+                                         errors='replace')
+                name, version, requires = parse_metadata(lines)
+    except (IOError, OSError, zipfile.BadZipfile):
+        return None
+    name, version = _fill_name_version(os.path.basename(path), name, version)
+    return MetadataDistribution(name, version, requires, location=path,
+                                path=os.path.join(path,
+                                                  os.path.dirname(members[0])))
+
+
+def scan_wheelhouse(directory, threads=None):
+    """Return the distributions of the wheels in a directory
+
+    The wheels are read concurrently in a thread pool. If there are
+    several wheels of a distribution, only the highest version is
+    returned, as that's what pip would install from the directory.
+
+    :param str directory: the directory containing .whl files
+    :param int threads: max. no. of threads (refer `_thread_map`)
+    :returns: list of MetadataDistribution instances
+    :rtype: list
+
+    """
+    from glob import glob
+    paths = sorted(glob(os.path.join(directory, '*.whl')))
+    dists = _thread_map(read_wheel, paths, threads)
+
+    def by_version(dist):
+        parsed = parse_version(dist.version)
+        return (parsed is not None, parsed)
+
+    latest = OrderedDict()
+    for dist in dists:
+        if dist is None or dist.key in STDLIB_PKGS:
+            continue
+        other = latest.get(dist.key)
+        if other is None or by_version(dist) > by_version(other):
+            latest[dist.key] = dist
+    return list(latest.values())
+
+
+SITE_DIRS = ('site-packages', 'dist-packages')
+
+
+def scan_tarball(path=None, fileobj=None):
+    """Return the distributions installed in a tar archive, eg. a
+    container image layer or the output of `docker export`
+
+    The archive (optionally compressed) is read as a stream in a
+    single forward pass and nothing is extracted. Only the metadata
+    files in site-packages/dist-packages directories are read ie.
+    `*.dist-info/METADATA`, `*.egg-info/PKG-INFO`,
+    `*.egg-info/requires.txt` and single file `*.egg-info`. If a
+    distribution is found in several directories, the first one is
+    returned.
+
+    :param str path: path to the archive
+    :param fileobj: file like object to read the archive from instead
+    :returns: list of MetadataDistribution instances
+    :rtype: list
+
+    """
+    import tarfile
+    # (location, entry) -> [(name, version, requires), requires.txt]
+    found = OrderedDict()
+    with tarfile.open(path, mode='r|*', fileobj=fileobj) as tar:
+        while True:
+            member = tar.next()
+            if member is None:
+                break
+            # TarFile keeps a list of all the members read so far,
+            # which would grow with the size of the archive
+            tar.members = []
+            if not member.isfile():
+                continue
+            parts = [part for part in member.name.split('/')
+                     if part not in ('', '.')]
+            if len(parts) >= 3 and parts[-3] in SITE_DIRS:
+                location, entry, filename = ('/'.join(parts[:-2]),
+                                             parts[-2], parts[-1])
+            elif len(parts) >= 2 and parts[-2] in SITE_DIRS:
+                # Single file .egg-info as installed by distutils
+                location, entry, filename = ('/'.join(parts[:-1]),
+                                             parts[-1], 'PKG-INFO')
+                if not entry.endswith('.egg-info'):
+                    continue
+            else:
+                continue
+            if entry.endswith('.dist-info'):
+                if filename != 'METADATA':
+                    continue
+            elif not entry.endswith('.egg-info') or \
+                    filename not in ('PKG-INFO', 'requires.txt'):
+                continue
+            # (io.TextIOWrapper needs a seekable file in stream mode)
+            lines = (line.decode('utf-8', 'replace')
+                     for line in tar.extractfile(member))
+            item = found.setdefault((location, entry), [None, None])
+            if filename == 'requires.txt':
+                item[1] = parse_requires_txt(lines)
+            else:
+                item[0] = parse_metadata(lines)
+
+    seen = set(STDLIB_PKGS)
+    dists = []
+    for (location, entry), (metadata, requires_txt) in found.items():
+        if metadata is None:
+            continue
+        name, version, requires = metadata
+        name, version = _fill_name_version(entry, name, version)
+        if requires_txt is not None:
+            requires = requires_txt
+        dist = MetadataDistribution(
+            name, version, requires,
+            location=os.path.join(path or '-', location),
+            path=os.path.join(path or '-', location, entry))
+        if dist.key not in seen:
+            seen.add(dist.key)
+            dists.append(dist)
+    return dists
+
+
+def environment_site_dirs(path):
+    """Return the site-packages directories of a virtualenv
+
+    :param str path: root of the virtualenv or a site-packages
+                     directory (returned as is)
+    :returns: list of directories
+    :rtype: list
+
+    """
+    from glob import glob
+    dirs = []
+    seen = set()
+    for pattern in (('lib', 'python*', 'site-packages'),
+                    ('lib64', 'python*', 'site-packages'),
+                    ('Lib', 'site-packages')):
+        for d in sorted(glob(os.path.join(path, *pattern))):
+            # lib64 is usually a symlink to lib
+            real = os.path.normcase(os.path.realpath(d))
+            if real not in seen and os.path.isdir(d):
+                seen.add(real)
+                dirs.append(d)
+    return dirs or [path]
+
+
+def _environment_dag(job):
+    # Runs in the worker processes of `scan_environments`, hence at
+    # module level so that it can be pickled
+    path, cache = job
+    dirs = environment_site_dirs(path)
+    return PackageDAG.from_pkgs(MetadataScanBackend(cache).scan_dirs(dirs),
+                                resolver=VersionResolver(paths=dirs))
+
+
+def scan_environments(paths, processes=None, cache=None):
+    """Build the dependency DAGs of several environments in parallel
+
+    The environments are scanned like the `scan` backend does (without
+    running their interpreters), each one in a worker process from a
+    `multiprocessing.Pool`.
+
+    :param list paths: virtualenv roots or site-packages directories
+    :param int processes: no. of worker processes (default: no. of
+                          CPUs). With 1, everything runs in the current
+                          process.
+    :param MetadataCache cache: optional cache of parsed metadata
+    :returns: ordered dict of path -> PackageDAG
+    :rtype: OrderedDict
+
+    """
+    jobs = [(path, cache) for path in paths]
+    if processes == 1 or len(jobs) < 2:
+        dags = [_environment_dag(job) for job in jobs]
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(processes or multiprocessing.cpu_count(),
+                                        len(jobs)))
+        try:
+            dags = pool.map(_environment_dag, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return OrderedDict(zip(paths, dags))
+
+
+def load(paths=None, local_only=False, user_only=False, backend='scan',
+         guess_by_import=False, cache=None):
+    """Build the dependency DAG of the installed distributions
+
+    This is the entry point for using pipdeptree as a library. Nothing
+    is printed, the DAG is to be queried (eg. `PackageDAG.get_parents`,
+    `PackageDAG.conflicts`) and rendered (refer `render`) as needed.
+    As a DAG can be shared by threads, it can be loaded once and used
+    eg. by all the requests handled by a web application.
+
+    :param list paths: virtualenv roots or site-packages directories
+                       to look for distributions in, in order of
+                       precedence (default: the current environment)
+    :param bool local_only: if in a virtualenv, only consider the
+                            distributions local to it (only without
+                            `paths`)
+    :param bool user_only: only consider the distributions installed
+                           in the user site dir (only without `paths`)
+    :param str backend: name of the backend (refer `BACKENDS`) to find
+                        the distributions of the current environment
+                        with. Unlike on the command line, the default
+                        is `scan`, which doesn't import pip.
+    :param bool guess_by_import: refer `VersionResolver` (only
+                                 without `paths`)
+    :param MetadataCache cache: optional cache of parsed metadata
+    :returns: PackageDAG instance
+
+    """
+    if paths is None:
+        dists = discover_distributions(backend, local_only=local_only,
+                                       user_only=user_only, cache=cache)
+        resolver = VersionResolver(guess_by_import)
+    else:
+        dirs = [d for path in paths for d in environment_site_dirs(path)]
+        dists = MetadataScanBackend(cache).scan_dirs(dirs)
+        resolver = VersionResolver(paths=dirs)
+    return PackageDAG.from_pkgs(dists, resolver=resolver)
+
+
+def traverse(tree, nodes, root_in_chain=False, dedupe=False, max_depth=None):
+    """Traverse the tree depth first, starting from each of the nodes
+
+    The traversal is iterative (using an explicit stack) so that the
+    depth of the tree is not limited by the recursion limit. Children
+    are visited in the order they appear in the tree. A child is
+    skipped if a package with the same name is already in the chain
+    of ancestors leading to it, which prevents infinitely traversing
+    cyclic dependencies.
+
+    With `dedupe`, the dependencies of a package are traversed only
+    the first time it's visited. Later occurrences of the package are
+    generated as references (without traversing the dependencies
+    again), which keeps the traversal linear in the size of the graph.
+
+    With `max_depth`, the nodes at that depth are generated without
+    looking at their dependencies at all, ie. the traversal is pruned
+    rather than truncated.
+
+    :param PackageDAG tree: the package tree
+    :param list nodes: nodes to start the traversal from
+    :param bool root_in_chain: whether the starting node is considered
+                               part of the chain of ancestors
+    :param bool dedupe: whether to traverse shared dependencies only
+                        once
+    :param int max_depth: depth up to which to traverse (or None for
+                          no limit)
+    :returns: generator of (node, parent, depth, is_ref) tuples in
+              pre-order, where parent is None and depth is 0 for the
+              starting nodes and is_ref tells whether the node is a
+              reference to an already traversed one
+
+    """
+    expanded = set()
+
+    for root in nodes:
+        if max_depth == 0:
+            yield root, None, 0, False
+            continue
+        children = tree.get_children(root.key)
+        if dedupe and root.key in expanded and children:
+            yield root, None, 0, True
+            continue
+        yield root, None, 0, False
+        expanded.add(root.key)
+        # names of the packages in the current chain of ancestors
+        chain = set([root.project_name]) if root_in_chain else set()
+        stack = [(root, iter(children))]
+        while stack:
+            node, children = stack[-1]
+            for c in children:
+                if c.project_name in chain:
+                    continue
+                if max_depth is not None and len(stack) >= max_depth:
+                    yield c, node, len(stack), False
+                    continue
+                grandchildren = tree.get_children(c.key)
+                if dedupe and c.key in expanded and grandchildren:
+                    yield c, node, len(stack), True
+                    continue
+                yield c, node, len(stack), False
+                expanded.add(c.key)
+                chain.add(c.project_name)
+                stack.append((c, iter(grandchildren)))
+                break
+            else:
+                stack.pop()
+                chain.discard(node.project_name)
+
+
+def iter_text_lines(tree, list_all=True, frozen=False, dedupe=False,
+                    max_depth=None):
+    """Generate the lines of the text representation of the tree
+
+    The lines are generated as the tree is traversed, so that the
+    output doesn't need to be held in memory entirely.
+
+    :param dict tree: the package tree
+    :param bool list_all: whether to list all the pgks at the root
+                          level or only those that are the
+                          sub-dependencies
+    :param bool frozen: whether or not show the names of the pkgs in
+                        the output that's favourable to pip --freeze
+    :param bool dedupe: whether to show the dependencies of a package
+                        only the first time it appears in the output
+                        (later occurrences are marked with "see above")
+    :param int max_depth: depth up to which to show the dependencies
+                          (or None for no limit)
+    :returns: generator of lines (without trailing newlines)
+
+    """
+    tree = tree.sort()
+    nodes = tree.keys()
+    branch_keys = set(r.key for r in flatten(tree.values()))
+    use_bullets = not frozen
+    # In frozen mode, the marker is a comment so that the output can
+    # still be used as a requirements file
+    ref_marker = '  # see above' if frozen else ' (see above)'
+
+    if not list_all:
+        nodes = [p for p in nodes if p.key not in branch_keys]
+
+    for node, parent, depth, is_ref in traverse(tree, nodes, dedupe=dedupe,
+                                                max_depth=max_depth):
+        node_str = node.render(parent, frozen)
+        if parent:
+            prefix = ' '*depth*2 + ('- ' if use_bullets else '')
+            node_str = prefix + node_str
+        if is_ref:
+            node_str += ref_marker
+        yield node_str
+
+
+def render_text(tree, list_all=True, frozen=False, out=None, dedupe=False,
+                max_depth=None):
+    """Print tree as text on console
+
+    Lines are written to the output stream as soon as they are
+    generated.
+
+    :param dict tree: the package tree
+    :param bool list_all: whether to list all the pgks at the root
+                          level or only those that are the
+                          sub-dependencies
+    :param bool frozen: whether or not show the names of the pkgs in
+                        the output that's favourable to pip --freeze
+    :param out: file like object to write to (default: sys.stdout)
+    :param bool dedupe: whether to show the dependencies of a package
+                        only the first time it appears in the output
+    :param int max_depth: depth up to which to show the dependencies
+                          (or None for no limit)
+    :returns: None
+
+    """
+    out = out or sys.stdout
+    for line in iter_text_lines(tree, list_all, frozen, dedupe, max_depth):
+        out.write(line)
+        out.write('\n')
+
+
+def render_json(tree, indent):
+    """Converts the tree into a flat json representation.
+
+    The json repr will be a list of hashes, each hash having 2 fields:
+      - package
+      - dependencies: list of dependencies
+
+    :param dict tree: dependency tree
+    :param int indent: no. of spaces to indent json
+    :returns: json representation of the tree
+    :rtype: str
+
+    """
+    return json.dumps(list(_json_items(tree)), indent=indent)
+
+
+def _json_items(tree):
+    for k, vs in tree.items():
+        yield {'package': k.as_dict(),
+               'dependencies': [v.as_dict() for v in vs]}
+
+
+def render_json_environments(trees, indent):
+    """Converts the trees of several environments into a json object
+    with the paths of the environments as keys and their flat json
+    representation (refer `render_json`) as values
+
+    :param dict trees: ordered dict of path -> dependency tree
+    :param int indent: no. of spaces to indent json
+    :returns: json representation of the trees
+    :rtype: str
+
+    """
+    return json.dumps(OrderedDict((path, list(_json_items(tree)))
+                                  for path, tree in trees.items()),
+                      indent=indent)
+
+
+def iter_json_lines(tree):
+    """Generate the flat json representation one package at a time
+
+    Each item is a json object (on a single line) with the same 2
+    fields as the items in the output of `render_json` ie.
+      - package
+      - dependencies: list of dependencies
+
+    :param dict tree: dependency tree
+    :returns: generator of str
+
+    """
+    for item in _json_items(tree):
+        yield json.dumps(item)
+
+
+def render_json_lines(tree, out=None):
+    """Print the flat json representation as newline delimited json
+
+    Every package is serialized and written to the output stream on
+    it's own line as the tree is iterated, so that the output can be
+    consumed incrementally.
+
+    :param dict tree: dependency tree
+    :param out: file like object to write to (default: sys.stdout)
+    :returns: None
+
+    """
+    out = out or sys.stdout
+    for line in iter_json_lines(tree):
+        out.write(line)
+        out.write('\n')
+
+
+def render_json_tree(tree, indent, dedupe=False, max_depth=None):
+    """Converts the tree into a nested json representation.
+
+    The json repr will be a list of hashes, each hash having the following fields:
+      - package_name
+      - key
+      - required_version
+      - installed_version
+      - dependencies: list of dependencies
+
+    With `dedupe`, the dependencies of a package are included only
+    the first time it appears. Later occurrences have a `ref` field
+    (the key of the package) instead of `dependencies`.
+
+    :param dict tree: dependency tree
+    :param int indent: no. of spaces to indent json
+    :param bool dedupe: whether to include the dependencies of a
+                        package only once
+    :param int max_depth: depth up to which to include the
+                          dependencies (or None for no limit)
+    :returns: json representation of the tree
+    :rtype: str
+
+    """
+    return ''.join(iter_json_tree(tree, indent, dedupe, max_depth))
+
+
+def iter_json_tree(tree, indent=None, dedupe=False, max_depth=None):
+    """Generate the nested json representation of the tree in chunks
+
+    The output is the same as `json.dumps` would produce for the
+    nested list of dicts (refer `render_json_tree`) but it's
+    generated as the tree is traversed, without building the nested
+    structure in memory and without recursion.
+
+    :param dict tree: dependency tree
+    :param int indent: no. of spaces to indent json
+    :param bool dedupe: whether to include the dependencies of a
+                        package only once
+    :param int max_depth: depth up to which to include the
+                          dependencies (or None for no limit)
+    :returns: generator of str
+
+    """
+    tree = tree.sort()
+    branch_keys = set(r.key for r in flatten(tree.values()))
+    nodes = [p for p in tree.keys() if p.key not in branch_keys]
+
+    if indent is None:
+        item_sep = ', '
+
+        def newline(level):
+            return ''
+    else:
+        item_sep = ','
+
+        def newline(level):
+            return '\n' + ' ' * indent * level
+
+    # A node at depth `d` is a dict at nesting level `2d+1` (the list
+    # of root nodes being at level 0) and it's `dependencies` list at
+    # level `2d+2`. As the children of a node are generated right after
+    # it, the list of dependencies of the previous node is either
+    # opened or empty depending on the depth of the next one. A
+    # reference has no list of dependencies at all.
+    def close(depth, to_depth, is_ref):
+        chunks = [] if is_ref else ['[]']
+        chunks += [newline(2*depth+1), '}']
+        for d in range(depth - 1, to_depth - 1, -1):
+            chunks += [newline(2*d+2), ']', newline(2*d+1), '}']
+        return ''.join(chunks)
+
+    yield '['
+    prev_depth, prev_ref = None, False
+    for node, parent, depth, is_ref in traverse(tree, nodes,
+                                                root_in_chain=True,
+                                                dedupe=dedupe,
+                                                max_depth=max_depth):
+        if prev_depth is None:
+            yield newline(1)
+        elif depth > prev_depth:
+            yield '[' + newline(2*depth+1)
+        else:
+            yield (close(prev_depth, depth, prev_ref) + item_sep +
+                   newline(2*depth+1))
+        d = node.as_dict()
+        if parent:
+            d['required_version'] = node.version_spec if node.version_spec else 'Any'
+        else:
+            d['required_version'] = d['installed_version']
+        fields = ['{0}: {1}'.format(json.dumps(k), json.dumps(v))
+                  for k, v in d.items()]
+        if is_ref:
+            fields.append('"ref": {0}'.format(json.dumps(node.key)))
+        else:
+            fields.append('"dependencies": ')
+        sep = item_sep + newline(2*depth+2)
+        yield '{' + newline(2*depth+2) + sep.join(fields)
+        prev_depth, prev_ref = depth, is_ref
+    if prev_depth is not None:
+        yield close(prev_depth, 0, prev_ref) + newline(0)
+    yield ']'
+
+
+# Output formats supported by the `dot` command of GraphViz
+GRAPHVIZ_FORMATS = frozenset([
+    'bmp', 'canon', 'cgimage', 'cmap', 'cmapx', 'cmapx_np', 'dot',
+    'dot_json', 'eps', 'exr', 'fig', 'gd', 'gd2', 'gif', 'gtk', 'gv', 'ico',
+    'imap', 'imap_np', 'ismap', 'jp2', 'jpe', 'jpeg', 'jpg', 'json', 'json0',
+    'pct', 'pdf', 'pic', 'pict', 'plain', 'plain-ext', 'png', 'pov', 'ps',
+    'ps2', 'psd', 'sgi', 'svg', 'svgz', 'tga', 'tif', 'tiff', 'tk', 'vml',
+    'vmlz', 'vrml', 'wbmp', 'webp', 'x11', 'xdot', 'xdot1.2', 'xdot1.4',
+    'xdot_json', 'xlib',
+])
+
+_DOT_ID_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*|-?(\.[0-9]+|[0-9]+(\.[0-9]*)?))$')
+_DOT_KEYWORDS = frozenset(['digraph', 'edge', 'graph', 'node', 'strict',
+                           'subgraph'])
+
+
+def _dot_quote(s):
+    """Returns `s` as a DOT identifier, quoting it only if necessary"""
+    if _DOT_ID_RE.match(s) and s.lower() not in _DOT_KEYWORDS:
+        return s
+    return '"{0}"'.format(s.replace('"', '\\"'))
+
+
+def _dot_attrs(**attrs):
+    # label is always the first attribute, others are sorted by name
+    # (same as the output of the graphviz package)
+    items = [('label', attrs.pop('label'))] if 'label' in attrs else []
+    items.extend(sorted(attrs.items()))
+    return ' '.join('{0}={1}'.format(k, _dot_quote(v)) for k, v in items)
+
+
+def iter_dot_lines(tree, is_reverse=False):
+    """Generate the dependency graph in DOT format line by line
+
+    :param dict tree: dependency graph
+    :param bool is_reverse: whether the tree is a reversed one
+    :returns: generator of lines (without the trailing newline)
+
+    """
+    def node(key, **attrs):
+        return '\t{0} [{1}]'.format(_dot_quote(key), _dot_attrs(**attrs))
+
+    def edge(tail, head, **attrs):
+        return '\t{0} -> {1} [{2}]'.format(_dot_quote(tail), _dot_quote(head),
+                                          _dot_attrs(**attrs))
+
+    yield 'digraph {'
+    if not is_reverse:
+        for pkg, deps in tree.items():
             pkg_label = '{0}\n{1}'.format(pkg.project_name, pkg.version)
-            graph.node(pkg.key, label=pkg_label)
+            yield node(pkg.key, label=pkg_label)
             for dep in deps:
                 edge_label = dep.version_spec or 'any'
                 if dep.is_missing:
                     dep_label = '{0}\n(missing)'.format(dep.project_name)
-                    graph.node(dep.key, label=dep_label, style='dashed')
-                    graph.edge(pkg.key, dep.key, style='dashed')
+                    yield node(dep.key, label=dep_label, style='dashed')
+                    yield edge(pkg.key, dep.key, style='dashed')
                 else:
-                    graph.edge(pkg.key, dep.key, label=edge_label)
+                    yield edge(pkg.key, dep.key, label=edge_label)
     else:
         for dep, parents in tree.items():
             dep_label = '{0}\n{1}'.format(dep.project_name,
                                           dep.installed_version)
-            graph.node(dep.key, label=dep_label)
+            yield node(dep.key, label=dep_label)
             for parent in parents:
                 # req reference of the dep associated with this
                 # particular parent package
                 req_ref = parent.req
                 edge_label = req_ref.version_spec or 'any'
-                graph.edge(dep.key, parent.key, label=edge_label)
+                yield edge(dep.key, parent.key, label=edge_label)
+    yield '}'
+
+
+def _check_graphviz_format(output_format):
+    if output_format not in GRAPHVIZ_FORMATS:
+        print('{0} is not a supported output format.'.format(output_format),
+              file=sys.stderr)
+        print('Supported formats are: {0}'.format(
+            ', '.join(sorted(GRAPHVIZ_FORMATS))), file=sys.stderr)
+        sys.exit(1)
+
+
+def _pipe_dot(lines, output_format, stdout):
+    """Feeds the DOT `lines` to the `dot` command of GraphViz to convert
+    them to `output_format`
+
+    :param lines: iterable of lines in DOT format
+    :param str output_format: output format
+    :param stdout: where `dot` writes the output to, either a file
+                   object or `subprocess.PIPE`
+    :returns: output of `dot` if stdout is `subprocess.PIPE` else None
+
+    """
+    try:
+        proc = subprocess.Popen(['dot', '-T{0}'.format(output_format)],
+                                stdin=subprocess.PIPE, stdout=stdout)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        print('GraphViz is not available, but necessary for the output '
+              'option. Please install it (the `dot` command must be on '
+              'PATH).', file=sys.stderr)
+        sys.exit(1)
+
+    output = []
+    try:
+        if stdout == subprocess.PIPE:
+            # dot writes the output only after reading all of the
+            # input, but it's collected concurrently to be on the safe
+            # side
+            source = ''.join(line + '\n' for line in lines)
+            output.append(proc.communicate(source.encode('utf-8'))[0])
+        else:
+            for line in lines:
+                proc.stdin.write(line.encode('utf-8') + b'\n')
+            proc.stdin.close()
+    except IOError as e:
+        # dot exited before reading all the input, the error is
+        # reported through the return code
+        if e.errno != errno.EPIPE:
+            raise
+    if proc.wait() != 0:
+        print('dot exited with status {0}'.format(proc.returncode),
+              file=sys.stderr)
+        sys.exit(1)
+    return output[0] if output else None
+
+
+def render_graphviz(tree, output_format='dot', is_reverse=False, out=None):
+    """Write the dependency graph in one of the supported GraphViz output
+    formats.
+
+    The DOT source is written to `out` as it's generated, without
+    building the whole graph in memory. Other formats are generated by
+    piping the DOT source to the `dot` command, which writes directly
+    to `out` (which must then have a file descriptor).
 
-    # Allow output of dot format, even if GraphViz isn't installed.
+    :param dict tree: dependency graph
+    :param str output_format: output format
+    :param bool is_reverse: whether the tree is a reversed one
+    :param out: file like object to write to (default: sys.stdout)
+    :returns: None
+
+    """
+    _check_graphviz_format(output_format)
+    out = out or sys.stdout
+    lines = iter_dot_lines(tree, is_reverse=is_reverse)
     if output_format == 'dot':
-        return graph.source
+        for line in lines:
+            out.write(line)
+            out.write('\n')
+    else:
+        out.flush()
+        _pipe_dot(lines, output_format, stdout=out)
+
 
+def dump_graphviz(tree, output_format='dot', is_reverse=False):
+    """Output dependency graph as one of the supported GraphViz output formats.
+
+    :param dict tree: dependency graph
+    :param string output_format: output format
+    :returns: representation of tree in the specified output format
+    :rtype: str or binary representation depending on the output format
+
+    """
+    _check_graphviz_format(output_format)
+    lines = iter_dot_lines(tree, is_reverse=is_reverse)
+
+    # The dot format doesn't need GraphViz to be installed
+    if output_format == 'dot':
+        return '\n'.join(lines)
+
+    output = _pipe_dot(lines, output_format, stdout=subprocess.PIPE)
     # As it's unknown if the selected output format is binary or not, try to
     # decode it as UTF8 and only print it out in binary if that's not possible.
     try:
-        return graph.pipe().decode('utf-8')
+        return output.decode('utf-8')
     except UnicodeDecodeError:
-        return graph.pipe()
+        return output
 
 
 def print_graphviz(dump_output):
@@ -656,51 +3112,501 @@ def conflicting_deps(tree):
     return conflicting
 
 
-def render_conflicts_text(conflicts):
+def render_conflicts_text(conflicts, out=None):
+    out = out or sys.stderr
     if conflicts:
         print('Warning!!! Possibly conflicting dependencies found:',
-              file=sys.stderr)
+              file=out)
         # Enforce alphabetical order when listing conflicts
         pkgs = sorted(conflicts.keys(), key=attrgetter('key'))
         for p in pkgs:
             pkg = p.render_as_root(False)
-            print('* {}'.format(pkg), file=sys.stderr)
+            print('* {}'.format(pkg), file=out)
             for req in conflicts[p]:
                 req_str = req.render_as_branch(False)
-                print(' - {}'.format(req_str), file=sys.stderr)
+                print(' - {}'.format(req_str), file=out)
+
+
+def what_if_conflicts(tree, versions):
+    """Find the requirements that wouldn't be satisfied if some
+    packages were installed in other versions, without touching the
+    environment
+
+    Only the requirements on the changed packages are checked. They
+    are found with the reversed DAG, which is cached, and the version
+    specifiers are parsed only once (refer `version_satisfies`), so
+    many changes can be checked at little cost. The requirements of
+    the changed packages themselves are assumed to stay the same.
+
+    The requirements that aren't satisfied by the installed versions
+    either are not reported (refer `conflicting_deps` for them).
+
+    :param PackageDAG tree: package tree/dag
+    :param versions: dict of package key -> version, or list of (key,
+                     version) pairs
+    :returns: dict of DistPackage -> list of the ReqPackage that would
+              be unsatisfied, referring to the new versions
+    :rtype: collections.OrderedDict
+
+    """
+    rtree = tree.reverse()
+    conflicts = OrderedDict()
+    for key, version in OrderedDict(versions).items():
+        for parent in rtree.get_children(key.lower()):
+            req = parent.req
+            if (version_satisfies(version, req.version_spec) or
+                    req.is_conflicting()):
+                continue
+            dist = MetadataDistribution(req.project_name, version, [])
+            node = conflicts.setdefault(parent.key, (parent, []))
+            node[1].append(ReqPackage(req._obj, dist, tree.resolver,
+                                      req.version_spec))
+    return OrderedDict(conflicts.values())
+
+
+def render_what_if_text(conflicts, out=None):
+    out = out or sys.stdout
+    if conflicts:
+        print('The following requirements would not be satisfied:',
+              file=out)
+        for p in sorted(conflicts.keys(), key=attrgetter('key')):
+            print('* {}'.format(p.render_as_root(False)), file=out)
+            for req in conflicts[p]:
+                print(' - {}'.format(req.render_as_branch(False)), file=out)
+
+
+def strongly_connected_components(tree):
+    """Find the strongly connected components of the graph
+
+    Uses an iterative version of Tarjan's algorithm, so it runs in
+    O(N+E) and isn't limited by the recursion limit. Only edges to
+    nodes present in the graph are considered ie. missing
+    dependencies are ignored.
+
+    :param PackageDAG tree: package tree/dag
+    :returns: list of components, each being a list of node keys, in
+              reverse topological order
+    :rtype: list
+
+    """
+    g = tree._graph
+    # missing dependencies have no edges, so they are always in a
+    # component of their own
+    return [[g.keys[i] for i in component]
+            for component in g.components() if component[0] < g.size]
 
 
 def cyclic_deps(tree):
     """Return cyclic dependencies as list of tuples
 
+    Each tuple represents a cycle with the first item being the
+    DistPackage where the cycle starts, followed by the ReqPackage
+    instances along the cycle, the last of which refers back to the
+    first one.
+
+    Every 2-cycle (A => B => A) is reported from both sides. Other
+    cycles are found using the strongly connected components of the
+    graph, such that every package that's part of a cycle appears in
+    at least one of the reported ones.
+
     :param PackageDAG pkgs: package tree/dag
     :returns: list of tuples representing cyclic dependencies
     :rtype: list
 
     """
-    index = {p.key: set([r.key for r in rs]) for p, rs in tree.items()}
+    # Only the packages in the (cached) cyclic components are looked at
+    component_of = {}
+    for i, component in enumerate(tree.cycles()):
+        for key in component:
+            component_of[key] = i
+    keys = sorted(component_of, key=tree._id)
+
+    # index of child nodes by key for all the nodes in cycles
+    index = {}
+    for key in keys:
+        cid = component_of[key]
+        index[key] = OrderedDict((r.key, r) for r in tree.get_children(key)
+                                 if component_of.get(r.key) == cid)
+
     cyclic = []
-    for p, rs in tree.items():
-        for r in rs:
-            if p.key in index.get(r.key, []):
-                p_as_dep_of_r = [x for x
-                                 in tree.get(tree.get_node_as_parent(r.key))
-                                 if x.key == p.key][0]
-                cyclic.append((p, r, p_as_dep_of_r))
+    covered = set()
+    for key in keys:
+        for r in index[key].values():
+            if key in index[r.key]:
+                cyclic.append((tree.get_node_as_parent(key), r,
+                               index[r.key][key]))
+                covered.update([key, r.key])
+
+    # Longer cycles, found by BFS back to the start node within the
+    # component, for all nodes not already covered by a 2-cycle
+    for key in sorted(k for k, children in index.items() if children):
+        if key in covered:
+            continue
+        prev = {}
+        queue = deque([key])
+        while key not in prev:
+            k = queue.popleft()
+            for c_key, c in index[k].items():
+                if c_key not in prev:
+                    prev[c_key] = (k, c)
+                    queue.append(c_key)
+        path = []
+        k = key
+        while True:
+            k, c = prev[k]
+            path.append(c)
+            if k == key:
+                break
+        path.reverse()
+        cyclic.append(tuple([tree.get_node_as_parent(key)] + path))
+        covered.update(c.key for c in path)
     return cyclic
 
 
-def render_cycles_text(cycles):
+def render_cycles_text(cycles, out=None):
+    out = out or sys.stderr
     if cycles:
-        print('Warning!! Cyclic dependencies found:', file=sys.stderr)
+        print('Warning!! Cyclic dependencies found:', file=out)
         # List in alphabetical order of the dependency that's cycling
         # (2nd item in the tuple)
         cycles = sorted(cycles, key=lambda xs: xs[1].key)
-        for a, b, c in cycles:
-            print('* {0} => {1} => {2}'.format(a.project_name,
-                                               b.project_name,
-                                               c.project_name),
-                  file=sys.stderr)
+        for cycle in cycles:
+            print('* {0}'.format(' => '.join(n.project_name for n in cycle)),
+                  file=out)
+
+
+def render_paths_text(paths, out=None):
+    """Print the paths to a package (refer `PackageDAG.paths_to`) as
+    text, each in the same form as the text output of the tree
+
+    :param list paths: list of paths
+    :param out: file like object to write to (default: sys.stdout)
+    :returns: None
+
+    """
+    out = out or sys.stdout
+    for path in paths:
+        for depth, node in enumerate(path):
+            if depth == 0:
+                out.write(node.render_as_root(False))
+            else:
+                out.write(' '*depth*2 + '- ' + node.render_as_branch(False))
+            out.write('\n')
+
+
+def render_paths_json(paths, indent):
+    """Converts the paths to a package (refer `PackageDAG.paths_to`)
+    into json, as a list of lists of packages
+
+    :param list paths: list of paths
+    :param int indent: no. of spaces to indent json
+    :returns: json representation of the paths
+    :rtype: str
+
+    """
+    return json.dumps([[n.as_dict() for n in path] for path in paths],
+                      indent=indent)
+
+
+# Options of the command line (by destination) that are about the
+# output, as opposed to where to look for the packages
+RENDER_OPTIONS = ('freeze', 'all', 'warn', 'reverse', 'packages',
+                  'exclude', 'json', 'json_lines', 'json_tree',
+                  'output_format', 'dedupe', 'why', 'max_paths', 'depth',
+                  'what_if')
+
+_option_defaults = {}
+_option_actions = {}
+
+
+def _render_args(options):
+    """Return the parsed command line options with the given values of
+    `RENDER_OPTIONS` and the defaults for the others
+
+    The values are checked (and converted if given as strings) the
+    same way as on the command line eg. `depth='1'` is the same as
+    `depth=1` and `what_if` can be given as 'PACKAGE==VERSION'.
+
+    :param dict options: destination -> value
+    :rtype: argparse.Namespace
+    :raises TypeError: if an option is not one of `RENDER_OPTIONS`
+    :raises ValueError: if the value of an option is not valid
+
+    """
+    unknown = set(options).difference(RENDER_OPTIONS)
+    if unknown:
+        raise TypeError('Unknown options: {0}'.format(
+            ', '.join(sorted(unknown))))
+    if not _option_defaults:
+        parser = get_parser()
+        _option_actions.update((a.dest, a) for a in parser._actions)
+        _option_defaults.update(vars(parser.parse_args([])))
+    args = argparse.Namespace(**_option_defaults)
+    for option, value in options.items():
+        action = _option_actions[option]
+        if (action.type is not None and not isinstance(value, bool) and
+                isinstance(value, (str, int))):
+            try:
+                value = action.type(str(value))
+            except (argparse.ArgumentTypeError, TypeError, ValueError) as e:
+                raise ValueError('Invalid value for {0}: {1}'.format(option,
+                                                                     e))
+        if action.choices is not None and value not in action.choices:
+            raise ValueError('Invalid value for {0}: {1!r} (choose from '
+                             '{2})'.format(option, value, ', '.join(
+                                 map(repr, action.choices))))
+        setattr(args, option, value)
+    return args
+
+
+def render(tree, out=None, err=None, **options):
+    """Render the DAG as the command line does with the given options
+
+    Eg. ``render(tree, reverse=True, packages='requests', json=True)``
+    returns the output of ``pipdeptree -r -p requests --json``.
+
+    :param PackageDAG tree: the dependency DAG (refer `load`)
+    :param out: file like object to write the output to (default:
+                return it as a string)
+    :param err: file like object to write the warnings to (default:
+                don't look for anything to warn about)
+    :param options: values of any of the `RENDER_OPTIONS` (refer
+                    `get_parser` for their meaning). The GraphViz
+                    formats other than `dot` need an `out` with a file
+                    descriptor.
+    :returns: the output if `out` is None
+    :rtype: str
+    :raises TypeError: if an option is not one of `RENDER_OPTIONS`
+    :raises ValueError: if the value of an option is not valid
+
+    """
+    args = _render_args(options)
+    if err is None:
+        # No need to look for anything to warn about
+        args.warn = 'silence'
+    stream = StringIO() if out is None else out
+    _render(tree, args, out=stream, err=err or StringIO())
+    if out is None:
+        return stream.getvalue()
+
+
+class Daemon(object):
+    """Keeps the dependency DAG of the environment in memory and up to
+    date, to answer queries without looking up the installed packages
+    every time (refer `serve`)
+
+    The directories are scanned like the `scan` backend does. They are
+    polled for changes by looking at their mtime, which changes
+    whenever a distribution is installed, upgraded or removed, and only
+    the metadata of the distributions that have changed is read again.
+
+      :param list locations: directories to look for distributions in,
+                             in order of precedence
+      :param bool guess_by_import: refer `VersionResolver`
+    """
+
+    def __init__(self, locations, guess_by_import=False):
+        self.locations = list(locations)
+        self.guess_by_import = guess_by_import
+        self.tree = None
+        self._mtimes = {}
+        # location -> {entry: (stamp, dist)}
+        self._entries = {}
+        self.refresh()
+
+    def refresh(self):
+        """Scan the directories that have changed since the last call
+        again and update the DAG if any distribution has changed
+
+        Only the changed distributions are applied to the DAG (refer
+        `PackageDAG.apply`), it's not built from scratch again.
+
+        :returns: whether the DAG was updated
+        :rtype: bool
+
+        """
+        if _frozen_reprs:
+            # The frozen representations are not kept beyond a query,
+            # as the VCS revision of an editable install can change
+            # without it's metadata
+            for entries in self._entries.values():
+                for _, dist in entries.values():
+                    _frozen_reprs.pop(dist, None)
+        previous = dict(self._entries)
+        changed = False
+        for location in self.locations:
+            try:
+                mtime = os.stat(location).st_mtime
+            except OSError:
+                mtime = None
+            if location not in self._mtimes or mtime != self._mtimes[location]:
+                self._mtimes[location] = mtime
+                changed = self._scan(location) or changed
+        if self.tree is None:
+            self.tree = PackageDAG.from_pkgs(
+                self.distributions(), guess_by_import=self.guess_by_import)
+            return True
+        if not changed:
+            return False
+        old = dict((d.key, d) for d in self._distributions(previous))
+        dists = self.distributions()
+        added = [d for d in dists if old.get(d.key) is not d]
+        keys = set(d.key for d in dists)
+        removed = [key for key in old if key not in keys]
+        if not (added or removed):
+            # eg. only a shadowed distribution has changed
+            return False
+        self.tree = self.tree.apply(added=added, removed=removed)
+        return True
+
+    def _scan(self, location):
+        old = self._entries.get(location, {})
+        new = MetadataScanBackend.rescan_dir(location, old)
+        self._entries[location] = new
+        return new != old
+
+    def distributions(self):
+        """Return the distributions found in the directories (refer
+        `MetadataScanBackend.scan_dirs`)
+
+        :rtype: list
+
+        """
+        return self._distributions(self._entries)
+
+    def _distributions(self, entries):
+        return _unshadowed(dist for location in self.locations
+                           for _, dist in entries.get(location, {}).values())
+
+    def query(self, options):
+        """Answer a query
+
+        :param dict options: the command line options (refer
+                             `get_parser`) as a dict of destination ->
+                             value. Only the `RENDER_OPTIONS` are
+                             considered. With `output_format`, the DOT
+                             source is returned whatever the format.
+        :returns: dict with the `output`, the `errors` (ie. warnings)
+                  and the `return_code` the command line would have
+        :rtype: dict
+
+        """
+        self.refresh()
+        args = _render_args(dict((k, v) for k, v in options.items()
+                                 if k in RENDER_OPTIONS))
+        if args.output_format:
+            args.output_format = 'dot'
+        out, err = StringIO(), StringIO()
+        return_code = _render(self.tree, args, out=out, err=err)
+        return {'output': out.getvalue(),
+                'errors': err.getvalue(),
+                'return_code': return_code}
+
+
+def serve(socket_path, daemon, poll_interval=1.0):
+    """Answer queries for a Daemon on a Unix domain socket until
+    interrupted
+
+    Every connection carries a single request, which is a json object
+    (on a single line) with the options of the query (refer
+    `Daemon.query`), and gets back a json object with the result or
+    with an `error`. The socket is only accessible to the current user.
+
+    :param str socket_path: path of the socket
+    :param Daemon daemon: the daemon
+    :param float poll_interval: seconds after which the directories
+                                are checked for changes, if there are
+                                no queries in the meantime
+    :returns: None
+
+    """
+    import socket
+    import stat
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except OSError:
+        mode = None
+    if mode is not None:
+        if not stat.S_ISSOCK(mode):
+            raise IOError(errno.EEXIST, 'File exists and is not a socket',
+                          socket_path)
+        # Reuse the socket of a daemon that's no longer running
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except (IOError, OSError):
+            os.remove(socket_path)
+        else:
+            raise IOError(errno.EADDRINUSE,
+                          'A daemon is already listening', socket_path)
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+    st = os.lstat(socket_path)
+    bound = (st.st_dev, st.st_ino)
+    try:
+        server.listen(16)
+        server.settimeout(poll_interval)
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                daemon.refresh()
+                continue
+            try:
+                conn.settimeout(10)
+                request = conn.makefile('rb').readline()
+                try:
+                    response = daemon.query(json.loads(request.decode('utf-8')))
+                except Exception as e:
+                    response = {'error': '{0}: {1}'.format(
+                        e.__class__.__name__, e)}
+                conn.sendall(json.dumps(response).encode('utf-8') + b'\n')
+            except (IOError, OSError):
+                # The client went away, nothing to do about it
+                pass
+            finally:
+                conn.close()
+    finally:
+        server.close()
+        # Unless it has been replaced in the meantime
+        try:
+            st = os.lstat(socket_path)
+        except OSError:
+            pass
+        else:
+            if (st.st_dev, st.st_ino) == bound and stat.S_ISSOCK(st.st_mode):
+                os.remove(socket_path)
+
+
+def query_daemon(socket_path, options):
+    """Send a query to a daemon (refer `serve`)
+
+    :param str socket_path: path of the socket the daemon listens on
+    :param dict options: options of the query (refer `Daemon.query`)
+    :returns: the response
+    :rtype: dict
+
+    """
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(options).encode('utf-8') + b'\n')
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    return json.loads(b''.join(chunks).decode('utf-8'))
 
 
 def get_parser():
@@ -731,7 +3637,9 @@ def get_parser():
                             '"silence" will not show warnings at all and '
                             'always return 0. "fail" will show warnings and '
                             'return 1 if any are present. The default is '
-                            '"suppress".'
+                            '"suppress". With --packages, "suppress" only '
+                            'warns about the selected packages and their '
+                            'dependencies, while "fail" checks all of them.'
                         ))
     parser.add_argument('-r', '--reverse', action='store_true',
                         default=False, help=(
@@ -755,11 +3663,19 @@ def get_parser():
                             '"raw" output that may be used by external tools. '
                             'This option overrides all other options.'
                         ))
+    parser.add_argument('--json-lines', action='store_true', default=False,
+                        help=(
+                            'Same as --json but output one json object per '
+                            'package on separate lines (newline delimited '
+                            'json) as it\'s generated. This option overrides '
+                            'all other options (except --json).'
+                        ))
     parser.add_argument('--json-tree', action='store_true', default=False,
                         help=(
                             'Display dependency tree as json which is nested '
                             'the same way as the plain text output printed by default. '
-                            'This option overrides all other options (except --json).'
+                            'This option overrides all other options (except '
+                            '--json and --json-lines).'
                         ))
     parser.add_argument('--graph-output', dest='output_format',
                         help=(
@@ -767,9 +3683,124 @@ def get_parser():
                             'format. Available are all formats supported by '
                             'GraphViz, e.g.: dot, jpeg, pdf, png, svg'
                         ))
+    parser.add_argument('--backend', choices=list(BACKENDS), default='pip',
+                        help=(
+                            'Strategy to find the installed packages. "pip" '
+                            '(default) uses pip\'s internal API, "scan" reads '
+                            'the metadata files on sys.path directly and '
+                            '"importlib" uses importlib.metadata. The last two '
+                            'are a lot faster in large environments but don\'t '
+                            'find packages installed as eggs.'
+                        ))
+    parser.add_argument('--cache', action='store_true', default=False,
+                        help=(
+                            'Cache the parsed metadata in '
+                            '$XDG_CACHE_HOME/pipdeptree so that subsequent '
+                            'runs only parse the packages that have changed. '
+                            'Only used with --backend scan and --env.'
+                        ))
+    parser.add_argument('--dedupe', action='store_true', default=False,
+                        help=(
+                            'Show the dependencies of a package only the '
+                            'first time it appears in the text or --json-tree '
+                            'output. Later occurrences refer back to it.'
+                        ))
+    parser.add_argument('--guess-by-import', action='store_true',
+                        default=False, help=(
+                            'If the installed version of a dependency can\'t '
+                            'be found in the metadata, guess it by importing '
+                            'the package and reading it\'s __version__. '
+                            'Importing packages may have side effects.'
+                        ))
+    parser.add_argument('--why', metavar='PACKAGE', help=(
+                            'Show why a package is installed ie. the '
+                            'shortest chain of dependencies leading to it '
+                            'from every top level package that needs it. '
+                            'Overrides --packages, --reverse and the output '
+                            'options except --json.'
+                        ))
+    parser.add_argument('--max-paths', type=_non_negative_int, metavar='N', help=(
+                            'Show at most N (the shortest) paths with '
+                            '--why'
+                        ))
+    parser.add_argument('--depth', type=_non_negative_int, metavar='N', help=(
+                            'Show the dependencies only up to N levels '
+                            'below the top level packages (or the ones '
+                            'specified with --packages). Works with all '
+                            'output formats.'
+                        ))
+    parser.add_argument('--what-if', type=_version_bumps,
+                        metavar='PACKAGE==VERSION', help=(
+                            'Show the requirements that would no longer be '
+                            'satisfied if the package was installed in that '
+                            'version, without changing anything. Several '
+                            'packages can be specified as comma separated '
+                            'values. Exits with status 1 if any requirement '
+                            'would break. Overrides --packages, --reverse '
+                            'and the output options except --json.'
+                        ))
+    parser.add_argument('--env', action='append', metavar='PATH', help=(
+                            'Show the packages installed in the virtualenv '
+                            '(or site-packages directory) at PATH instead '
+                            'of the current environment. Can be repeated, '
+                            'in which case the environments are scanned in '
+                            'parallel and the output of every one is listed '
+                            'under it\'s path. Only the text and --json '
+                            'output formats are supported.'
+                        ))
+    parser.add_argument('--wheelhouse', metavar='DIR', help=(
+                            'Show the dependencies of the wheels (.whl '
+                            'files) in DIR instead of the installed '
+                            'packages. If there are several versions of a '
+                            'package, the highest one is used.'
+                        ))
+    parser.add_argument('--tarball', metavar='FILE', help=(
+                            'Show the packages installed in a tar archive '
+                            '(optionally compressed) instead of the current '
+                            'environment, eg. a container image layer or '
+                            'the output of "docker export". Use "-" to read '
+                            'the archive from stdin.'
+                        ))
+    parser.add_argument('--serve', metavar='SOCKET', help=(
+                            'Run as a daemon that keeps the dependency tree '
+                            'in memory, updated as packages are installed '
+                            'or removed, and answers queries made with '
+                            '--connect on the Unix domain socket SOCKET. '
+                            'The packages are always found like with '
+                            '--backend scan.'
+                        ))
+    parser.add_argument('--connect', metavar='SOCKET', help=(
+                            'Get the output from the daemon listening on '
+                            'SOCKET (refer --serve) instead of looking up '
+                            'the installed packages. The options about '
+                            'where to find the packages are the ones the '
+                            'daemon was started with.'
+                        ))
     return parser
 
 
+def _non_negative_int(s):
+    try:
+        value = int(s)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise argparse.ArgumentTypeError(
+            'must be a non-negative integer: {0!r}'.format(s))
+    return value
+
+
+def _version_bumps(s):
+    bumps = []
+    for item in s.split(','):
+        name, sep, version = item.partition('==')
+        if not sep or not name.strip() or not version.strip():
+            raise argparse.ArgumentTypeError(
+                'must be comma separated PACKAGE==VERSION: {0!r}'.format(s))
+        bumps.append((_safe_name(name.strip()).lower(), version.strip()))
+    return bumps
+
+
 def _get_args():
     parser = get_parser()
     return parser.parse_args()
@@ -778,12 +3809,100 @@ def _get_args():
 def main():
     args = _get_args()
 
-    pkgs = get_installed_distributions(local_only=args.local_only,
-                                       user_only=args.user_only)
+    if args.serve:
+        return _main_serve(args)
+    if args.connect:
+        return _main_connect(args)
+
+    cache = MetadataCache() if args.cache else None
+    if args.env:
+        return _main_environments(args, cache)
+
+    if args.cache and (args.wheelhouse or args.tarball or
+                       args.backend != 'scan'):
+        print('Warning: --cache is ignored, it is only used with '
+              '--backend scan and --env', file=sys.stderr)
+
+    if args.wheelhouse:
+        if not os.path.isdir(args.wheelhouse):
+            print('{0} is not a directory'.format(args.wheelhouse),
+                  file=sys.stderr)
+            return 1
+        pkgs = scan_wheelhouse(args.wheelhouse)
+        # The dependencies missing in the wheelhouse (or the tarball)
+        # are missing, whether installed in the current environment or
+        # not
+        resolver = VersionResolver(paths=[])
+    elif args.tarball:
+        import tarfile
+        try:
+            if args.tarball == '-':
+                stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+                pkgs = scan_tarball(fileobj=stdin)
+            else:
+                pkgs = scan_tarball(args.tarball)
+        except (IOError, OSError, tarfile.TarError) as e:
+            print('Unable to read {0}: {1}'.format(args.tarball, e),
+                  file=sys.stderr)
+            return 1
+        resolver = VersionResolver(paths=[])
+    else:
+        pkgs = discover_distributions(backend=args.backend,
+                                      local_only=args.local_only,
+                                      user_only=args.user_only,
+                                      cache=cache)
+        resolver = VersionResolver(args.guess_by_import)
+
+    show_only = set(args.packages.split(',')) if args.packages else None
+    exclude = set(args.exclude.split(',')) if args.exclude else None
+
+    # With --packages, only the selected packages and their
+    # dependencies need to be looked at. That's not the case with
+    # --reverse, as the packages depending on the selected ones can
+    # only be found by going through all of them.
+    # With --warn fail, the warnings have to cover all the packages.
+    is_lazy = show_only is not None and not (args.reverse or args.why or
+                                             args.what_if or
+                                             args.warn == 'fail')
+    tree = PackageDAG.from_pkgs(pkgs, include=show_only if is_lazy else None,
+                                exclude=exclude if is_lazy else None,
+                                max_depth=(_max_depth(args) if is_lazy
+                                           else None),
+                                resolver=resolver)
+
+    try:
+        return_code = _render(tree, args, total=len(pkgs) if is_lazy else None)
+        sys.stdout.flush()
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        _discard_stdout()
+        return 1
+
+    return return_code
+
+
+def _render(tree, args, out=None, err=None, total=None):
+    """Render the tree as per the command line options
+
+    :param PackageDAG tree: the dependency tree
+    :param args: parsed command line options
+    :param out: file like object for the output (default: sys.stdout)
+    :param err: file like object for the warnings (default: sys.stderr)
+    :param int total: no. of installed distributions, if the tree was
+                      built lazily from some of them (refer
+                      `PackageDAG.from_pkgs`)
+    :returns: the return code
+    :rtype: int
 
-    tree = PackageDAG.from_pkgs(pkgs)
+    """
+    out = out or sys.stdout
+    err = err or sys.stderr
+    show_only = set(args.packages.split(',')) if args.packages else None
+    exclude = set(args.exclude.split(',')) if args.exclude else None
 
-    is_text_output = not any([args.json, args.json_tree, args.output_format])
+    is_text_output = _is_text_output(args)
+    max_depth = _max_depth(args)
 
     return_code = 0
 
@@ -791,44 +3910,207 @@ def main():
     # about possibly conflicting or cyclic deps if found and warnings
     # are enabled (ie. only if output is to be printed to console)
     if is_text_output and args.warn != 'silence':
-        conflicts = conflicting_deps(tree)
-        if conflicts:
-            render_conflicts_text(conflicts)
-            print('-'*72, file=sys.stderr)
-
-        cycles = cyclic_deps(tree)
-        if cycles:
-            render_cycles_text(cycles)
-            print('-'*72, file=sys.stderr)
+        if total is not None:
+            # Note that the warnings then only cover the selected
+            # packages and their dependencies
+            print('Looked up {0} of {1} installed distributions'.format(
+                len(tree), total), file=err)
 
-        if args.warn == 'fail' and (conflicts or cycles):
+        if _print_warnings(tree, out=err) and args.warn == 'fail':
             return_code = 1
 
-    # Reverse the tree (if applicable) before filtering, thus ensuring
-    # that the filter will be applied on ReverseTree
+    if args.why:
+        if tree.get_node_as_parent(args.why.lower()) is None:
+            print('{0} is not installed'.format(args.why), file=err)
+            return 1
+        paths = tree.paths_to(args.why.lower(), max_paths=args.max_paths)
+        if args.json:
+            print(render_paths_json(paths, indent=4), file=out)
+        else:
+            render_paths_text(paths, out=out)
+        return return_code
+
+    if args.what_if:
+        conflicts = what_if_conflicts(tree, args.what_if)
+        if args.json:
+            print(render_json(conflicts, indent=4), file=out)
+        else:
+            render_what_if_text(conflicts, out=out)
+        return 1 if conflicts else return_code
+
+    # Reverse the tree (if applicable) before filtering, thus
+    # ensuring that the filter will be applied on ReverseTree
     if args.reverse:
         tree = tree.reverse()
 
-    show_only = set(args.packages.split(',')) if args.packages else None
-    exclude = set(args.exclude.split(',')) if args.exclude else None
-
-    if show_only is not None or exclude is not None:
-        tree = tree.filter(show_only, exclude)
+    if (show_only is not None or exclude is not None or
+            max_depth is not None):
+        tree = tree.filter(show_only, exclude, max_depth)
 
     if args.json:
-        print(render_json(tree, indent=4))
+        print(render_json(tree, indent=4), file=out)
+    elif args.json_lines:
+        render_json_lines(tree, out=out)
     elif args.json_tree:
-        print(render_json_tree(tree, indent=4))
+        print(render_json_tree(tree, indent=4, dedupe=args.dedupe,
+                               max_depth=args.depth), file=out)
     elif args.output_format:
-        output = dump_graphviz(tree,
-                               output_format=args.output_format,
-                               is_reverse=args.reverse)
-        print_graphviz(output)
+        render_graphviz(tree, output_format=args.output_format,
+                        is_reverse=args.reverse, out=out)
     else:
-        render_text(tree, args.all, args.freeze)
+        if args.freeze:
+            prefetch_frozen_reprs(d for d in tree._graph.dists
+                                  if d is not None)
+        render_text(tree, args.all, args.freeze, out=out, dedupe=args.dedupe,
+                    max_depth=args.depth)
+    return return_code
+
+
+def _is_text_output(args):
+    return not any([args.json, args.json_lines, args.json_tree,
+                    args.output_format])
+
+
+def _max_depth(args):
+    """Return the depth up to which the DAG is to be kept for the
+    output as per the command line options"""
+    # The text output with --all lists every package at the top level,
+    # so the deeper ones can't be pruned from the DAG
+    return None if _is_text_output(args) and args.all else args.depth
+
+
+def _print_warnings(tree, location=None, out=None):
+    """Print the possibly conflicting and cyclic deps in the tree
+
+    :param PackageDAG tree: the dependency tree
+    :param str location: environment to mention in the warnings
+    :param out: file like object to write to (default: sys.stderr)
+    :returns: whether there was anything to warn about
+    :rtype: bool
+
+    """
+    out = out or sys.stderr
+    conflicts = tree.conflicts()
+    cycles = cyclic_deps(tree)
+    if location is not None and (conflicts or cycles):
+        print('In {0}:'.format(location), file=out)
+    if conflicts:
+        render_conflicts_text(conflicts, out=out)
+        print('-'*72, file=out)
+    if cycles:
+        render_cycles_text(cycles, out=out)
+        print('-'*72, file=out)
+    return bool(conflicts or cycles)
+
+
+def _discard_stdout():
+    # stdout was closed before all the output could be written
+    # (eg. `pipdeptree | head`). Point it to devnull so that
+    # python doesn't fail again when flushing it at exit.
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+
+
+def _main_environments(args, cache):
+    unsupported = [option for option, value in (
+        ('--json-lines', args.json_lines), ('--json-tree', args.json_tree),
+        ('--graph-output', args.output_format), ('--why', args.why),
+        ('--what-if', args.what_if)) if value]
+    if unsupported:
+        print('--env can\'t be used with {0}'.format(', '.join(unsupported)),
+              file=sys.stderr)
+        return 1
+    for path in args.env:
+        if not os.path.isdir(path):
+            print('{0} is not a directory'.format(path), file=sys.stderr)
+            return 1
+    trees = scan_environments(args.env, cache=cache)
+
+    show_only = set(args.packages.split(',')) if args.packages else None
+    exclude = set(args.exclude.split(',')) if args.exclude else None
+    max_depth = _max_depth(args)
+
+    return_code = 0
+    for path, tree in trees.items():
+        if not args.json and args.warn != 'silence':
+            if _print_warnings(tree, path) and args.warn == 'fail':
+                return_code = 1
+        if args.reverse:
+            tree = tree.reverse()
+        if (show_only is not None or exclude is not None or
+                max_depth is not None):
+            tree = tree.filter(show_only, exclude, max_depth)
+        trees[path] = tree
+
+    try:
+        if args.json:
+            print(render_json_environments(trees, indent=4))
+        else:
+            if args.freeze:
+                prefetch_frozen_reprs(d for tree in trees.values()
+                                      for d in tree._graph.dists
+                                      if d is not None)
+            for path, tree in trees.items():
+                print('# {0}'.format(path))
+                render_text(tree, args.all, args.freeze, dedupe=args.dedupe,
+                            max_depth=args.depth)
+        sys.stdout.flush()
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        _discard_stdout()
+        return 1
 
     return return_code
 
 
+def _main_serve(args):
+    daemon = Daemon(_search_paths(args.local_only, args.user_only),
+                    guess_by_import=args.guess_by_import)
+    print('Serving {0} distributions on {1}'.format(len(daemon.tree),
+                                                    args.serve),
+          file=sys.stderr)
+    try:
+        serve(args.serve, daemon)
+    except KeyboardInterrupt:
+        pass
+    except (IOError, OSError) as e:
+        print('Unable to listen on {0}: {1}'.format(args.serve, e),
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+def _main_connect(args):
+    if args.output_format:
+        _check_graphviz_format(args.output_format)
+    try:
+        response = query_daemon(args.connect, vars(args))
+    except (IOError, OSError, ValueError) as e:
+        print('Unable to query the daemon on {0}: {1}'.format(args.connect, e),
+              file=sys.stderr)
+        return 1
+    if 'error' in response:
+        print('The daemon failed to answer: {0}'.format(response['error']),
+              file=sys.stderr)
+        return 1
+
+    sys.stderr.write(response['errors'])
+    try:
+        if args.output_format and args.output_format != 'dot':
+            sys.stdout.flush()
+            _pipe_dot(response['output'].splitlines(), args.output_format,
+                      stdout=sys.stdout)
+        else:
+            sys.stdout.write(response['output'])
+        sys.stdout.flush()
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        _discard_stdout()
+        return 1
+    return response['return_code']
+
+
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,563 @@
+"""Benchmarks for pipdeptree
+
+These are not part of the unit tests and need to be run manually,
+
+    $ python tests/benchmarks.py            # run all benchmarks
+    $ python tests/benchmarks.py backends   # run selected ones
+
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pipdeptree as p  # noqa: E402
+
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def report(label, seconds):
+    print('  {0:<40} {1:>10.2f} ms'.format(label, seconds * 1000))
+
+
+def make_site_dir(n):
+    """Create a site-packages like directory with `n` fake
+    distributions, each depending on the previous 3 ones
+
+    """
+    site_dir = tempfile.mkdtemp(prefix='pipdeptree-bench-')
+    for i in range(n):
+        dist_info = os.path.join(site_dir,
+                                 'pkg{0}-1.0.dist-info'.format(i))
+        os.mkdir(dist_info)
+        lines = ['Metadata-Version: 2.1',
+                 'Name: pkg{0}'.format(i),
+                 'Version: 1.0']
+        lines += ['Requires-Dist: pkg{0} (>=0.{1})'.format(j, i % 10)
+                  for j in range(max(0, i - 3), i)]
+        with open(os.path.join(dist_info, 'METADATA'), 'w') as f:
+            f.write('\n'.join(lines) + '\n\n' + 'description\n' * 200)
+    return site_dir
+
+
+def synthetic_dists(n, fanout=3):
+    """Return `n` distributions, each depending on the previous
+    `fanout` ones"""
+    return [p.MetadataDistribution(
+        'pkg{0}'.format(i), '1.0',
+        ['pkg{0}>=0.{1}'.format(j, i % 10)
+         for j in range(max(0, i - fanout), i)])
+        for i in range(n)]
+
+
+# Code timed in a fresh interpreter by the `backends` benchmark
+# because pkg_resources builds the working set only once per process
+_BACKEND_STMT = '''
+import sys, time
+sys.path[:0] = [{site_dir!r}, {repo_dir!r}]
+start = time.time()
+import pipdeptree
+pkgs = pipdeptree.discover_distributions({backend!r})
+pipdeptree.PackageDAG.from_pkgs(pkgs)
+print(time.time() - start, len(pkgs))
+'''
+
+
+@benchmark
+def backends(n=2500):
+    """Time discovering the distributions with every backend in a
+    synthetic environment of `n` packages"""
+    site_dir = make_site_dir(n)
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        for name in p.BACKENDS:
+            stmt = _BACKEND_STMT.format(site_dir=site_dir, repo_dir=repo_dir,
+                                        backend=name)
+            out = subprocess.check_output([sys.executable, '-c', stmt])
+            seconds, count = out.decode('utf-8').split()
+            report('{0} ({1} dists)'.format(name, count), float(seconds))
+    finally:
+        shutil.rmtree(site_dir)
+
+
+@benchmark
+def metadata_cache(n=2500):
+    """Time the scan backend with a cold and a warm metadata cache in a
+    synthetic environment of `n` packages"""
+    site_dir = make_site_dir(n)
+    cache_dir = tempfile.mkdtemp(prefix='pipdeptree-bench-cache-')
+    try:
+        for label in ('cold cache', 'warm cache'):
+            backend = p.MetadataScanBackend(p.MetadataCache(cache_dir))
+            start = time.time()
+            pkgs = backend.scan_dir(site_dir)
+            p.PackageDAG.from_pkgs(pkgs)
+            report('{0} ({1} dists)'.format(label, len(pkgs)),
+                   time.time() - start)
+    finally:
+        shutil.rmtree(site_dir)
+        shutil.rmtree(cache_dir)
+
+
+@benchmark
+def reverse(sizes=(10000, 50000)):
+    """Time reversing synthetic graphs of increasing size. The time per
+    node should stay roughly the same as reversal is linear"""
+    for n in sizes:
+        tree = p.PackageDAG.from_pkgs(synthetic_dists(n))
+        start = time.time()
+        tree.reverse()
+        elapsed = time.time() - start
+        report('{0} nodes ({1:.2f} us/node)'.format(n, elapsed * 1e6 / n),
+               elapsed)
+        start = time.time()
+        for i in range(0, n, 10):
+            tree.get_parents('pkg{0}'.format(i))
+        report('{0} x get_parents (cached)'.format(n // 10),
+               time.time() - start)
+
+
+@benchmark
+def conflicting_deps(n=50000, sample=5000):
+    """Time finding conflicting dependencies in a synthetic graph of `n`
+    nodes, compared to parsing `sample` requirements with
+    pkg_resources"""
+    from pip._vendor import pkg_resources
+    tree = p.PackageDAG.from_pkgs(synthetic_dists(n))
+    edges = list(p.flatten(tree.values()))
+
+    def per_edge(count, seconds):
+        return '{0} edges ({1:.2f} us/edge)'.format(count, seconds * 1e6 / count)
+
+    start = time.time()
+    for r in edges[:sample]:
+        req = pkg_resources.Requirement.parse(
+            '{0}{1}'.format(r.project_name, r.version_spec or ''))
+        r.installed_version not in req
+    elapsed = time.time() - start
+    report(per_edge(sample, elapsed) + ' pkg_resources', elapsed)
+
+    for label in ('cold', 'warm'):
+        start = time.time()
+        p.conflicting_deps(tree)
+        elapsed = time.time() - start
+        report(per_edge(len(edges), elapsed) + ' ' + label, elapsed)
+
+
+@benchmark
+def packages(n=3000):
+    """Time building the DAG for a single package (as with --packages)
+    from `n` synthetic distributions, completely and then filtered vs.
+    lazily"""
+    for label in ('complete + filter', 'lazy'):
+        dists = synthetic_dists(n)
+        include = set(['pkg{0}'.format(n // 100)])
+        start = time.time()
+        if label == 'lazy':
+            tree = p.PackageDAG.from_pkgs(dists, include=include)
+        else:
+            tree = p.PackageDAG.from_pkgs(dists)
+        tree = tree.filter(include, None)
+        report('{0} ({1} of {2} dists)'.format(label, len(tree), n),
+               time.time() - start)
+
+
+@benchmark
+def memory(n=20000):
+    """Memory retained by a PackageDAG of a synthetic graph of `n` nodes
+    (about 3 edges each), compared to a dict of Package instances which
+    is how the graph used to be stored"""
+    import tracemalloc
+    dists = synthetic_dists(n)
+    for d in dists:
+        d.requires()  # parse the requirements beforehand
+
+    def measure(label, fn):
+        tracemalloc.start()
+        start = time.time()
+        result = fn()
+        elapsed = time.time() - start
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        report('{0} ({1:.0f} bytes/node)'.format(label, size / n), elapsed)
+        return result
+
+    tree = measure('PackageDAG', lambda: p.PackageDAG.from_pkgs(dists))
+    measure('dict of Package instances',
+            lambda: {k: list(vs) for k, vs in tree.items()})
+
+
+@benchmark
+def graphviz_dot(n=7000):
+    """Time and peak memory of writing the DOT source of a synthetic graph
+    of `n` nodes (about 3 edges each) to /dev/null, compared to building
+    it with the graphviz package"""
+    import tracemalloc
+    tree = p.PackageDAG.from_pkgs(synthetic_dists(n))
+    edges = sum(len(deps) for deps in tree.values())
+
+    def measure(label, fn):
+        tracemalloc.start()
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report('{0} ({1} edges, peak {2:.0f} KB)'.format(
+            label, edges, peak / 1e3), elapsed)
+
+    try:
+        from graphviz import Digraph
+    except ImportError:
+        pass
+    else:
+        def with_graphviz():
+            graph = Digraph(format='dot')
+            for pkg, deps in tree.items():
+                graph.node(pkg.key, label=pkg.project_name)
+                for dep in deps:
+                    graph.edge(pkg.key, dep.key, label=dep.version_spec)
+            with open(os.devnull, 'w') as f:
+                f.write(graph.source)
+        measure('graphviz package', with_graphviz)
+
+    def native():
+        with open(os.devnull, 'w') as f:
+            p.render_graphviz(tree, output_format='dot', out=f)
+    measure('native', native)
+
+
+@benchmark
+def reachability(n=5000, queries=200):
+    """Time answering `queries` "does A depend on B" questions about a
+    synthetic graph of `n` nodes with repeated calls to filter vs. the
+    reachability index (including the time to build it)"""
+    import random
+    rand = random.Random(0)
+    tree = p.PackageDAG.from_pkgs(synthetic_dists(n, fanout=2))
+    pairs = [('pkg{0}'.format(rand.randrange(n)),
+              'pkg{0}'.format(rand.randrange(n))) for _ in range(queries)]
+
+    start = time.time()
+    expected = [any(b in (d.key for d in deps)
+                    for deps in tree.filter(set([a]), None).values())
+                for a, b in pairs]
+    report('{0} x filter'.format(queries), time.time() - start)
+
+    start = time.time()
+    tree.reachability()
+    report('build index', time.time() - start)
+    start = time.time()
+    assert [tree.depends_on(a, b) for a, b in pairs] == expected
+    report('{0} x depends_on'.format(queries), time.time() - start)
+
+
+@benchmark
+def environments(envs=8, n=1500):
+    """Time scanning `envs` synthetic environments of `n` packages each
+    sequentially vs. in a process pool"""
+    import multiprocessing
+    site_dirs = [make_site_dir(n) for _ in range(envs)]
+    try:
+        for label, processes in (('sequential', 1),
+                                 ('pool', max(2, multiprocessing.cpu_count()))):
+            start = time.time()
+            p.scan_environments(site_dirs, processes=processes)
+            report('{0} ({1} processes)'.format(label, processes),
+                   time.time() - start)
+    finally:
+        for site_dir in site_dirs:
+            shutil.rmtree(site_dir)
+
+
+@benchmark
+def wheelhouse(n=1000):
+    """Time reading the metadata of `n` synthetic wheels with a single
+    thread vs. the default thread pool"""
+    import zipfile
+    directory = tempfile.mkdtemp(prefix='pipdeptree-bench-wheels-')
+    try:
+        for dist in synthetic_dists(n):
+            path = os.path.join(directory, '{0}-1.0-py3-none-any.whl'.format(
+                dist.project_name))
+            lines = ['Metadata-Version: 2.1',
+                     'Name: {0}'.format(dist.project_name),
+                     'Version: 1.0']
+            lines += ['Requires-Dist: {0}'.format(r)
+                      for r in dist.requires_dist]
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as whl:
+                for i in range(20):
+                    whl.writestr('{0}/mod{1}.py'.format(dist.key, i),
+                                 'x = 1\n' * 1000)
+                whl.writestr('{0}-1.0.dist-info/METADATA'.format(
+                    dist.project_name),
+                    '\n'.join(lines) + '\n\n' + 'description\n' * 200)
+        for label, threads in (('1 thread', 1), ('thread pool', None)):
+            start = time.time()
+            pkgs = p.scan_wheelhouse(directory, threads=threads)
+            p.PackageDAG.from_pkgs(pkgs)
+            report('{0} ({1} wheels)'.format(label, len(pkgs)),
+                   time.time() - start)
+    finally:
+        shutil.rmtree(directory)
+
+
+@benchmark
+def tarball(n=2000, filler_mb=200):
+    """Time and peak memory of scanning a synthetic tar.gz image layer
+    with `n` packages and `filler_mb` MB of other files"""
+    import io
+    import tarfile
+    import tracemalloc
+    fd, path = tempfile.mkstemp(prefix='pipdeptree-bench-', suffix='.tar.gz')
+    os.close(fd)
+    site = 'usr/lib/python3.8/site-packages'
+    try:
+        with tarfile.open(path, 'w:gz') as tar:
+            def add(name, data):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            filler = os.urandom(1024 * 1024)
+            for i in range(filler_mb):
+                add('{0}/big/blob{1}.so'.format(site, i), filler)
+            for dist in synthetic_dists(n):
+                lines = ['Metadata-Version: 2.1',
+                         'Name: {0}'.format(dist.project_name),
+                         'Version: 1.0']
+                lines += ['Requires-Dist: {0}'.format(r)
+                          for r in dist.requires_dist]
+                add('{0}/{1}-1.0.dist-info/METADATA'.format(
+                    site, dist.project_name),
+                    ('\n'.join(lines) + '\n\n' +
+                     'description\n' * 200).encode('utf-8'))
+        tracemalloc.start()
+        start = time.time()
+        pkgs = p.scan_tarball(path)
+        p.PackageDAG.from_pkgs(pkgs)
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report('{0} dists, {1:.0f} MB archive (peak {2:.1f} MB)'.format(
+            len(pkgs), os.path.getsize(path) / 1e6, peak / 1e6), elapsed)
+    finally:
+        os.remove(path)
+
+
+@benchmark
+def freeze(n=15, vcs_ms=50):
+    """Time the --freeze text output of a synthetic graph of `n`
+    editable packages (each depending on the previous 2, so that they
+    appear many times in the tree), for which pip takes `vcs_ms` ms to
+    probe the VCS checkout, with and without computing the frozen reprs
+    in a thread pool first"""
+    import io
+
+    calls = []
+
+    def frozen_req_from_dist(dist):
+        calls.append(dist)
+        time.sleep(vcs_ms / 1000.0)
+        return '-e git+https://example.com/{0}.git@abc#egg={0}'.format(
+            dist.project_name)
+
+    original = p.frozen_req_from_dist
+    p.frozen_req_from_dist = frozen_req_from_dist
+    try:
+        tree = p.PackageDAG.from_pkgs(synthetic_dists(n, fanout=2))
+        for label in ('sequential', 'prefetch'):
+            p._frozen_reprs.clear()
+            del calls[:]
+            out = io.StringIO()
+            start = time.time()
+            if label == 'prefetch':
+                p.prefetch_frozen_reprs(tree._graph.dists)
+            p.render_text(tree, list_all=False, frozen=True, out=out)
+            report('{0} ({1} lines, {2} probes)'.format(
+                label, out.getvalue().count('\n'), len(calls)),
+                time.time() - start)
+    finally:
+        p.frozen_req_from_dist = original
+
+
+_QUERY_STMT = '''
+import sys
+sys.path[:0] = [{site_dir!r}, {repo_dir!r}]
+sys.argv = ['pipdeptree', '--backend', 'scan', '-w', 'silence', '-r',
+            '-p', 'pkg10', '--depth', '1']
+import pipdeptree
+pipdeptree.main()
+'''
+
+
+@benchmark
+def daemon(n=2500, queries=20):
+    """Time answering `queries` queries (direct reverse deps of a
+    package) about a synthetic environment of `n` packages with a new process
+    every time vs. a warm daemon"""
+    import threading
+    site_dir = make_site_dir(n)
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    socket_path = os.path.join(site_dir, 'pipdeptree.sock')
+    options = {'warn': 'silence', 'reverse': True, 'packages': 'pkg10',
+               'depth': 1}
+    try:
+        stmt = _QUERY_STMT.format(site_dir=site_dir, repo_dir=repo_dir)
+        start = time.time()
+        for _ in range(queries):
+            subprocess.check_output([sys.executable, '-c', stmt])
+        report('{0} x new process'.format(queries), time.time() - start)
+
+        start = time.time()
+        d = p.Daemon([site_dir])
+        report('start daemon', time.time() - start)
+        thread = threading.Thread(target=p.serve, args=(socket_path, d))
+        thread.daemon = True
+        thread.start()
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        start = time.time()
+        for _ in range(queries):
+            p.query_daemon(socket_path, options)
+        report('{0} x query daemon'.format(queries), time.time() - start)
+    finally:
+        shutil.rmtree(site_dir)
+
+
+@benchmark
+def apply(n=5000, steps=50):
+    """Time checking the conflicts and cycles after every step of an
+    install plan of `steps` upgrades in a synthetic graph of `n` nodes
+    by rebuilding the DAG vs. applying the changes incrementally"""
+    import random
+    rand = random.Random(0)
+    pkgs = synthetic_dists(n)
+    # every upgrade requires other (random) packages it can't be a
+    # dependency of, so the graph stays acyclic
+    plan = [p.MetadataDistribution(
+        'pkg{0}'.format(i), '2.0',
+        ['pkg{0}'.format(rand.randrange(i)) for _ in range(3)])
+        for i in rand.sample(range(1, n), steps)]
+
+    start = time.time()
+    idx = OrderedDict((dist.key, dist) for dist in pkgs)
+    for dist in plan:
+        idx[dist.key] = dist
+        tree = p.PackageDAG.from_pkgs(list(idx.values()))
+        expected = (len(tree.conflicts()), len(tree.cycles()))
+    report('{0} x from_pkgs'.format(steps), time.time() - start)
+
+    tree = p.PackageDAG.from_pkgs(pkgs)
+    tree.conflicts()
+    tree.cycles()
+    start = time.time()
+    for dist in plan:
+        tree = tree.apply(upgraded=[dist])
+        result = (len(tree.conflicts()), len(tree.cycles()))
+    report('{0} x apply'.format(steps), time.time() - start)
+    assert expected == result
+
+
+@benchmark
+def api(n=2500, queries=20, threads=4):
+    """Time answering `queries` queries (direct reverse deps of a
+    package) about a synthetic environment of `n` packages with a new
+    process every time vs. rendering a DAG loaded once, from
+    `threads` threads"""
+    import threading
+    site_dir = make_site_dir(n)
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        stmt = _QUERY_STMT.format(site_dir=site_dir, repo_dir=repo_dir)
+        start = time.time()
+        for _ in range(queries):
+            expected = subprocess.check_output([sys.executable, '-c', stmt])
+        report('{0} x new process'.format(queries), time.time() - start)
+
+        start = time.time()
+        tree = p.load(paths=[site_dir])
+        report('load', time.time() - start)
+        outputs = []
+
+        def worker():
+            for _ in range(queries // threads):
+                outputs.append(p.render(tree, warn='silence', reverse=True,
+                                        packages='pkg10', depth=1))
+        start = time.time()
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        report('{0} x render ({1} threads)'.format(len(outputs), threads),
+               time.time() - start)
+        assert all(o == expected.decode('utf-8') for o in outputs)
+    finally:
+        shutil.rmtree(site_dir)
+
+
+@benchmark
+def what_if(n=5000, bumps=50):
+    """Time finding the requirements broken by each of `bumps` version
+    bumps in a synthetic graph of `n` nodes by rebuilding the DAG with
+    the new version vs. checking the reverse dependencies only"""
+    import random
+    rand = random.Random(0)
+    pkgs = synthetic_dists(n)
+    keys = ['pkg{0}'.format(rand.randrange(n)) for _ in range(bumps)]
+
+    start = time.time()
+    expected = []
+    before = set((k.key, r.key) for k, rs in
+                 p.conflicting_deps(p.PackageDAG.from_pkgs(pkgs)).items()
+                 for r in rs)
+    for key in keys:
+        changed = [p.MetadataDistribution(d.project_name, '0.0',
+                                          d.requires_dist)
+                   if d.key == key else d for d in pkgs]
+        conflicts = p.conflicting_deps(p.PackageDAG.from_pkgs(changed))
+        expected.append(sorted(
+            (k.key, r.key) for k, rs in conflicts.items() for r in rs
+            if (k.key, r.key) not in before))
+    report('{0} x from_pkgs'.format(bumps), time.time() - start)
+
+    tree = p.PackageDAG.from_pkgs(pkgs)
+    start = time.time()
+    result = []
+    for key in keys:
+        conflicts = p.what_if_conflicts(tree, [(key, '0.0')])
+        result.append(sorted((k.key, r.key) for k, rs in conflicts.items()
+                             for r in rs))
+    report('{0} x what_if_conflicts'.format(bumps), time.time() - start)
+    assert expected == result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run pipdeptree benchmarks')
+    parser.add_argument('names', nargs='*', metavar='NAME',
+                        help='benchmarks to run, one of {0} (default: all)'
+                        .format(', '.join(BENCHMARKS)))
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: {0}'.format(', '.join(unknown)))
+    for name in args.names or BENCHMARKS:
+        print('{0}: {1}'.format(name, ' '.join(BENCHMARKS[name].__doc__.split())))
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,8 @@
 from contextlib import contextmanager
+import io
+import json
+import os
+import subprocess
 import sys
 from tempfile import NamedTemporaryFile
 try:
@@ -35,7 +39,7 @@ def mock_PackageDAG(simple_graph):
 
 # util for comparing tree contents with a simple graph
 def dag_to_dict(g):
-    return {k.key: [v.key for v in vs] for k, vs in g._obj.items()}
+    return {k.key: [v.key for v in vs] for k, vs in g.items()}
 
 
 def sort_map_values(m):
@@ -100,6 +104,159 @@ def test_PackageDAG_filter():
         dag_to_dict(t.filter(set(['d']), set(['D', 'e'])))
 
 
+@pytest.mark.parametrize(
+    "include,exclude",
+    [
+        (set(['a', 'd']), None),
+        (set(['B']), None),
+        (set(['a', 'g']), set(['d', 'e'])),
+        (set(['f']), set(['D'])),
+        (set(['non-existent']), None),
+    ]
+)
+def test_PackageDAG_from_pkgs_lazy(include, exclude):
+    graph = {
+        ('a', '3.4.0'): [('b', [('>=', '2.0.0')]), ('c', [('>=', '5.7.1')])],
+        ('b', '2.3.1'): [('d', [('>=', '2.30'), ('<', '2.42')])],
+        ('c', '5.10.0'): [('d', [('>=', '2.30')]), ('e', [('>=', '0.12.1')])],
+        ('d', '2.35'): [('e', [('>=', '0.9.0')]), ('x', [])],
+        ('e', '0.12.1'): [],
+        ('f', '3.1'): [('b', [('>=', '2.1.0')])],
+        ('g', '6.8.3rc1'): [('e', [('>=', '0.9.0')]), ('f', [('>=', '3.0.0')])]
+    }
+    pkgs = list(mock_pkgs(graph))
+    tree = p.PackageDAG.from_pkgs(pkgs, include=include, exclude=exclude)
+    expected = p.PackageDAG.from_pkgs(pkgs).filter(include, exclude)
+    assert dag_to_dict(expected) == dag_to_dict(tree.filter(include, exclude))
+    assert (p.render_json(expected, indent=None) ==
+            p.render_json(tree.filter(include, exclude), indent=None))
+
+
+def test_PackageDAG_from_pkgs_lazy_parses_reachable_only():
+    pkgs = list(mock_pkgs({
+        ('a', '1.0'): [('b', [])],
+        ('b', '1.0'): [],
+        ('c', '1.0'): [('a', [])],
+    }))
+    for pkg in pkgs:
+        pkg.requires.reset_mock()
+    tree = p.PackageDAG.from_pkgs(pkgs, include=set(['a']))
+    assert ['a', 'b'] == sorted(n.key for n in tree)
+    assert [1, 1, 0] == [pkg.requires.call_count for pkg in pkgs]
+
+
+def test_main_packages_is_lazy(capsys):
+    pkgs = list(mock_pkgs({
+        ('a', '1.0'): [('b', [])],
+        ('b', '1.0'): [],
+        ('c', '1.0'): [('a', [])],
+    }))
+    args = p.get_parser().parse_args(['-p', 'a'])
+    with mock.patch.object(p, '_get_args', return_value=args), \
+            mock.patch.object(p, 'discover_distributions', return_value=pkgs):
+        assert 0 == p.main()
+    out, err = capsys.readouterr()
+    assert 'a==1.0\n  - b [required: Any, installed: 1.0]\n' == out
+    assert 'Looked up 2 of 3 installed distributions' in err
+    assert not pkgs[2].requires.called
+
+    # --reverse needs all the packages
+    args = p.get_parser().parse_args(['-p', 'a', '-r'])
+    with mock.patch.object(p, '_get_args', return_value=args), \
+            mock.patch.object(p, 'discover_distributions', return_value=pkgs):
+        assert 0 == p.main()
+    out, err = capsys.readouterr()
+    assert 'a==1.0\n  - c==1.0 [requires: a]\n' == out
+    assert 'Looked up' not in err
+
+    # --warn fail checks all the packages
+    pkgs.append(next(mock_pkgs({('d', '1.0'): [('e', [])]})))
+    args = p.get_parser().parse_args(['-p', 'a', '-w', 'fail'])
+    with mock.patch.object(p, '_get_args', return_value=args), \
+            mock.patch.object(p, 'discover_distributions', return_value=pkgs):
+        assert 1 == p.main()
+    out, err = capsys.readouterr()
+    assert 'a==1.0\n  - b [required: Any, installed: 1.0]\n' == out
+    assert '* d==1.0\n - e [required: Any, installed: ?]' in err
+
+
+def test_main_packages_is_lazy_all_max_depth(capsys):
+    pkgs = list(mock_pkgs({
+        ('a', '1.0'): [('b', [])],
+        ('b', '1.0'): [('c', [])],
+        ('c', '1.0'): [('d', [])],
+        ('d', '1.0'): [],
+        ('e', '1.0'): [('a', [])],
+    }))
+    args = p.get_parser().parse_args(['-p', 'a', '--all', '--depth', '1'])
+    with mock.patch.object(p, '_get_args', return_value=args), \
+            mock.patch.object(p, 'discover_distributions', return_value=pkgs):
+        assert 0 == p.main()
+    out, _ = capsys.readouterr()
+    # same as with the complete DAG, which --warn fail builds
+    args = p.get_parser().parse_args(['-p', 'a', '--all', '--depth', '1',
+                                      '-w', 'fail'])
+    with mock.patch.object(p, '_get_args', return_value=args), \
+            mock.patch.object(p, 'discover_distributions', return_value=pkgs):
+        assert 0 == p.main()
+    out_full, _ = capsys.readouterr()
+    assert out_full == out
+    assert 'b==1.0\n  - c [required: Any, installed: 1.0]\n' in out
+
+
+def test_PackageDAG_filter_max_depth():
+    # top level packages are the roots by default
+    assert {'a': [], 'g': []} == dag_to_dict(t.filter(None, None, 0))
+    expected = {'a': ['b', 'c'],
+                'b': [],
+                'c': [],
+                'e': [],
+                'f': [],
+                'g': ['e', 'f']}
+    assert expected == dag_to_dict(t.filter(None, None, 1))
+    expected = {'c': ['d', 'e'],
+                'd': [],
+                'e': []}
+    assert expected == dag_to_dict(t.filter(set(['c']), None, 1))
+    assert {'c': ['e'], 'e': []} == dag_to_dict(t.filter(set(['c']),
+                                                          set(['d']), 1))
+    # a node is kept at it's minimum depth
+    expected = {'f': ['b'], 'g': ['e', 'f'], 'b': [], 'e': []}
+    assert expected == dag_to_dict(t.filter(set(['g', 'f']), None, 1))
+    # and the same in reverse
+    expected = {'d': ['b', 'c'], 'b': [], 'c': []}
+    assert expected == dag_to_dict(t.reverse().filter(set(['d']), None, 1))
+
+
+def test_PackageDAG_filter_max_depth_keeps_unreachable_cycles():
+    tree = mock_PackageDAG({('a', '1.0'): [('x', [])],
+                            ('b', '1.0'): [('c', [])],
+                            ('c', '1.0'): [('b', [])],
+                            ('d', '1.0'): [('d', [])],
+                            ('x', '1.0'): []})
+    expected = {'a': ['x'], 'b': ['c'], 'c': ['b'], 'd': ['d'], 'x': []}
+    assert expected == dag_to_dict(tree.filter(None, None, 5))
+    # the cycle is entered at it's first package
+    expected = {'a': [], 'b': [], 'd': []}
+    assert expected == dag_to_dict(tree.filter(None, None, 0))
+    # a cycle broken by an excluded package
+    expected = {'a': ['x'], 'c': [], 'd': ['d'], 'x': []}
+    assert expected == dag_to_dict(tree.filter(None, set(['b']), 5))
+
+
+def test_PackageDAG_from_pkgs_lazy_max_depth():
+    pkgs = list(mock_pkgs({
+        ('a', '1.0'): [('b', [])],
+        ('b', '1.0'): [('c', [])],
+        ('c', '1.0'): [],
+    }))
+    for pkg in pkgs:
+        pkg.requires.reset_mock()
+    tree = p.PackageDAG.from_pkgs(pkgs, include=set(['a']), max_depth=1)
+    assert {'a': ['b'], 'b': []} == dag_to_dict(tree)
+    assert [1, 0, 0] == [pkg.requires.call_count for pkg in pkgs]
+
+
 def test_PackageDAG_reverse():
     t1 = t.reverse()
     expected = {'a': [],
@@ -129,6 +286,274 @@ def test_PackageDAG_reverse():
     assert all([isinstance(v, p.ReqPackage) for v in p.flatten(t2.values())])
 
 
+def test_PackageDAG_reverse_is_cached():
+    t1 = t.reverse()
+    assert t1 is t.reverse()
+    assert t1.reverse() is t1.reverse()
+
+
+def test_PackageDAG_get_parents():
+    assert ['a', 'f'] == sorted(n.key for n in t.get_parents('b'))
+    assert ['c', 'd', 'g'] == sorted(n.key for n in t.get_parents('e'))
+    assert [] == t.get_parents('a')
+    assert [] == t.get_parents('non-existent')
+    assert all(isinstance(n, p.DistPackage) for n in t.get_parents('e'))
+
+    # parents in a reversed DAG are the children in the original one
+    t1 = t.reverse()
+    assert ['d', 'e'] == sorted(n.key for n in t1.get_parents('c'))
+
+
+def test_PackageDAG_reverse_twice():
+    tree = mock_PackageDAG({
+        ('a', '1.0'): [('b', [('>=', '2.0')]), ('missing', [('>=', '1.0')])],
+        ('b', '2.1'): [],
+        ('c', '1.0'): [('b', [('<', '3.0')])]
+    })
+    t2 = tree.reverse().reverse()
+    assert dag_to_dict(tree) == dag_to_dict(t2)
+    # the version specs are of the respective requirements
+    assert (p.render_json(tree.sort(), indent=None) ==
+            p.render_json(t2.sort(), indent=None))
+
+
+def test_PackageDAG_from_pkgs_duplicates():
+    pkgs = list(mock_pkgs({('a', '1.0'): [('b', [])], ('b', '1.0'): []}))
+    pkgs += list(mock_pkgs({('b', '2.0'): []}))
+    tree = p.PackageDAG.from_pkgs(iter(pkgs))
+    assert ['a', 'b'] == [n.key for n in tree]
+    assert '1.0' == tree.get_node_as_parent('b').version
+    assert '1.0' == tree.get_children('a')[0].installed_version
+
+
+def test_PackageDAG_nodes_are_compact():
+    nodes = list(t.keys()) + list(p.flatten(t.values()))
+    nodes += list(t.reverse().keys()) + list(p.flatten(t.reverse().values()))
+    for n in nodes:
+        # no instance __dict__, as the classes define __slots__
+        with pytest.raises(AttributeError):
+            n.foo = 1
+    # nodes are looked up by key
+    assert ['d'] == [c.key for c in t[t.get_node_as_parent('b')]]
+    assert len(t) == t._graph.size
+
+
+def test_CompactGraph():
+    g = t._graph
+    a = g.ids['a']
+    children = [g.keys[g.targets[e]] for e in g.edges(a)]
+    assert ['b', 'c'] == children
+    assert ['>=2.0.0', '>=5.7.1'] == [g.spec_table[g.specs[e]]
+                                      for e in g.edges(a)]
+    # the version specs are interned
+    assert len(set(g.spec_table)) == len(g.spec_table)
+    rg = t.reverse()._graph
+    assert len(g.targets) == len(rg.targets)
+    assert ['a', 'f'] == [rg.keys[rg.targets[e]]
+                          for e in rg.edges(rg.ids['b'])]
+
+
+def test_PackageDAG_paths_to():
+    def keys(paths):
+        return [[n.key for n in path] for path in paths]
+
+    assert [['a']] == keys(t.paths_to('a'))
+    assert [['a', 'b'], ['g', 'f', 'b']] == keys(t.paths_to('b'))
+    assert [['a', 'b', 'd'], ['g', 'f', 'b', 'd']] == keys(t.paths_to('d'))
+    # the shortest paths are found first
+    assert [['g', 'e']] == keys(t.paths_to('e', max_paths=1))
+    assert [] == t.paths_to('e', max_paths=0)
+    assert [] == t.paths_to('non-existent')
+
+    path = t.paths_to('d')[1]
+    assert isinstance(path[0], p.DistPackage)
+    assert all(isinstance(n, p.ReqPackage) for n in path[1:])
+    assert ['>=3.0.0', '>=2.1.0', '>=2.30,<2.42'] == [n.version_spec
+                                                      for n in path[1:]]
+
+
+def test_PackageDAG_paths_to_is_linear():
+    # every package depends on all the packages of the next layer, so
+    # the number of paths grows exponentially with the no. of layers
+    width, layers = 4, 40
+    graph = {('root', '1.0'): [('p0-{0}'.format(i), [])
+                               for i in range(width)]}
+    for layer in range(layers):
+        for i in range(width):
+            children = [('p{0}-{1}'.format(layer + 1, j), [])
+                        for j in range(width)] if layer < layers - 1 else []
+            graph[('p{0}-{1}'.format(layer, i), '1.0')] = children
+    tree = mock_PackageDAG(graph)
+    paths = tree.paths_to('p{0}-0'.format(layers - 1))
+    assert 1 == len(paths)
+    assert layers + 1 == len(paths[0])
+
+
+def test_PackageDAG_depends_on():
+    assert t.depends_on('a', 'b')
+    assert t.depends_on('a', 'e')
+    assert t.depends_on('g', 'd')
+    assert not t.depends_on('a', 'f')
+    assert not t.depends_on('e', 'a')
+    assert not t.depends_on('a', 'a')
+    assert not t.depends_on('a', 'non-existent')
+    assert not t.depends_on('non-existent', 'a')
+    assert t.reverse().depends_on('e', 'g')
+    assert not t.reverse().depends_on('g', 'e')
+
+
+def test_PackageDAG_transitive_deps():
+    assert set(['b', 'c', 'd', 'e']) == t.transitive_deps('a')
+    assert set(['b', 'd', 'e', 'f']) == t.transitive_deps('g')
+    assert set() == t.transitive_deps('e')
+    assert set() == t.transitive_deps('non-existent')
+    assert set(['a', 'b', 'c', 'd', 'f', 'g']) == \
+        t.reverse().transitive_deps('e')
+
+
+def test_PackageDAG_transitive_deps_is_same_as_filter():
+    for node in t:
+        keys = set(dep.key for deps in t.filter(set([node.key]), None).values()
+                   for dep in deps)
+        assert keys == t.transitive_deps(node.key)
+
+
+def test_PackageDAG_reachability_with_cycles():
+    tree = mock_PackageDAG({
+        ('a', '1.0'): [('b', [])],
+        ('b', '1.0'): [('c', []), ('x', [])],
+        ('c', '1.0'): [('a', []), ('d', [])],
+        ('d', '1.0'): [('d', [])],
+        ('f', '1.0'): [('a', [])]
+    })
+    assert tree.reachability() is tree.reachability()
+    # packages part of a cycle depend on themselves
+    assert tree.depends_on('a', 'a')
+    assert tree.depends_on('d', 'd')
+    assert not tree.depends_on('f', 'f')
+    # missing dependencies are included
+    assert tree.depends_on('f', 'x')
+    assert set(['a', 'b', 'c', 'd', 'x']) == tree.transitive_deps('f')
+    assert set(['a', 'b', 'c', 'd', 'x']) == tree.transitive_deps('b')
+    assert set(['d']) == tree.transitive_deps('d')
+
+
+def test_PackageDAG_conflicts_and_cycles():
+    tree = mock_PackageDAG({
+        ('a', '1.0'): [('b', [('>=', '2.0')])],
+        ('b', '1.0'): [('c', []), ('x', [])],
+        ('c', '1.0'): [('a', [])],
+        ('d', '1.0'): [('d', [])]
+    })
+    expected = {k.key: [r.key for r in rs]
+                for k, rs in p.conflicting_deps(tree).items()}
+    assert {'a': ['b'], 'b': ['x']} == expected
+    assert expected == {k.key: [r.key for r in rs]
+                        for k, rs in tree.conflicts().items()}
+    assert (sorted([frozenset(['a', 'b', 'c']), frozenset(['d'])]) ==
+            sorted(tree.cycles()))
+
+
+def make_dist(key, version, requires=()):
+    dist = mock.Mock(key=key, project_name=key, version=version)
+    dist.requires = mock.Mock(return_value=[
+        mock.Mock(key=k, project_name=k, specs=specs)
+        for k, specs in requires])
+    return dist
+
+
+def test_PackageDAG_apply():
+    pkgs = list(mock_pkgs({
+        ('a', '1.0'): [('b', [('>=', '2.0')])],
+        ('b', '1.0'): [('c', [])],
+        ('c', '1.0'): [],
+        ('d', '1.0'): [('c', [('<', '2.0')]), ('x', [])]
+    }))
+    tree = p.PackageDAG.from_pkgs(pkgs)
+    reqs = dict((p_.key, p_.requires) for p_ in pkgs)
+    b2 = make_dist('b', '2.0', [('c', []), ('d', [])])
+    c2 = make_dist('c', '2.0')
+    x1 = make_dist('x', '1.0', [('a', [])])
+    new = tree.apply(added=[x1], removed=['A'], upgraded=[b2, c2])
+
+    # the original DAG is left as is
+    assert {'a': ['b'], 'b': ['c'], 'c': [], 'd': ['c', 'x']} == \
+        dag_to_dict(tree)
+    assert {'b': ['c', 'd'], 'c': [], 'd': ['c', 'x'], 'x': ['a']} == \
+        dag_to_dict(new)
+    assert ['b', 'c', 'd', 'x'] == [n.key for n in new]
+    assert ['2.0', '1.0'] == [c.installed_version
+                              for c in new.get_children('d')]
+    assert new.get_children('x')[0].is_missing
+    # the requirements of the unchanged packages aren't read again
+    assert 1 == reqs['d'].call_count
+    assert set(['a', 'c', 'd', 'x']) == new.transitive_deps('b')
+    assert ['b', 'd'] == sorted(n.key for n in new.get_parents('c'))
+    # ids of removed packages no longer referred to are dropped
+    assert 'a' not in tree.apply(removed=['a'])._graph.ids
+    assert not tree.apply(removed=['a']).get_children('a')
+
+
+def test_PackageDAG_apply_carries_over_conflicts_and_cycles():
+    pkgs = list(mock_pkgs({
+        ('a', '1.0'): [('b', [('>=', '2.0')])],
+        ('b', '1.0'): [('c', [])],
+        ('c', '1.0'): [('b', [])],
+        ('d', '1.0'): [('e', [])],
+        ('e', '1.0'): [('d', [])],
+        ('f', '1.0'): [('g', [('<', '2.0')])],
+        ('g', '1.0'): []
+    }))
+    tree = p.PackageDAG.from_pkgs(pkgs)
+    assert ['a'] == [k.key for k in tree.conflicts()]
+    assert 2 == len(tree.cycles())
+
+    new = tree.apply(upgraded=[make_dist('b', '2.0'),
+                               make_dist('g', '2.0', [('f', [])])])
+    conflicts = new.conflicts()
+    assert ['f'] == [k.key for k in conflicts]
+    assert [['2.0']] == [[r.installed_version for r in rs]
+                         for rs in conflicts.values()]
+    expected = [frozenset(['d', 'e']), frozenset(['f', 'g'])]
+    assert sorted(expected) == sorted(new.cycles())
+
+    # same results as computed from scratch
+    scratch = p.PackageDAG(new._graph, new.resolver)
+    assert sorted(scratch.cycles()) == sorted(new.cycles())
+    assert ([k.key for k in scratch.conflicts()] ==
+            [k.key for k in new.conflicts()])
+    # not computed beforehand, so not carried over either
+    assert p.PackageDAG.from_pkgs(pkgs).apply()._conflicts is None
+
+    # the same, with the parents found in the reversed DAG
+    tree.reverse()
+    with mock.patch.object(p, 'bisect_right') as bisect_right:
+        new = tree.apply(upgraded=[make_dist('b', '2.0'),
+                                   make_dist('g', '2.0', [('f', [])])])
+        assert not bisect_right.called
+    assert ['f'] == [k.key for k in new.conflicts()]
+
+    with pytest.raises(TypeError):
+        tree.reverse().apply(removed=['a'])
+
+
+@pytest.mark.parametrize("precompute", [False, True])
+def test_PackageDAG_apply_removed_are_missing(precompute):
+    # pytest is installed in the current environment as well
+    tree = mock_PackageDAG({('foo', '1.0'): [('pytest', [('>=', '1')])],
+                            ('pytest', '9.0'): []})
+    if precompute:
+        assert {} == tree.conflicts()
+    new = tree.apply(removed=['pytest'])
+    conflicts = new.conflicts()
+    assert ['foo'] == [k.key for k in conflicts]
+    assert [['?']] == [[r.installed_version for r in rs]
+                       for rs in conflicts.values()]
+    # and the original DAG still finds it
+    assert {} == tree.conflicts()
+    assert '9.0' == tree.get_children('foo')[0].installed_version
+
+
 # Tests for Package classes
 #
 # Note: For all render methods, we are only testing for frozen=False
@@ -220,6 +645,121 @@ def test_ReqPackage__as_dict():
     assert expected == result
 
 
+def test_ReqPackage__installed_version_is_memoized():
+    bar_req = mock.Mock(key='bar', project_name='bar', specs=[('>=', '4.0')])
+    resolver = p.VersionResolver()
+    rp = p.ReqPackage(bar_req, resolver=resolver)
+    with mock.patch.object(resolver, 'resolve',
+                           return_value='4.1.0') as resolve:
+        assert '4.1.0' == rp.installed_version
+        assert not rp.is_missing
+        assert not rp.is_conflicting()
+        assert '4.1.0' == rp.as_dict()['installed_version']
+        resolve.assert_called_once_with('bar', '?')
+
+
+def test_frozen_repr_is_memoized():
+    foo = mock.Mock(key='foo', project_name='foo', version='1.0')
+    foo_req = mock.Mock(key='foo', project_name='foo', specs=[])
+    with mock.patch.dict(p._frozen_reprs, clear=True), \
+            mock.patch.object(p, 'frozen_req_from_dist',
+                              return_value='-e git+repo#egg=foo\n') as f:
+        dp = p.DistPackage(foo)
+        assert '-e git+repo#egg=foo' == dp.render_as_root(True)
+        assert '-e git+repo#egg=foo' == \
+            p.ReqPackage(foo_req, dist=dp).render_as_root(True)
+        f.assert_called_once_with(foo)
+
+
+def test_frozen_repr_does_not_keep_dists_alive():
+    import gc
+    foo = mock.Mock(key='foo', project_name='foo', version='1.0')
+    with mock.patch.dict(p._frozen_reprs, clear=True), \
+            mock.patch.object(p, 'frozen_req_from_dist',
+                              lambda dist: 'foo==1.0\n'):
+        assert 'foo==1.0' == p.frozen_repr(foo)
+        assert 1 == len(p._frozen_reprs)
+        del foo
+        gc.collect()
+        assert 0 == len(p._frozen_reprs)
+
+
+def test_prefetch_frozen_reprs():
+    import threading
+    import time
+    dists = [mock.Mock(key='p{0}'.format(i)) for i in range(6)]
+    lock = threading.Lock()
+    running = [0, 0]  # current, max
+
+    def from_dist(dist):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return '{0}==1.0\n'.format(dist.key)
+
+    with mock.patch.dict(p._frozen_reprs, clear=True), \
+            mock.patch.object(p, 'frozen_req_from_dist',
+                              side_effect=from_dist) as f:
+        p.prefetch_frozen_reprs(dists + dists[:2], threads=3)
+        assert 6 == f.call_count
+        assert 1 < running[1] <= 3
+        assert 'p3==1.0' == p.frozen_repr(dists[3])
+        p.prefetch_frozen_reprs(dists)
+        assert 6 == f.call_count
+
+
+def test_VersionResolver():
+    resolver = p.VersionResolver()
+    with mock.patch.object(p.VersionResolver, 'lookup_metadata',
+                           side_effect=['1.0', None]) as lookup_metadata:
+        with mock.patch.object(p, 'guess_version') as guess_version:
+            assert '1.0' == resolver.resolve('foo')
+            assert '1.0' == resolver.resolve('foo')
+            assert '?' == resolver.resolve('bar')
+            assert '?' == resolver.resolve('bar')
+            assert 2 == lookup_metadata.call_count
+            # packages are never imported unless asked for
+            assert not guess_version.called
+
+
+def test_VersionResolver__guess_by_import():
+    resolver = p.VersionResolver(guess_by_import=True)
+    with mock.patch.object(p.VersionResolver, 'lookup_metadata',
+                           return_value=None):
+        with mock.patch.object(p, 'guess_version',
+                               return_value='2.0') as guess_version:
+            assert '2.0' == resolver.resolve('foo')
+            assert '2.0' == resolver.resolve('foo')
+            guess_version.assert_called_once_with('foo', None)
+
+
+def test_VersionResolver__lookup_metadata():
+    assert p.VersionResolver.lookup_metadata('pip') is not None
+    assert p.VersionResolver.lookup_metadata('non-existent-pkg') is None
+
+
+def test_VersionResolver__paths(tmpdir):
+    write_dist_info(tmpdir, 'foo', '1.2')
+    resolver = p.VersionResolver(guess_by_import=True, paths=[str(tmpdir)])
+    with mock.patch.object(p, 'guess_version') as guess_version:
+        assert '1.2' == resolver.resolve('foo')
+        assert '?' == resolver.resolve('pip')
+        assert not guess_version.called
+    assert '?' == p.VersionResolver(paths=[]).resolve('pip')
+
+
+def test_PackageDAG_shares_resolver():
+    tree = mock_PackageDAG({('a', '1.0'): [('missing', [('>=', '1.0')])]})
+    resolver = tree.resolver
+    assert resolver is tree.reverse().resolver
+    assert resolver is tree.filter(set(['a']), None).resolver
+    assert resolver is tree.sort().resolver
+    assert all(r.resolver is resolver for r in p.flatten(tree.values()))
+
+
 # Tests for render_text
 #
 # @NOTE: These tests use mocked tree and it's not easy to test for
@@ -343,6 +883,199 @@ def test_render_text(capsys, list_all, reverse, expected_output):
     assert '\n'.join(expected_output).strip() == captured.out.strip()
 
 
+def test_render_text_streams_lines():
+    lines = p.iter_text_lines(t, list_all=False, frozen=False)
+    assert 'a==3.4.0' == next(lines)
+    assert '  - b [required: >=2.0.0, installed: 2.3.1]' == next(lines)
+
+    out = mock.Mock()
+    p.render_text(t, list_all=False, frozen=False, out=out)
+    written = ''.join(c[0][0] for c in out.write.call_args_list)
+    expected = list(p.iter_text_lines(t, list_all=False, frozen=False))
+    assert '\n'.join(expected) + '\n' == written
+
+
+def test_main_stdout_closed_early():
+    class ClosedPipe(object):
+        def write(self, s):
+            raise IOError(p.errno.EPIPE, 'Broken pipe')
+
+        def fileno(self):
+            return 1
+
+    pkgs = list(mock_pkgs({('a', '1.0'): []}))
+    args = p.get_parser().parse_args(['-w', 'silence'])
+    with mock.patch.object(p, '_get_args', return_value=args), \
+            mock.patch.object(p, 'discover_distributions', return_value=pkgs), \
+            mock.patch.object(p.sys, 'stdout', ClosedPipe()), \
+            mock.patch.object(p.os, 'dup2') as dup2:
+        assert 1 == p.main()
+        assert dup2.called
+
+
+def test_main_why(capsys):
+    pkgs = list(mock_pkgs({
+        ('a', '1.0'): [('b', [('>=', '1.0')])],
+        ('b', '1.0'): [('c', [])],
+        ('c', '1.0'): [],
+        ('d', '1.0'): [('c', [])],
+    }))
+    args = p.get_parser().parse_args(['--why', 'C', '-w', 'silence'])
+    with mock.patch.object(p, '_get_args', return_value=args), \
+            mock.patch.object(p, 'discover_distributions', return_value=pkgs):
+        assert 0 == p.main()
+    out, _ = capsys.readouterr()
+    expected = ['d==1.0',
+                '  - c [required: Any, installed: 1.0]',
+                'a==1.0',
+                '  - b [required: >=1.0, installed: 1.0]',
+                '    - c [required: Any, installed: 1.0]']
+    assert expected == out.splitlines()
+
+    args = p.get_parser().parse_args(['--why', 'x', '-w', 'silence'])
+    with mock.patch.object(p, '_get_args', return_value=args), \
+            mock.patch.object(p, 'discover_distributions', return_value=pkgs):
+        assert 1 == p.main()
+    _, err = capsys.readouterr()
+    assert 'x is not installed' in err
+
+
+def test_traverse():
+    tree = mock_PackageDAG({
+        ('a', '1.0'): [('b', []), ('c', [])],
+        ('b', '1.0'): [('a', [])],
+        ('c', '1.0'): []
+    })
+    a = tree.get_node_as_parent('a')
+    result = [(n.key, par and par.key, d) for n, par, d, _ in p.traverse(tree, [a])]
+    assert [('a', None, 0),
+            ('b', 'a', 1),
+            ('a', 'b', 2),
+            ('c', 'a', 3),
+            ('c', 'a', 1)] == result
+
+    result = [(n.key, par and par.key, d)
+              for n, par, d, _ in p.traverse(tree, [a], root_in_chain=True)]
+    assert [('a', None, 0), ('b', 'a', 1), ('c', 'a', 1)] == result
+
+
+def deep_chain_dag(n):
+    pkgs = [p.MetadataDistribution('pkg{0}'.format(i), '1.0',
+                                   ['pkg{0}'.format(i + 1)] if i < n - 1 else [])
+            for i in range(n)]
+    return p.PackageDAG.from_pkgs(pkgs)
+
+
+def test_render_deep_tree():
+    # Deeper than the recursion limit
+    n = sys.getrecursionlimit() + 500
+    tree = deep_chain_dag(n)
+    lines = list(p.iter_text_lines(tree, list_all=False))
+    assert n == len(lines)
+    assert lines[-1].startswith(' ' * 2 * (n - 1) + '- pkg{0} '.format(n - 1))
+    assert '"dependencies": []' in p.render_json_tree(tree, indent=None)
+
+
+@pytest.mark.parametrize("indent", [None, 4])
+@pytest.mark.parametrize("reverse", [False, True])
+def test_render_json_tree_same_as_json_dumps(indent, reverse):
+    tree = t.reverse() if reverse else t
+    output = p.render_json_tree(tree, indent=indent)
+    assert json.dumps(json.loads(output), indent=indent) == output
+    assert '[]' == p.render_json_tree(p.PackageDAG({}), indent=indent)
+
+
+def test_render_json_lines():
+    out = io.StringIO()
+    p.render_json_lines(t, out=out)
+    lines = out.getvalue().splitlines()
+    assert len(t) == len(lines)
+    assert json.loads(p.render_json(t, indent=None)) == [json.loads(l)
+                                                         for l in lines]
+    assert '' == ''.join(p.iter_json_lines(p.PackageDAG({})))
+
+
+@pytest.mark.parametrize("max_depth", [0, 1, 2])
+def test_render_text_max_depth(max_depth):
+    lines = list(p.iter_text_lines(t, list_all=False, max_depth=max_depth))
+    full = list(p.iter_text_lines(t, list_all=False))
+    # the same as truncating the complete output
+    expected = [l for l in full
+                if len(l) - len(l.lstrip()) <= 2 * max_depth]
+    assert expected == lines
+
+
+def test_traverse_max_depth_is_pruned():
+    tree = deep_chain_dag(1000)
+    with mock.patch.object(tree, 'get_children',
+                           wraps=tree.get_children) as get_children:
+        result = list(p.traverse(tree, [tree.get_node_as_parent('pkg0')],
+                                 max_depth=2))
+    assert [0, 1, 2] == [d for _, _, d, _ in result]
+    assert 2 == get_children.call_count
+
+
+def test_render_json_tree_max_depth():
+    result = json.loads(p.render_json_tree(t, indent=None, max_depth=1))
+    assert ['a', 'g'] == [n['key'] for n in result]
+    assert [['b', 'c'], ['e', 'f']] == [[c['key'] for c in n['dependencies']]
+                                        for n in result]
+    assert all(c['dependencies'] == []
+               for n in result for c in n['dependencies'])
+
+
+def test_render_text_dedupe():
+    expected = [
+        'a==3.4.0',
+        '  - b [required: >=2.0.0, installed: 2.3.1]',
+        '    - d [required: >=2.30,<2.42, installed: 2.35]',
+        '      - e [required: >=0.9.0, installed: 0.12.1]',
+        '  - c [required: >=5.7.1, installed: 5.10.0]',
+        '    - d [required: >=2.30, installed: 2.35] (see above)',
+        '    - e [required: >=0.12.1, installed: 0.12.1]',
+        'g==6.8.3rc1',
+        '  - e [required: >=0.9.0, installed: 0.12.1]',
+        '  - f [required: >=3.0.0, installed: 3.1]',
+        '    - b [required: >=2.1.0, installed: 2.3.1] (see above)'
+    ]
+    assert expected == list(p.iter_text_lines(t, list_all=False,
+                                              dedupe=True))
+    # With --all, the top level packages already shown are referenced
+    lines = list(p.iter_text_lines(t, list_all=True, dedupe=True))
+    assert 'b==2.3.1 (see above)' in lines
+    assert 'e==0.12.1' in lines
+
+
+def test_render_json_tree_dedupe():
+    result = json.loads(p.render_json_tree(t, indent=4, dedupe=True))
+    c = result[0]['dependencies'][1]
+    assert 'c' == c['key']
+    d, e = c['dependencies']
+    assert {'key': 'd',
+            'package_name': 'd',
+            'installed_version': '2.35',
+            'required_version': '>=2.30',
+            'ref': 'd'} == d
+    assert [] == e['dependencies']
+
+
+def test_dedupe_output_is_linear():
+    # every package depends on all the packages of the next layer, so
+    # the number of paths grows exponentially with the no. of layers
+    width, layers = 3, 8
+    graph = {}
+    for layer in range(layers):
+        for i in range(width):
+            children = [('p{0}-{1}'.format(layer + 1, j), [])
+                        for j in range(width)] if layer < layers - 1 else []
+            graph[('p{0}-{1}'.format(layer, i), '1.0')] = children
+    tree = mock_PackageDAG(graph)
+    lines = list(p.iter_text_lines(tree, list_all=False, dedupe=True))
+    assert len(lines) <= width + width * width * (layers - 1)
+    output = p.render_json_tree(tree, indent=None, dedupe=True)
+    assert len(json.loads(output)) == width
+
+
 # Tests for graph outputs
 
 def test_render_pdf():
@@ -373,6 +1106,65 @@ def test_render_svg(capsys):
     assert out.strip().endswith('</svg>')
 
 
+def test_render_graphviz_dot():
+    tree = mock_PackageDAG({
+        ('zope.interface', '1.0'): [('missing-x', [('>=', '1.0')]),
+                                    ('b', [])],
+        ('b', '2.0'): []
+    })
+    expected = [
+        'digraph {',
+        '\t"zope.interface" [label="zope.interface\n1.0"]',
+        '\t"missing-x" [label="missing-x\n(missing)" style=dashed]',
+        '\t"zope.interface" -> "missing-x" [style=dashed]',
+        '\t"zope.interface" -> b [label=any]',
+        '\tb [label="b\n2.0"]',
+        '}'
+    ]
+    assert expected == list(p.iter_dot_lines(tree))
+    out = io.StringIO()
+    p.render_graphviz(tree, output_format='dot', out=out)
+    assert '\n'.join(expected) + '\n' == out.getvalue()
+    assert '\n'.join(expected) == p.dump_graphviz(tree)
+
+
+def test_render_graphviz_dot_reverse():
+    lines = list(p.iter_dot_lines(t.reverse(), is_reverse=True))
+    assert '\te [label="e\n0.12.1"]' in lines
+    assert '\te -> c [label=">=0.12.1"]' in lines
+    assert '\td -> b [label=">=2.30,<2.42"]' in lines
+
+
+def test_render_graphviz_unsupported_format(capsys):
+    with pytest.raises(SystemExit):
+        p.dump_graphviz(t, output_format='unknown')
+    _, err = capsys.readouterr()
+    assert 'unknown is not a supported output format.' in err
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='needs a posix shell')
+def test_render_graphviz_pipes_to_dot(tmpdir, monkeypatch):
+    # a fake `dot` command that outputs the format and it's input
+    dot = tmpdir.join('dot')
+    dot.write('#!/bin/sh\necho "$1"\ncat\n')
+    dot.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmpdir) + os.pathsep + os.environ['PATH'])
+    source = p.dump_graphviz(t)
+    assert '-Tplain\n' + source + '\n' == p.dump_graphviz(t, 'plain')
+    with open(str(tmpdir.join('out')), 'w+') as f:
+        p.render_graphviz(t, output_format='plain', out=f)
+        f.seek(0)
+        assert '-Tplain\n' + source + '\n' == f.read()
+
+
+def test_render_graphviz_without_dot(tmpdir, monkeypatch, capsys):
+    monkeypatch.setenv('PATH', str(tmpdir))
+    with pytest.raises(SystemExit):
+        p.dump_graphviz(t, output_format='svg')
+    _, err = capsys.readouterr()
+    assert 'GraphViz is not available' in err
+
+
 # Test for conflicting deps
 
 @pytest.mark.parametrize(
@@ -439,6 +1231,84 @@ def test_conflicting_deps(capsys, mpkgs, expected_keys, expected_output):
     assert '\n'.join(expected_output).strip() == captured.err.strip()
 
 
+def test_what_if_conflicts(capsys):
+    tree = mock_PackageDAG({
+        ('a', '1.0'): [('b', [('<', '2.0')])],
+        ('c', '1.0'): [('b', [('>=', '1.0')]), ('x', [('<', '1')])],
+        ('d', '1.0'): [('b', [('<', '1.0')])],
+        ('b', '1.5'): [],
+        ('x', '0.5'): []
+    })
+    result = p.what_if_conflicts(tree, {'B': '2.0', 'x': '1.2'})
+    assert {'a': [('b', '2.0')], 'c': [('x', '1.2')]} == \
+        {k.key: [(r.key, r.installed_version) for r in rs]
+         for k, rs in result.items()}
+    # already conflicting, not a new conflict
+    assert 'd' not in [k.key for k in result]
+    assert not p.what_if_conflicts(tree, [('b', '1.9'), ('e', '1.0')])
+    # the reversed DAG is reused for every batch
+    assert tree.reverse() is tree.reverse()
+
+    p.render_what_if_text(result)
+    out, _ = capsys.readouterr()
+    assert ['The following requirements would not be satisfied:',
+            '* a==1.0',
+            ' - b [required: <2.0, installed: 2.0]',
+            '* c==1.0',
+            ' - x [required: <1, installed: 1.2]'] == out.splitlines()
+
+
+def test_main_what_if(capsys):
+    pkgs = list(mock_pkgs({
+        ('a', '1.0'): [('b', [('<', '2.0')])],
+        ('b', '1.5'): [],
+        ('c', '1.0'): [('b', [])]
+    }))
+
+    def run(*argv):
+        args = p.get_parser().parse_args(list(argv))
+        with mock.patch.object(p, '_get_args', return_value=args), \
+                mock.patch.object(p, 'discover_distributions',
+                                  return_value=pkgs):
+            return_code = p.main()
+        return return_code, capsys.readouterr()[0]
+
+    return_code, out = run('--what-if', 'b==2.0,c==3', '-p', 'c')
+    assert 1 == return_code
+    assert ['* a==1.0', ' - b [required: <2.0, installed: 2.0]'] == \
+        out.splitlines()[1:]
+    return_code, out = run('--what-if', 'B==1.9', '--json')
+    assert 0 == return_code
+    assert [] == json.loads(out)
+    return_code, out = run('--what-if', 'b==2.0', '--json')
+    assert [{'key': 'b', 'package_name': 'b', 'installed_version': '2.0',
+             'required_version': '<2.0'}] == \
+        json.loads(out)[0]['dependencies']
+
+
+def test_parse_specifier_and_version_are_cached():
+    assert p.parse_specifier('>=1.0,<2') is p.parse_specifier('>=1.0,<2')
+    assert '' == str(p.parse_specifier(None))
+    assert p.parse_version('1.0') is p.parse_version('1.0')
+
+
+@pytest.mark.parametrize(
+    "specs,installed,expected",
+    [
+        ([('>=', '1.0')], '1.1rc1', False),
+        ([('>=', '1.0'), ('<', '2.0')], '2.0', True),
+        ([('==', '1.*')], '1.4', False),
+        ([], '1.0', False),
+        ([], 'not a version', False),
+        ([('>=', '1.0')], 'not a version', True)
+    ]
+)
+def test_ReqPackage__is_conflicting(specs, installed, expected):
+    req = mock.Mock(key='foo', project_name='foo', specs=specs)
+    dist = mock.Mock(key='foo', project_name='foo', version=installed)
+    assert expected == p.ReqPackage(req, dist=dist).is_conflicting()
+
+
 # Tests for cyclic deps
 
 @pytest.mark.parametrize(
@@ -464,19 +1334,793 @@ def test_conflicting_deps(capsys, mpkgs, expected_keys, expected_output):
             },
             [],
             [] # no output expected
+        ),
+        (
+            {
+                ('a', '1.0.1'): [('b', [('>=', '2.0.0')])],
+                ('b', '2.3.0'): [('c', [('>=', '4.0.0')])],
+                ('c', '4.5.0'): [('a', [('>=', '1.0.1')]),
+                                 ('d', [('==', '2.0')])],
+                ('d', '2.0'): []
+            },
+            [('a', 'b', 'c', 'a')],
+            [
+                'Warning!! Cyclic dependencies found:',
+                '* a => b => c => a'
+            ]
+        ),
+        (
+            {
+                ('a', '1.0.1'): [('b', [('>=', '2.0.0')])],
+                ('b', '2.3.0'): [('a', [('>=', '1.0.1')]),
+                                 ('c', [('>=', '4.0.0')])],
+                ('c', '4.5.0'): [('d', [('==', '2.0')])],
+                ('d', '2.0'): [('e', [])],
+                ('e', '1.0'): [('c', [])]
+            },
+            [('a', 'b', 'a'), ('b', 'a', 'b'), ('c', 'd', 'e', 'c')],
+            [
+                'Warning!! Cyclic dependencies found:',
+                '* b => a => b',
+                '* a => b => a',
+                '* c => d => e => c'
+            ]
         )
     ]
 )
 def test_cyclic_deps(capsys, mpkgs, expected_keys, expected_output):
     tree = mock_PackageDAG(mpkgs)
     result = p.cyclic_deps(tree)
-    result_keys = [(a.key, b.key, c.key) for (a, b, c) in result]
+    result_keys = [tuple(n.key for n in cycle) for cycle in result]
     assert sorted(expected_keys) == sorted(result_keys)
     p.render_cycles_text(result)
     captured = capsys.readouterr()
     assert '\n'.join(expected_output).strip() == captured.err.strip()
 
 
+# Tests for discovery backends
+
+def test_parse_metadata():
+    lines = ['Metadata-Version: 2.1',
+             'Name: Foo-Bar',
+             'Version: 1.2.0',
+             'Summary: foo',
+             '  continued',
+             'Requires-Dist: six (>=1.10)',
+             "Requires-Dist: pytest ; extra == 'test'",
+             '',
+             'Requires-Dist: not-a-header']
+    name, version, requires = p.parse_metadata(lines)
+    assert 'Foo-Bar' == name
+    assert '1.2.0' == version
+    assert ['six (>=1.10)', "pytest ; extra == 'test'"] == requires
+
+
+def test_parse_requires_txt():
+    lines = ['six>=1.10',
+             '',
+             '[:python_version < "2.0"]',
+             'futures',
+             '[test]',
+             'pytest',
+             '[test:python_version < "2.0"]',
+             'mock']
+    expected = ['six>=1.10', 'futures; python_version < "2.0"']
+    assert expected == p.parse_requires_txt(lines)
+
+
+def test_MetadataDistribution__requires():
+    dist = p.MetadataDistribution('foo_bar', '1.0',
+                                  ['six (>=1.10,<2)',
+                                   "pytest ; extra == 'test'",
+                                   'futures ; python_version < "2.0"'])
+    assert 'foo-bar' == dist.key
+    reqs = dist.requires()
+    assert ['six'] == [r.key for r in reqs]
+    assert [('<', '2'), ('>=', '1.10')] == sorted(reqs[0].specs)
+    as_req = dist.as_requirement()
+    assert ('foo-bar', [('==', '1.0')]) == (as_req.key, as_req.specs)
+
+
+@pytest.mark.parametrize(
+    "req_str,expected",
+    [
+        ('foo[bar]>=1.0,<2', ('foo', [('>=', '1.0'), ('<', '2')])),
+        ('Foo_Bar (~=1.2)', ('foo-bar', [('~=', '1.2')])),
+        ('foo @ https://example.com/foo.whl', ('foo', [])),
+        ('foo>=1 ; python_version < "2.0"', None),
+        ("foo ; extra == 'test'", None)
+    ]
+)
+def test_MetadataRequirement__parse(req_str, expected):
+    req = p.MetadataRequirement.parse(req_str)
+    assert expected == (req and (req.key, req.specs))
+
+
+def write_dist_info(site_dir, name, version, requires=()):
+    dist_info = site_dir.mkdir('{0}-{1}.dist-info'.format(name, version))
+    lines = ['Metadata-Version: 2.1',
+             'Name: {0}'.format(name),
+             'Version: {0}'.format(version)]
+    lines += ['Requires-Dist: {0}'.format(r) for r in requires]
+    dist_info.join('METADATA').write('\n'.join(lines) + '\n\nlong desc\n')
+
+
+def test_MetadataScanBackend(tmpdir):
+    write_dist_info(tmpdir, 'a', '3.4.0', ['b (>=2.0.0)'])
+    write_dist_info(tmpdir, 'b', '2.3.1')
+    egg_info = tmpdir.mkdir('c.egg-info')
+    egg_info.join('PKG-INFO').write('Name: c\nVersion: 5.10.0\n')
+    egg_info.join('requires.txt').write('a>=3\n[docs]\nsphinx\n')
+    tmpdir.join('argparse-1.2.1.egg-info').write('Name: argparse\n'
+                                                 'Version: 1.2.1\n')
+    with mock.patch.object(p, '_search_paths', return_value=[str(tmpdir)]):
+        pkgs = p.MetadataScanBackend().distributions()
+    tree = p.PackageDAG.from_pkgs(pkgs)
+    assert {'a': ['b'], 'b': [], 'c': ['a']} == dag_to_dict(tree)
+    assert '3.4.0' == tree.get_node_as_parent('a').version
+
+
+def test_MetadataScanBackend__cache(tmpdir):
+    site_dir = tmpdir.mkdir('site-packages')
+    write_dist_info(site_dir, 'a', '3.4.0', ['b (>=2.0.0)'])
+    write_dist_info(site_dir, 'b', '2.3.1')
+    cache = p.MetadataCache(str(tmpdir.join('cache')))
+    backend = p.MetadataScanBackend(cache)
+
+    def scan():
+        dists = backend.scan_dir(str(site_dir))
+        return {d.key: (d.version, d.requires_dist) for d in dists}
+
+    # cold run parses everything and writes the cache
+    expected = {'a': ('3.4.0', ['b (>=2.0.0)']), 'b': ('2.3.1', [])}
+    assert expected == scan()
+    assert ['a-3.4.0.dist-info', 'b-2.3.1.dist-info'] == \
+        sorted(cache.load(str(site_dir)))
+
+    # warm run doesn't parse anything
+    with mock.patch.object(p.MetadataScanBackend, 'read_dist') as read_dist:
+        assert expected == scan()
+        assert not read_dist.called
+
+    # only the changed distributions are parsed again
+    site_dir.join('b-2.3.1.dist-info').remove()
+    write_dist_info(site_dir, 'b', '2.4.0', ['c'])
+    with mock.patch.object(p.MetadataScanBackend, 'read_dist',
+                           wraps=p.MetadataScanBackend.read_dist) as read_dist:
+        expected = {'a': ('3.4.0', ['b (>=2.0.0)']), 'b': ('2.4.0', ['c'])}
+        assert expected == scan()
+        read_dist.assert_called_once_with(str(site_dir), 'b-2.4.0.dist-info')
+    assert ['a-3.4.0.dist-info', 'b-2.4.0.dist-info'] == \
+        sorted(cache.load(str(site_dir)))
+
+
+def test_MetadataScanBackend__cache_requires_txt(tmpdir):
+    site_dir = tmpdir.mkdir('site-packages')
+    egg_info = site_dir.mkdir('c.egg-info')
+    egg_info.join('PKG-INFO').write('Name: c\nVersion: 1.0\n')
+    egg_info.join('requires.txt').write('a\n')
+    cache = p.MetadataCache(str(tmpdir.join('cache')))
+    backend = p.MetadataScanBackend(cache)
+
+    def requires():
+        dist, = backend.scan_dir(str(site_dir))
+        return [r.key for r in dist.requires()]
+
+    assert ['a'] == requires()
+    # only requires.txt changes
+    egg_info.join('requires.txt').write('a\nb>=1\n')
+    assert ['a', 'b'] == requires()
+    egg_info.join('requires.txt').remove()
+    assert [] == requires()
+
+
+def test_MetadataCache__load_invalid(tmpdir):
+    cache = p.MetadataCache(str(tmpdir))
+    assert {} == cache.load('/some/dir')
+    tmpdir.join(p.os.path.basename(cache.cache_file('/some/dir'))).write('{')
+    assert {} == cache.load('/some/dir')
+    cache.save('/some/dir', {'a-1.0.dist-info': {}})
+    assert {'a-1.0.dist-info': {}} == cache.load('/some/dir')
+
+
+def make_venv(root, dists):
+    site_dir = root.join('lib', 'python3.8', 'site-packages')
+    site_dir.ensure(dir=True)
+    for name, version, requires in dists:
+        write_dist_info(site_dir, name, version, requires)
+    return site_dir
+
+
+def test_environment_site_dirs(tmpdir):
+    assert [str(tmpdir)] == p.environment_site_dirs(str(tmpdir))
+    site_dir = make_venv(tmpdir, [])
+    tmpdir.join('lib64').mksymlinkto(tmpdir.join('lib'))
+    assert [str(site_dir)] == p.environment_site_dirs(str(tmpdir))
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_scan_environments(tmpdir, processes):
+    venv1, venv2 = tmpdir.join('venv1'), tmpdir.join('venv2')
+    make_venv(venv1, [('a', '1.0', ['b>=2']), ('b', '1.0', [])])
+    site_dir = make_venv(venv2, [('a', '2.0', []), ('c', '1.0', ['a'])])
+    paths = [str(venv1), str(site_dir)]
+    trees = p.scan_environments(paths, processes=processes)
+    assert paths == list(trees)
+    assert {'a': ['b'], 'b': []} == dag_to_dict(trees[str(venv1)])
+    assert {'a': [], 'c': ['a']} == dag_to_dict(trees[str(site_dir)])
+    assert 1 == len(p.conflicting_deps(trees[str(venv1)]))
+    assert '2.0' == trees[str(site_dir)].get_node_as_parent('a').version
+
+
+def test_main_env(tmpdir, capsys):
+    venv1, venv2 = tmpdir.join('venv1'), tmpdir.join('venv2')
+    make_venv(venv1, [('a', '1.0', ['b>=2']), ('b', '1.0', [])])
+    make_venv(venv2, [('c', '1.0', [])])
+
+    def run(*argv):
+        args = p.get_parser().parse_args(list(argv))
+        with mock.patch.object(p, '_get_args', return_value=args):
+            return_code = p.main()
+        out, err = capsys.readouterr()
+        return return_code, out, err
+
+    return_code, out, err = run('--env', str(venv1), '--env', str(venv2),
+                                '--json')
+    assert 0 == return_code
+    data = json.loads(out)
+    assert [str(venv1), str(venv2)] == list(data)
+    assert ['a', 'b'] == [d['package']['key'] for d in data[str(venv1)]]
+    assert 'c' == data[str(venv2)][0]['package']['key']
+
+    return_code, out, err = run('--env', str(venv1), '--env', str(venv2),
+                                '-w', 'fail')
+    assert 1 == return_code
+    expected = ('# {0}\n'
+                'a==1.0\n'
+                '  - b [required: >=2, installed: 1.0]\n'
+                '# {1}\n'
+                'c==1.0\n').format(venv1, venv2)
+    assert expected == out
+    assert 'In {0}:\nWarning!!! Possibly conflicting'.format(venv1) in err
+    assert str(venv2) not in err
+
+    return_code, out, err = run('--env', str(tmpdir.join('missing')))
+    assert 1 == return_code
+    assert 'is not a directory' in err
+
+    # the versions of missing dependencies are not looked up in the
+    # current environment (where pytest is installed)
+    make_venv(venv2, [('d', '1.0', ['pytest>=1'])])
+    return_code, out, err = run('--env', str(venv2), '-w', 'fail')
+    assert 1 == return_code
+    assert '  - pytest [required: >=1, installed: ?]\n' in out
+    assert ' - pytest [required: >=1, installed: ?]' in err
+
+    for option in (['--json-tree'], ['--json-lines'], ['--why', 'a'],
+                   ['--graph-output', 'dot'], ['--what-if', 'b==3']):
+        return_code, out, err = run('--env', str(venv1), *option)
+        assert 1 == return_code
+        assert '' == out
+        assert '--env can\'t be used with {0}\n'.format(option[0]) == err
+
+
+def write_wheel(directory, name, version, requires=(), metadata=True):
+    import zipfile
+    path = directory.join('{0}-{1}-py2.py3-none-any.whl'.format(name,
+                                                                version))
+    dist_info = '{0}-{1}.dist-info'.format(name, version)
+    lines = ['Metadata-Version: 2.1',
+             'Name: {0}'.format(name),
+             'Version: {0}'.format(version)]
+    lines += ['Requires-Dist: {0}'.format(r) for r in requires]
+    with zipfile.ZipFile(str(path), 'w', zipfile.ZIP_DEFLATED) as whl:
+        whl.writestr('{0}/__init__.py'.format(name), '')
+        if metadata:
+            whl.writestr('{0}/METADATA'.format(dist_info),
+                         '\n'.join(lines) + '\n\nlong desc\n')
+        whl.writestr('{0}/RECORD'.format(dist_info), '')
+    return path
+
+
+def test_read_wheel(tmpdir):
+    dist = p.read_wheel(str(write_wheel(tmpdir, 'a', '1.0', ['b (>=2)'])))
+    assert ('a', '1.0', ['b (>=2)']) == (dist.key, dist.version,
+                                         dist.requires_dist)
+    assert p.read_wheel(str(write_wheel(tmpdir, 'c', '1.0',
+                                        metadata=False))) is None
+    tmpdir.join('broken-1.0-py3-none-any.whl').write('not a zip')
+    assert p.read_wheel(str(tmpdir.join('broken-1.0-py3-none-any.whl'))) \
+        is None
+
+
+def test_scan_wheelhouse(tmpdir):
+    write_wheel(tmpdir, 'a', '1.0', ['b (>=2)', 'c'])
+    write_wheel(tmpdir, 'b', '1.9')
+    write_wheel(tmpdir, 'b', '1.10')
+    write_wheel(tmpdir, 'c', '2.0', ['a'])
+    tmpdir.join('b-3.0.tar.gz').write('')
+    pkgs = p.scan_wheelhouse(str(tmpdir), threads=2)
+    tree = p.PackageDAG.from_pkgs(pkgs)
+    assert {'a': ['b', 'c'], 'b': [], 'c': ['a']} == dag_to_dict(tree)
+    # the highest version is picked
+    assert '1.10' == tree.get_node_as_parent('b').version
+    assert ['a'] == [pkg.key for pkg in p.conflicting_deps(tree)]
+    assert p.cyclic_deps(tree)
+    assert [] == p.scan_wheelhouse(str(tmpdir.join('b-3.0.tar.gz')))
+
+
+def test_main_wheelhouse(tmpdir, capsys):
+    write_wheel(tmpdir, 'a', '1.0', ['b (>=2)'])
+    write_wheel(tmpdir, 'b', '2.1')
+    for argv, expected in [([], 'a==1.0\n'
+                                '  - b [required: >=2, installed: 2.1]\n'),
+                           (['-f'], 'a==1.0\n  b==2.1\n')]:
+        args = p.get_parser().parse_args(['--wheelhouse', str(tmpdir)] + argv)
+        with mock.patch.object(p, '_get_args', return_value=args):
+            assert 0 == p.main()
+        out, _ = capsys.readouterr()
+        assert expected == out
+
+    # pytest is installed in the current environment but not in the
+    # wheelhouse
+    write_wheel(tmpdir, 'c', '1.0', ['pytest>=1'])
+    args = p.get_parser().parse_args(['--wheelhouse', str(tmpdir),
+                                      '-p', 'c', '-w', 'fail'])
+    with mock.patch.object(p, '_get_args', return_value=args):
+        assert 1 == p.main()
+    out, err = capsys.readouterr()
+    assert 'c==1.0\n  - pytest [required: >=1, installed: ?]\n' == out
+    assert ' - pytest [required: >=1, installed: ?]' in err
+
+    args = p.get_parser().parse_args(['--wheelhouse',
+                                      str(tmpdir.join('missing'))])
+    with mock.patch.object(p, '_get_args', return_value=args):
+        assert 1 == p.main()
+    _, err = capsys.readouterr()
+    assert 'is not a directory' in err
+
+
+def write_tarball(path, files, mode='w:gz'):
+    import tarfile
+    with tarfile.open(str(path), mode) as tar:
+        for name, content in files:
+            data = content.encode('utf-8')
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+def test_scan_tarball(tmpdir):
+    site = './usr/lib/python3.8/site-packages'
+    files = [
+        ('./etc/passwd', 'root:x:0:0'),
+        ('{0}/a-1.0.dist-info/RECORD'.format(site), ''),
+        ('{0}/a-1.0.dist-info/METADATA'.format(site),
+         'Name: a\nVersion: 1.0\nRequires-Dist: b (>=2)\n\nlong desc\n'),
+        # requires.txt before PKG-INFO
+        ('{0}/b.egg-info/requires.txt'.format(site), 'c\n[docs]\nsphinx\n'),
+        ('{0}/b.egg-info/PKG-INFO'.format(site), 'Name: b\nVersion: 2.1\n'),
+        ('./usr/lib/python3/dist-packages/c-0.5.egg-info',
+         'Name: c\nVersion: 0.5\n'),
+        # shadowed by the first one
+        ('./opt/venv/lib/python3.8/site-packages/a-2.0.dist-info/METADATA',
+         'Name: a\nVersion: 2.0\n'),
+        ('{0}/a/__init__.py'.format(site), ''),
+    ]
+    path = write_tarball(tmpdir.join('layer.tar.gz'), files)
+    pkgs = p.scan_tarball(str(path))
+    tree = p.PackageDAG.from_pkgs(pkgs)
+    assert {'a': ['b'], 'b': ['c'], 'c': []} == dag_to_dict(tree)
+    assert ['1.0', '2.1', '0.5'] == [d.version for d in pkgs]
+    assert str(path.join(site, 'a-1.0.dist-info')) == pkgs[0].path
+
+    # reading from a non-seekable stream
+    class Stream(object):
+        def __init__(self, f):
+            self.read = f.read
+
+    with path.open('rb') as f:
+        assert [d.key for d in pkgs] == \
+            [d.key for d in p.scan_tarball(fileobj=Stream(f))]
+
+
+def test_main_tarball(tmpdir, capsys):
+    site = 'usr/lib/python3.8/site-packages'
+    path = write_tarball(tmpdir.join('layer.tar'), [
+        ('{0}/a-1.0.dist-info/METADATA'.format(site),
+         'Name: a\nVersion: 1.0\nRequires-Dist: b (>=2)\n'),
+        ('{0}/b-2.1.dist-info/METADATA'.format(site),
+         'Name: b\nVersion: 2.1\n')], mode='w')
+    for argv, expected in [([], 'a==1.0\n'
+                                '  - b [required: >=2, installed: 2.1]\n'),
+                           (['-f'], 'a==1.0\n  b==2.1\n')]:
+        args = p.get_parser().parse_args(['--tarball', str(path)] + argv)
+        with mock.patch.object(p, '_get_args', return_value=args):
+            assert 0 == p.main()
+        out, _ = capsys.readouterr()
+        assert expected == out
+
+    # pytest is installed in the current environment but not in the
+    # tarball
+    path = write_tarball(tmpdir.join('layer2.tar'), [
+        ('{0}/c-1.0.dist-info/METADATA'.format(site),
+         'Name: c\nVersion: 1.0\nRequires-Dist: pytest>=1\n')], mode='w')
+    args = p.get_parser().parse_args(['--tarball', str(path)])
+    with mock.patch.object(p, '_get_args', return_value=args):
+        assert 0 == p.main()
+    out, err = capsys.readouterr()
+    assert 'c==1.0\n  - pytest [required: >=1, installed: ?]\n' == out
+    assert ' - pytest [required: >=1, installed: ?]' in err
+
+    tmpdir.join('broken.tar').write('not a tarball')
+    for name in ('broken.tar', 'missing.tar'):
+        args = p.get_parser().parse_args(['--tarball', str(tmpdir.join(name))])
+        with mock.patch.object(p, '_get_args', return_value=args):
+            assert 1 == p.main()
+        _, err = capsys.readouterr()
+        assert 'Unable to read' in err
+
+
+def test_discover_distributions_fallback(capsys):
+    class Unavailable(p.DiscoveryBackend):
+        name = 'unavailable'
+
+        def distributions(self, local_only=False, user_only=False):
+            raise p.BackendUnavailable('unavailable is not available')
+
+    backends = dict(p.BACKENDS, unavailable=Unavailable)
+    with mock.patch.object(p, 'BACKENDS', backends):
+        with mock.patch.object(p.PipBackend, 'distributions',
+                               return_value=['dist']):
+            assert ['dist'] == p.discover_distributions('unavailable')
+    _, err = capsys.readouterr()
+    assert 'unavailable is not available, falling back to pip' == err.strip()
+
+
+# Tests for the daemon
+
+def touch_dir(path, offset):
+    st = path.stat()
+    os.utime(str(path), (st.atime, st.mtime + offset))
+
+
+def test_Daemon(tmpdir):
+    write_dist_info(tmpdir, 'a', '1.0', ['b>=2'])
+    write_dist_info(tmpdir, 'b', '1.0')
+    daemon = p.Daemon([str(tmpdir)])
+    assert {'a': ['b'], 'b': []} == dag_to_dict(daemon.tree)
+    assert not daemon.refresh()
+
+    response = daemon.query({'json_tree': True, 'packages': 'a'})
+    assert 0 == response['return_code']
+    assert ['a'] == [d['key'] for d in json.loads(response['output'])]
+    response = daemon.query({'warn': 'fail', 'backend': 'ignored'})
+    assert 1 == response['return_code']
+    assert 'a==1.0\n  - b [required: >=2, installed: 1.0]\n' == \
+        response['output']
+    assert 'Possibly conflicting dependencies' in response['errors']
+    assert 'digraph' in daemon.query({'output_format': 'png'})['output']
+
+    # only the changed distributions are read again
+    tmpdir.join('b-1.0.dist-info').remove()
+    write_dist_info(tmpdir, 'b', '2.0')
+    write_dist_info(tmpdir, 'c', '1.0', ['a'])
+    touch_dir(tmpdir, 1)
+    with mock.patch.object(p.MetadataScanBackend, 'read_dist',
+                           wraps=p.MetadataScanBackend.read_dist) as read_dist, \
+            mock.patch.object(p.PackageDAG, 'from_pkgs') as from_pkgs:
+        response = daemon.query({'why': 'b'})
+        assert ['b-2.0.dist-info', 'c-1.0.dist-info'] == \
+            sorted(c[0][1] for c in read_dist.call_args_list)
+        # and applied to the DAG instead of building it again
+        assert not from_pkgs.called
+    assert 'c==1.0\n  - a [required: Any, installed: 1.0]\n' \
+        '    - b [required: >=2, installed: 2.0]\n' == response['output']
+    assert '' == response['errors']
+
+    tmpdir.join('b-2.0.dist-info').remove()
+    touch_dir(tmpdir, 2)
+    assert daemon.refresh()
+    assert {'a': ['b'], 'c': ['a']} == dag_to_dict(daemon.tree)
+    assert ['a'] == [k.key for k in daemon.tree.conflicts()]
+    assert not daemon.refresh()
+
+    # the frozen representations are computed again for every query
+    with mock.patch.dict(p._frozen_reprs):
+        for dist in daemon.distributions():
+            p._frozen_reprs[dist] = 'stale'
+        daemon.refresh()
+        assert not set(daemon.distributions()) & set(p._frozen_reprs)
+
+
+def test_serve(tmpdir, capsys):
+    import threading
+    site_dir = tmpdir.mkdir('site')
+    write_dist_info(site_dir, 'a', '1.0', ['b>=2'])
+    write_dist_info(site_dir, 'b', '2.0')
+    socket_path = str(tmpdir.join('pipdeptree.sock'))
+    daemon = p.Daemon([str(site_dir)])
+
+    class Stop(Exception):
+        pass
+
+    stopping = []
+    refresh = daemon.refresh
+
+    def stoppable_refresh():
+        if stopping:
+            raise Stop()
+        return refresh()
+
+    def run():
+        try:
+            p.serve(socket_path, daemon, poll_interval=0.05)
+        except Stop:
+            pass
+
+    daemon.refresh = stoppable_refresh
+    thread = threading.Thread(target=run)
+    thread.start()
+    try:
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                break
+            thread.join(0.05)
+        assert 0o600 == os.stat(socket_path).st_mode & 0o777
+        with pytest.raises(IOError):
+            p.serve(socket_path, daemon)
+
+        for argv, expected in [
+                ([], 'a==1.0\n  - b [required: >=2, installed: 2.0]\n'),
+                (['-r', '-p', 'b'], 'b==2.0\n  - a==1.0 [requires: b>=2]\n'),
+                (['--graph-output', 'dot'], 'digraph {\n')]:
+            args = p.get_parser().parse_args(['--connect', socket_path] + argv)
+            with mock.patch.object(p, '_get_args', return_value=args):
+                assert 0 == p.main()
+            out, err = capsys.readouterr()
+            assert out.startswith(expected)
+            assert '' == err
+
+        response = p.query_daemon(socket_path, {'why': 'missing'})
+        assert 1 == response['return_code']
+        assert 'missing is not installed\n' == response['errors']
+        response = p.query_daemon(socket_path, {'depth': 'invalid'})
+        assert 'error' in response
+    finally:
+        stopping.append(True)
+        thread.join()
+    assert not os.path.exists(socket_path)
+
+    args = p.get_parser().parse_args(['--connect', socket_path])
+    with mock.patch.object(p, '_get_args', return_value=args):
+        assert 1 == p.main()
+    _, err = capsys.readouterr()
+    assert 'Unable to query the daemon' in err
+
+
+def test_serve_refuses_to_replace_other_files(tmpdir):
+    path = tmpdir.join('requirements.txt')
+    path.write('a==1.0\n')
+    with pytest.raises(IOError):
+        p.serve(str(path), None)
+    assert 'a==1.0\n' == path.read()
+
+
+def test_serve_replaces_stale_socket(tmpdir):
+    import socket
+    socket_path = str(tmpdir.join('pipdeptree.sock'))
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+
+    class Daemon(object):
+        def refresh(self):
+            raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        p.serve(socket_path, Daemon(), poll_interval=0.01)
+    assert not os.path.exists(socket_path)
+
+
+def test_load(tmpdir):
+    venv = tmpdir.join('venv')
+    make_venv(venv, [('a', '1.0', ['b>=2']), ('b', '1.0', [])])
+    site_dir = tmpdir.join('site-packages').ensure(dir=True)
+    write_dist_info(site_dir, 'b', '3.0')
+    write_dist_info(site_dir, 'c', '1.0', ['a'])
+    tree = p.load(paths=[str(venv), str(site_dir)])
+    assert {'a': ['b'], 'b': [], 'c': ['a']} == dag_to_dict(tree)
+    assert '1.0' == tree.get_node_as_parent('b').version
+    assert ['a'] == [k.key for k in tree.conflicts()]
+
+    # pytest is only installed in the current environment
+    write_dist_info(site_dir, 'd', '1.0', ['pytest>=1'])
+    tree = p.load(paths=[str(site_dir)])
+    assert '?' == tree.get_children('d')[0].installed_version
+
+    with mock.patch.object(p, 'discover_distributions',
+                           return_value=[]) as discover:
+        assert 0 == len(p.load(local_only=True))
+    discover.assert_called_once_with('scan', local_only=True,
+                                     user_only=False, cache=None)
+
+
+def test_render(tmpdir):
+    write_dist_info(tmpdir, 'a', '1.0', ['b>=2'])
+    write_dist_info(tmpdir, 'b', '1.0')
+    tree = p.load(paths=[str(tmpdir)])
+    assert 'a==1.0\n  - b [required: >=2, installed: 1.0]\n' == \
+        p.render(tree)
+    assert ['b', 'a'] == [d['package']['key'] for d in
+                          json.loads(p.render(tree, reverse=True,
+                                              json=True, packages='b'))]
+
+    out, err = io.StringIO(), io.StringIO()
+    # whatever pip's API for freezing
+    with mock.patch.object(p, 'frozen_req_from_dist',
+                           side_effect=AttributeError('editable')):
+        assert p.render(tree, out=out, err=err, freeze=True) is None
+    assert out.getvalue().startswith('a==1.0\n')
+    assert 'Possibly conflicting dependencies' in err.getvalue()
+
+    with pytest.raises(TypeError):
+        p.render(tree, local_only=True)
+
+
+def test_render_checks_options():
+    tree = mock_PackageDAG({('a', '1.0'): [('b', [('>=', '2')])],
+                            ('b', '1.0'): [('c', [])],
+                            ('c', '1.0'): []})
+    assert p.render(tree, depth=1) == p.render(tree, depth='1')
+    assert p.render(tree, what_if=[('b', '3.0')]) == \
+        p.render(tree, what_if='b==3.0')
+    for options in ({'depth': '-1'}, {'depth': 'x'}, {'max_paths': -1},
+                    {'what_if': 'b'}, {'warn': 'loud'}):
+        with pytest.raises(ValueError) as e:
+            p.render(tree, **options)
+        assert 'Invalid value for {0}'.format(list(options)[0]) in \
+            str(e.value)
+
+
+def test_render_warnings_only_with_err():
+    tree = mock_PackageDAG({('a', '1.0'): [('b', [])],
+                            ('b', '1.0'): [('a', [])],
+                            ('c', '1.0'): [('a', [])]})
+    with mock.patch.object(p, '_print_warnings') as print_warnings:
+        assert p.render(tree).startswith('c==1.0\n')
+        assert not print_warnings.called
+
+    err = io.StringIO()
+    with mock.patch.object(p.CompactGraph, 'components',
+                           wraps=tree._graph.components) as components:
+        p.render(tree, err=err)
+        p.render(tree, err=err)
+        # the cycles are found only once and reused for the report
+        assert 1 == components.call_count
+    assert 'Cyclic dependencies found' in err.getvalue()
+
+
+@pytest.mark.parametrize("direct_url, expected", [
+    (None, 'a==1.0'),
+    ('not json', 'a==1.0'),
+    ({'url': 'file:///src/a', 'dir_info': {'editable': True}},
+     '-e file:///src/a'),
+    ({'url': 'https://github.com/x/a', 'vcs_info': {'vcs': 'git',
+                                                    'commit_id': 'abc'}},
+     'a @ git+https://github.com/x/a@abc'),
+    ({'url': 'https://host/a-1.0.tar.gz', 'archive_info': {}},
+     'a @ https://host/a-1.0.tar.gz'),
+])
+def test_MetadataDistribution_direct_url_repr(tmpdir, direct_url, expected):
+    write_dist_info(tmpdir, 'a', '1.0')
+    dist_info = tmpdir.join('a-1.0.dist-info')
+    if direct_url is not None:
+        dist_info.join('direct_url.json').write(
+            direct_url if isinstance(direct_url, str)
+            else json.dumps(direct_url))
+    dist, = p.MetadataScanBackend().scan_dir(str(tmpdir))
+    assert expected == dist.direct_url_repr()
+    # used if pip doesn't take the distribution
+    with mock.patch.object(p, 'frozen_req_from_dist',
+                           side_effect=AttributeError('editable')):
+        assert expected == p._compute_frozen_repr(dist)
+
+
+def test_PackageDAG_cached_once_across_threads():
+    import threading
+    import time
+    tree = mock_PackageDAG({('a', '1.0'): [('b', [])],
+                            ('b', '1.0'): []})
+    results = []
+    transpose = p.CompactGraph.transpose
+
+    def slow_transpose(*args):
+        time.sleep(0.05)
+        return transpose(*args)
+
+    with mock.patch.object(p.CompactGraph, 'transpose',
+                           side_effect=slow_transpose,
+                           autospec=True) as patched:
+        threads = [threading.Thread(
+            target=lambda: results.append(tree.reverse()))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert 1 == patched.call_count
+    assert all(r is results[0] for r in results)
+
+
+# Tests for startup time
+#
+# pip and pkg_resources take hundreds of milliseconds to import, so
+# make sure they are not imported unless actually required
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='-X importtime requires python 3.7+')
+@pytest.mark.parametrize(
+    "code",
+    [
+        'pipdeptree.get_parser()',
+        "sys.argv = ['pipdeptree', '--version']; pipdeptree.main()",
+        "sys.argv = ['pipdeptree', '--help']; pipdeptree.main()"
+    ]
+)
+def test_startup_imports(code):
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    stmt = 'import sys; sys.path.insert(0, {0!r}); import pipdeptree; {1}'
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c',
+                             stmt.format(repo_dir, code)],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    assert 0 == proc.returncode
+    imported = [line.split('|')[-1].strip()
+                for line in err.decode('utf-8').splitlines()
+                if line.startswith('import time:')]
+    assert 'pipdeptree' in imported
+    slow = [m for m in imported
+            if m.split('.')[0] in ('pip', 'pkg_resources')]
+    assert [] == slow
+
+
+def test_cyclic_deps_large_graph():
+    # A single cycle through 50k packages must not hit the recursion
+    # limit
+    n = 50000
+    pkgs = [p.MetadataDistribution('pkg{0}'.format(i), '1.0',
+                                   ['pkg{0}'.format((i + 1) % n)])
+            for i in range(n)]
+    tree = p.PackageDAG.from_pkgs(pkgs)
+    components = p.strongly_connected_components(tree)
+    assert [n] == [len(c) for c in components]
+    result = p.cyclic_deps(tree)
+    assert 1 == len(result)
+    assert n + 1 == len(result[0])
+    assert 'pkg0' == result[0][0].key == result[0][-1].key
+
+
+def test_strongly_connected_components():
+    tree = mock_PackageDAG({
+        ('a', '1.0'): [('b', [])],
+        ('b', '1.0'): [('c', []), ('x', [])],
+        ('c', '1.0'): [('a', []), ('d', [])],
+        ('d', '1.0'): [('e', [])],
+        ('e', '1.0'): [('d', [])],
+        ('f', '1.0'): [('a', [])]
+    })
+    result = p.strongly_connected_components(tree)
+    assert [['a', 'b', 'c'], ['d', 'e'], ['f']] == \
+        sorted(sorted(c) for c in result)
+    # components are in reverse topological order
+    order = [sorted(c) for c in result]
+    assert order.index(['d', 'e']) < order.index(['a', 'b', 'c']) < \
+        order.index(['f'])
+
+
 # Tests for the argparse parser
 
 def test_parser_default():
@@ -508,6 +2152,33 @@ def test_parser_json_tree():
     assert args.output_format is None
 
 
+def test_parser_json_lines():
+    parser = p.get_parser()
+    args = parser.parse_args(['--json-lines'])
+    assert args.json_lines
+    assert not args.json
+    assert args.output_format is None
+
+
+def test_parser_depth():
+    parser = p.get_parser()
+    assert parser.parse_args([]).depth is None
+    assert 2 == parser.parse_args(['--depth', '2']).depth
+    for arg in ['-1', 'x']:
+        with pytest.raises(SystemExit):
+            parser.parse_args(['--depth', arg])
+
+
+def test_parser_what_if():
+    parser = p.get_parser()
+    assert parser.parse_args([]).what_if is None
+    args = parser.parse_args(['--what-if', 'Foo_Bar==1.0, baz == 2'])
+    assert [('foo-bar', '1.0'), ('baz', '2')] == args.what_if
+    for arg in ['foo', 'foo==', '==1.0', 'foo==1.0,']:
+        with pytest.raises(SystemExit):
+            parser.parse_args(['--what-if', arg])
+
+
 def test_parser_pdf():
     parser = p.get_parser()
     args = parser.parse_args(['--graph-output', 'pdf'])
@@ -520,3 +2191,43 @@ def test_parser_svg():
     args = parser.parse_args(['--graph-output', 'svg'])
     assert args.output_format == 'svg'
     assert not args.json
+
+
+def test_parser_backend():
+    parser = p.get_parser()
+    assert 'pip' == parser.parse_args([]).backend
+    args = parser.parse_args(['--backend', 'scan'])
+    assert 'scan' == args.backend
+
+
+def test_parser_guess_by_import():
+    parser = p.get_parser()
+    assert not parser.parse_args([]).guess_by_import
+    assert parser.parse_args(['--guess-by-import']).guess_by_import
+
+
+def test_parser_dedupe():
+    parser = p.get_parser()
+    assert not parser.parse_args([]).dedupe
+    assert parser.parse_args(['--dedupe']).dedupe
+
+
+def test_parser_cache():
+    parser = p.get_parser()
+    assert not parser.parse_args([]).cache
+    assert parser.parse_args(['--cache']).cache
+
+
+@pytest.mark.parametrize("argv, warns", [
+    (['--cache'], True),
+    (['--cache', '--backend', 'importlib'], True),
+    (['--cache', '--backend', 'scan'], False),
+    (['--backend', 'pip'], False),
+])
+def test_main_cache_ignored_warning(argv, warns, capsys):
+    args = p.get_parser().parse_args(argv + ['--warn', 'silence'])
+    with mock.patch.object(p, '_get_args', return_value=args):
+        with mock.patch.object(p, 'discover_distributions', return_value=[]):
+            assert 0 == p.main()
+    _, err = capsys.readouterr()
+    assert warns == ('--cache is ignored' in err)